@@ -0,0 +1,62 @@
+"""
+Per-deploy overhead of the Deployer, excluding the kubernetes API request.
+
+Before: every handler built its own Deployer, with a fresh jinja Environment
+and five kubernetes API objects each owning a connection pool, then rendered.
+After: handlers share one Deployer with compiled templates and one ApiClient.
+
+Run from the repository root with `python -m benchmarks.deployer`.
+"""
+
+import argparse
+import time
+
+import yaml
+from jinja2 import Environment, PackageLoader, select_autoescape
+from kubernetes.client import AppsV1Api, BatchV1Api, CoreV1Api, CustomObjectsApi, NetworkingV1Api
+
+from kanidm_operator.deployer import Deployer, b64enc, slugify
+
+VARIABLES = dict(username="idm_admin", password="hunter2")
+
+
+def per_call_deployer():
+    # What Deployer.__init__ did for every deploy before it was shared
+    apis = [CoreV1Api(), BatchV1Api(), AppsV1Api(), NetworkingV1Api(), CustomObjectsApi()]
+    env = Environment(
+        loader=PackageLoader("kanidm_operator", package_path="templates", encoding="utf-8"),
+        autoescape=select_autoescape(["toml", "yaml", "yml", "json"]),
+    )
+    env.filters["b64enc"] = b64enc
+    env.filters["slugify"] = slugify
+    template = env.get_template(name="usersecret.yaml", globals={"namespace": "kanidm", "version": "1.1.0"})
+    return apis, yaml.safe_load(template.render(**VARIABLES))
+
+
+def shared_deployer(deployer: Deployer):
+    return deployer.api_client, deployer.render("usersecret.yaml", "kanidm", "1.1.0", **VARIABLES)
+
+
+def measure(func, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - started) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=500)
+    args = parser.parse_args()
+
+    deployer = Deployer()
+    deployer.compile_templates()
+
+    before = measure(per_call_deployer, args.iterations)
+    after = measure(lambda: shared_deployer(deployer), args.iterations)
+    print(f"per-call deployer: {before * 1e6:10.1f} us/deploy")
+    print(f"shared deployer:   {after * 1e6:10.1f} us/deploy ({before / after:.1f}x faster)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Stand-in for the kanidm CLI tool, forwarding the subcommands the operator
+uses to the REST API of tests/kanidm_stub.py, and printing their results the
+way the real tool does.
+
+It authenticates with KANIDM_PASSWORD as a bearer token, which the benchmark
+registers with the stub, rather than keeping a token file.
+"""
+
+import json
+import os
+import sys
+import urllib.error
+import urllib.request
+
+
+def call(method: str, path: str, body=None):
+    request = urllib.request.Request(
+        os.environ["KANIDM_URL"] + path,
+        method=method,
+        data=None if body is None else json.dumps(body).encode("utf-8"),
+        headers={"Authorization": f"Bearer {os.environ['KANIDM_PASSWORD']}", "Content-Type": "application/json"},
+    )
+    try:
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read() or b"null")
+    except urllib.error.HTTPError as e:
+        print(f"Error: Http({e.code})", file=sys.stderr)
+        sys.exit(1)
+
+
+def print_entry(attrs: dict[str, list[str]]):
+    print("---")
+    for key, values in attrs.items():
+        for value in values:
+            print(f"{key}: {value}")
+
+
+def person(command: str, args: list[str]):
+    match command:
+        case "get":
+            entry = call("GET", f"/v1/person/{args[-1]}")
+            print("No matching entries" if entry is None else json.dumps(entry))
+        case "list":
+            for entry in call("GET", "/v1/person"):
+                print(json.dumps(entry))
+        case "create":
+            call("POST", "/v1/person", {"attrs": {"name": [args[0]], "displayname": [args[1]]}})
+        case "update" if args[1] == "--displayname":
+            call("PATCH", f"/v1/person/{args[0]}", {"attrs": {"displayname": [args[2]]}})
+        case "update":
+            call("PUT", f"/v1/person/{args[0]}/_attr/mail", args[2::2])
+        case "delete":
+            call("DELETE", f"/v1/person/{args[0]}")
+
+
+def group(command: str, args: list[str]):
+    match command:
+        case "get":
+            entry = call("GET", f"/v1/group/{args[-1]}")
+            if entry is None:
+                print("No matching group", file=sys.stderr)
+            else:
+                print(json.dumps(entry))
+        case "list":
+            for entry in call("GET", "/v1/group"):
+                print(json.dumps(entry))
+        case "create":
+            call("POST", "/v1/group", {"attrs": {"name": [args[0]]}})
+        case "set-members":
+            call("PUT", f"/v1/group/{args[0]}/_attr/member", args[1:])
+        case "add-members":
+            call("POST", f"/v1/group/{args[0]}/_attr/member", args[1:])
+        case "remove-members":
+            call("DELETE", f"/v1/group/{args[0]}/_attr/member", args[1:])
+        case "delete":
+            call("DELETE", f"/v1/group/{args[0]}")
+
+
+def oauth2(command: str, args: list[str]):
+    match command:
+        case "get":
+            entry = call("GET", f"/v1/oauth2/{args[0]}")
+            if entry is None:
+                print("No matching entries")
+            else:
+                print_entry(entry["attrs"])
+        case "list":
+            for entry in call("GET", "/v1/oauth2"):
+                print_entry(entry["attrs"])
+        case "create":
+            call("POST", "/v1/oauth2/_basic", {"attrs": {
+                "oauth2_rs_name": [args[0]], "displayname": [args[1]], "oauth2_rs_origin": [args[2]],
+            }})
+        case "reset-secrets":
+            call("PATCH", f"/v1/oauth2/{args[0]}", {"attrs": {"oauth2_rs_basic_secret": []}})
+        case "show-basic-secret":
+            print(call("GET", f"/v1/oauth2/{args[0]}/_basic_secret"))
+        case "prefer-short-username":
+            call("PATCH", f"/v1/oauth2/{args[0]}", {"attrs": {"oauth2_prefer_short_username": ["true"]}})
+        case "enable-pkce":
+            call("PATCH", f"/v1/oauth2/{args[0]}", {"attrs": {"oauth2_allow_insecure_client_disable_pkce": []}})
+        case "warning-insecure-client-disable-pkce":
+            call("PATCH", f"/v1/oauth2/{args[0]}", {"attrs": {"oauth2_allow_insecure_client_disable_pkce": ["true"]}})
+        case "set-landing-url":
+            call("PATCH", f"/v1/oauth2/{args[0]}", {"attrs": {"oauth2_rs_origin_landing": [args[1]]}})
+        case "update-scope-map":
+            call("POST", f"/v1/oauth2/{args[0]}/_scopemap/{args[1]}", args[2:])
+        case "delete":
+            call("DELETE", f"/v1/oauth2/{args[0]}")
+
+
+def main(args: list[str]):
+    match args:
+        case ["login", *_]:
+            call("GET", "/v1/person")
+        case ["person", command, *rest]:
+            person(command, [arg for arg in rest if arg not in ("-o", "json")])
+        case ["group", command, *rest]:
+            group(command, [arg for arg in rest if arg not in ("-o", "json")])
+        case ["system", "oauth2", command, *rest]:
+            oauth2(command, rest)
+        case _:
+            print(f"Unsupported command: {' '.join(args)}", file=sys.stderr)
+            sys.exit(2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
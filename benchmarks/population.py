@@ -0,0 +1,276 @@
+"""
+Large, realistic identity populations, replayed into the operator.
+
+Generates users with one to three emails, groups with other groups among
+their members, and oauth2 clients with scope maps. They are either written
+out as manifests (--write) or replayed as streams of create, update and
+delete events through the operator's handlers, under the harness of
+benchmarks.reconcile. Each phase reports how long kanidm took to converge
+on the final state, and how much the process' memory grew.
+
+As kopf does, events for one resource are handled in order and different
+resources concurrently, and handlers failing with a TemporaryError are
+retried, e.g. a group whose members were not created in time.
+
+Run from the repository root with `python -m benchmarks.population`.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import copy
+import logging
+import os
+import random
+import resource
+import tempfile
+import time
+from collections import defaultdict
+from typing import Any
+
+import kopf
+import yaml
+
+from kanidm_operator.deploy.bulk import drifted, group_state, oauth2client_state, user_state
+from kanidm_operator.deploy.group import on_create_group, on_delete_group, on_update_group_members
+from kanidm_operator.deploy.oauth2client import on_create_oauth2client, on_delete_oauth2client
+from kanidm_operator.deploy.user import on_create_user, on_delete_user
+from kanidm_operator.deployer import _applied_hashes
+from kanidm_operator.sessions import sessions
+from tests.kanidm_stub import KanidmStub
+from .reconcile import KANIDM_NAME, NAMESPACE, index_resources, invoke, start_environment
+
+FIRST_NAMES = ["ada", "alan", "anna", "barbara", "claude", "edsger", "frances", "grace", "john", "ken", "linus", "margaret", "niklaus", "radia", "tim"]
+LAST_NAMES = ["allen", "berners-lee", "dijkstra", "hamilton", "hopper", "kernighan", "liskov", "lovelace", "perlman", "ritchie", "shannon", "turing", "wirth"]
+SCOPES = ["openid", "email", "profile", "groups"]
+
+HANDLERS = {
+    ("users", "create"): on_create_user,
+    ("users", "update"): on_create_user,
+    ("users", "delete"): on_delete_user,
+    ("groups", "create"): on_create_group,
+    ("groups", "update"): on_update_group_members,
+    ("groups", "delete"): on_delete_group,
+    ("oauth2-clients", "create"): on_create_oauth2client,
+    ("oauth2-clients", "update"): on_create_oauth2client,
+    ("oauth2-clients", "delete"): on_delete_oauth2client,
+}
+KINDS = {"users": "User", "groups": "Group", "oauth2-clients": "OAuth2Client"}
+
+logger = logging.getLogger("benchmark")
+
+Population = dict[str, dict[str, dict]]
+Event = tuple[str, str, dict]
+
+
+def resource_body(plural: str, spec: dict) -> dict:
+    return {
+        "apiVersion": "kanidm.github.io/v1alpha1",
+        "kind": KINDS[plural],
+        "metadata": {"name": spec["name"], "namespace": NAMESPACE, "uid": f"uid-{plural}-{spec['name']}"},
+        "spec": {"kanidmName": KANIDM_NAME, **spec},
+    }
+
+
+def generate_population(rng: random.Random, users: int, groups: int, oauth2clients: int, nested: float) -> Population:
+    """Resources by plural and name."""
+    population: Population = {plural: {} for plural in KINDS}
+    for i in range(users):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        name = f"{first}.{last}.{i}"
+        emails = [f"{name}@example.com", f"{first[0]}{last}{i}@corp.example.com", f"{last}.{i}@alumni.example.org"]
+        population["users"][name] = resource_body("users", {
+            "name": name,
+            "displayName": f"{first.title()} {last.title()}",
+            "emails": emails[:rng.choice([1, 1, 1, 2, 2, 3])],
+        })
+
+    user_names = list(population["users"])
+    for i in range(groups):
+        # Most groups are small teams, a few are department wide
+        size = min(len(user_names), int(rng.paretovariate(1.2) * 5))
+        members = rng.sample(user_names, size)
+        if i > 0 and rng.random() < nested:
+            # Only earlier groups, so memberships never cycle
+            members += [f"group-{j}" for j in rng.sample(range(i), min(i, rng.randint(1, 3)))]
+        population["groups"][f"group-{i}"] = resource_body("groups", {"name": f"group-{i}", "members": members})
+
+    group_names = list(population["groups"])
+    for i in range(oauth2clients):
+        spec = {"name": f"app-{i}", "displayName": f"App {i}", "origin": f"https://app-{i}.example.com"}
+        if group_names:
+            spec["scope-map"] = {"group": rng.choice(group_names), "scopes": rng.sample(SCOPES, rng.randint(1, len(SCOPES)))}
+        if rng.random() < 0.5:
+            spec["callback-url"] = f"https://app-{i}.example.com/oauth2/callback"
+        if rng.random() < 0.3:
+            spec["prefer-short-username"] = True
+        population["oauth2-clients"][spec["name"]] = resource_body("oauth2-clients", spec)
+    return population
+
+
+def updated(rng: random.Random, plural: str, body: dict, population: Population) -> dict:
+    """A copy of a resource with an edit typical of its kind."""
+    body = copy.deepcopy(body)
+    spec = body["spec"]
+    if plural == "users":
+        if rng.random() < 0.5:
+            spec["displayName"] += " Jr"
+        else:
+            spec["emails"] = spec["emails"][1:] + [f"{spec['name']}@new.example.com"]
+    elif plural == "groups":
+        spec["members"] = [m for m in spec["members"] if rng.random() > 0.1] + rng.sample(list(population["users"]), 2)
+    elif "scope-map" in spec:
+        spec["scope-map"]["scopes"] = rng.sample(SCOPES, rng.randint(1, len(SCOPES)))
+    else:
+        spec["displayName"] += " (renamed)"
+    return body
+
+
+def phases(rng: random.Random, population: Population, updates: float, deletes: float) -> list[tuple[str, list[Event], Population]]:
+    """The create, update and delete event streams, each with the population it leaves."""
+    created = [(plural, "create", body) for plural, bodies in population.items() for body in bodies.values()]
+    rng.shuffle(created)
+
+    after_updates = copy.deepcopy(population)
+    update_events = []
+    for plural, bodies in after_updates.items():
+        for name in rng.sample(list(bodies), int(len(bodies) * updates)):
+            bodies[name] = updated(rng, plural, bodies[name], after_updates)
+            update_events.append((plural, "update", bodies[name]))
+    rng.shuffle(update_events)
+
+    after_deletes = copy.deepcopy(after_updates)
+    delete_events = []
+    for plural, bodies in after_deletes.items():
+        for name in rng.sample(list(bodies), int(len(bodies) * deletes)):
+            delete_events.append((plural, "delete", bodies.pop(name)))
+    rng.shuffle(delete_events)
+
+    return [("create", created, population), ("update", update_events, after_updates), ("delete", delete_events, after_deletes)]
+
+
+async def handle(event: Event, indexes: dict[str, Any], timeout: float, retry_delay: float) -> int:
+    """Handle one event, retrying as kopf would until timeout, returning the number of retries."""
+    plural, action, body = event
+    given_up_at = time.monotonic() + timeout
+    attempt = 0
+    while True:
+        try:
+            await invoke(HANDLERS[plural, action], plural, body, indexes)
+            return attempt
+        except kopf.TemporaryError as e:
+            if time.monotonic() > given_up_at:
+                logger.warning(f"Giving up on {action} of {plural} {body['metadata']['name']}: {e}")
+                return attempt
+            attempt += 1
+            await asyncio.sleep(min(e.delay or retry_delay, retry_delay))
+
+
+async def replay(events: list[Event], indexes: dict[str, Any], concurrency: int, rate: float, timeout: float, retry_delay: float) -> int:
+    """Replay events arriving at rate per second (all at once if 0), returning the number of retries."""
+    by_resource: dict[tuple[str, str], list[tuple[float, Event]]] = defaultdict(list)
+    for index, event in enumerate(events):
+        by_resource[event[0], event[2]["metadata"]["name"]].append((index / rate if rate else 0.0, event))
+    # Handlers waiting on the resources they depend on hold a slot, so only
+    # bound them when asked to, as kopf's worker limit would
+    semaphore = asyncio.Semaphore(concurrency) if concurrency else contextlib.nullcontext()
+    started = time.monotonic()
+
+    async def worker(queue: list[tuple[float, Event]]) -> int:
+        retried = 0
+        for arrival, event in queue:
+            await asyncio.sleep(max(0.0, started + arrival - time.monotonic()))
+            async with semaphore:
+                retried += await handle(event, indexes, timeout, retry_delay)
+        return retried
+
+    return sum(await asyncio.gather(*(worker(queue) for queue in by_resource.values())))
+
+
+def differences(stub: KanidmStub, population: Population) -> int:
+    """How many resources kanidm disagrees with, missing and left over ones included."""
+    states = {"users": ("person", user_state), "groups": ("group", group_state), "oauth2-clients": ("oauth2", oauth2client_state)}
+    count = 0
+    for plural, (kind, state) in states.items():
+        entries = stub.entries[kind]
+        desired = population[plural]
+        count += sum(drifted(state, body["spec"], {"attrs": entries.get(name)} if name in entries else None) for name, body in desired.items())
+        count += len(entries.keys() - desired.keys())
+    return count
+
+
+def rss_bytes() -> int:
+    """Resident memory of this process, falling back to its peak where /proc is missing."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+async def benchmark(args: argparse.Namespace, population: Population, cli_directory: str):
+    rng = random.Random(args.seed + 1)
+    stub, _, indexes = await start_environment(args.backend, cli_directory, args.kanidm_latency, args.k8s_latency)
+    print(f"{args.backend} backend, {len(population['users'])} users, {len(population['groups'])} groups, "
+          f"{len(population['oauth2-clients'])} oauth2 clients, {args.concurrency or 'unbounded'} handlers at once")
+    baseline = rss_bytes()
+    try:
+        for phase, events, expected in phases(rng, population, args.updates, args.deletes):
+            index_resources(indexes, expected["users"].values(), expected["groups"].values())
+            started = time.perf_counter()
+            retried = await replay(events, indexes, args.concurrency, args.rate, args.timeout, args.retry_delay)
+            converged = time.perf_counter() - started
+            remaining = differences(stub, expected)
+            print(
+                f"{phase:6} {len(events):7} events, {retried:5} retries, "
+                + (f"converged in {converged:7.2f}s" if remaining == 0 else f"NOT converged, {remaining} resources differ after {converged:.2f}s")
+                + f"  rss +{(rss_bytes() - baseline) / 2**20:7.1f}MiB"
+                f"  cached sessions {len(sessions)}, applied hashes {len(_applied_hashes)}"
+            )
+    finally:
+        await stub.stop()
+
+
+def write_manifests(population: Population, directory: str):
+    os.makedirs(directory, exist_ok=True)
+    for plural, bodies in population.items():
+        manifests = [
+            {"apiVersion": body["apiVersion"], "kind": body["kind"], "metadata": {"name": name}, "spec": body["spec"]}
+            for name, body in bodies.items()
+        ]
+        with open(os.path.join(directory, f"{plural}.yaml"), "w") as f:
+            yaml.safe_dump_all(manifests, f, sort_keys=False)
+    print(f"Wrote {sum(len(bodies) for bodies in population.values())} resources to {directory}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--groups", type=int, default=500)
+    parser.add_argument("--oauth2-clients", type=int, default=50)
+    parser.add_argument("--nested", type=float, default=0.2, help="fraction of groups with groups among their members")
+    parser.add_argument("--updates", type=float, default=0.2, help="fraction of resources updated after creation")
+    parser.add_argument("--deletes", type=float, default=0.05, help="fraction of resources deleted after the updates")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--write", metavar="DIRECTORY", help="write the population as manifests instead of replaying it")
+    parser.add_argument("--backend", choices=["http", "cli"], default="http")
+    parser.add_argument("--concurrency", type=int, default=0, help="handlers run at once, 0 for as many as there are resources, as kopf does")
+    parser.add_argument("--rate", type=float, default=0.0, help="events arriving per second, 0 for all at once")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds a handler failing with a TemporaryError is retried for")
+    parser.add_argument("--retry-delay", type=float, default=0.5, help="longest wait before a retry, in seconds")
+    parser.add_argument("--kanidm-latency", type=float, default=0.0, help="seconds added to each kanidm API call")
+    parser.add_argument("--k8s-latency", type=float, default=0.0, help="seconds added to each kubernetes API call")
+    args = parser.parse_args()
+
+    population = generate_population(random.Random(args.seed), args.users, args.groups, args.oauth2_clients, args.nested)
+    if args.write:
+        write_manifests(population, args.write)
+        return
+
+    logging.basicConfig(level=logging.ERROR)
+    with tempfile.TemporaryDirectory() as cli_directory:
+        asyncio.run(benchmark(args, population, cli_directory))
+
+
+if __name__ == "__main__":
+    main()
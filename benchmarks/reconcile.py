@@ -0,0 +1,274 @@
+"""
+Reconcile throughput of the user, group and oauth2 client handlers.
+
+Runs the real handlers from kanidm_operator/deploy against tests/kanidm_stub.py
+standing in for kanidm, either over REST or through benchmarks/fake_kanidm.py
+standing in for the kanidm CLI, and an in-memory kubernetes API. No cluster
+or kanidm server is needed.
+
+Each phase reports reconciles per second, the p50/p99 latency of a handler
+call, and how many kanidm API calls, CLI subprocesses and kubernetes API
+calls it took:
+  create  every resource is new
+  resync  every resource is handled again, with nothing to change
+  bulk    one bulk reconcile of the whole instance, as done on operator restart
+
+Run from the repository root with `python -m benchmarks.reconcile`.
+"""
+
+import argparse
+import asyncio
+import copy
+import logging
+import os
+import stat
+import sys
+import tempfile
+import time
+from typing import Any, Awaitable, Callable, Iterable
+
+import kopf
+from kopf._core.actions import execution
+from kopf._core.intents import causes
+
+import kanidm_operator.client
+from kanidm_operator.deploy import util
+from kanidm_operator.deploy.bulk import bulk_reconcile_instance
+from kanidm_operator.deploy.group import on_create_group
+from kanidm_operator.deploy.oauth2client import SECRET_FINGERPRINT_ANNOTATION, on_create_oauth2client
+from kanidm_operator.deploy.user import on_create_user
+from kanidm_operator.deployer import deployer
+from kanidm_operator.metrics import kanidm_requests
+from kanidm_operator.sessions import sessions
+from tests.kanidm_stub import KanidmStub
+
+NAMESPACE = "kanidm"
+KANIDM_NAME = "kanidm"
+PASSWORD = "benchmark-password"
+
+logger = logging.getLogger("benchmark")
+
+
+class InMemoryApiClient:
+    """Stands in for the kubernetes ApiClient used by the Deployer, keeping applied objects by path."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.objects: dict[str, Any] = {}
+        self.calls = 0
+
+    def call_api(self, path: str, method: str, body: Any = None, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        if method == "GET":
+            return copy.deepcopy(self.objects.get(path))
+        self.objects[path] = copy.deepcopy(body)
+        return body
+
+
+def generate_resources(users: int, groups: int, oauth2clients: int, members: int) -> dict[str, list[dict]]:
+    """Resources as kopf would hand them to the handlers, by plural."""
+    def resource(kind: str, name: str, spec: dict) -> dict:
+        return {
+            "apiVersion": "kanidm.github.io/v1alpha1",
+            "kind": kind,
+            "metadata": {"name": name, "namespace": NAMESPACE, "uid": f"uid-{kind}-{name}"},
+            "spec": {"kanidmName": KANIDM_NAME, **spec},
+        }
+
+    return {
+        "users": [
+            resource("User", f"user-{i}", {"name": f"user-{i}", "displayName": f"User {i}", "emails": [f"user-{i}@example.com"]})
+            for i in range(users)
+        ],
+        "groups": [
+            resource("Group", f"group-{i}", {"name": f"group-{i}", "members": [f"user-{(i * members + j) % users}" for j in range(min(members, users))]})
+            for i in range(groups)
+        ],
+        "oauth2-clients": [
+            resource("OAuth2Client", f"client-{i}", {
+                "name": f"client-{i}",
+                "displayName": f"Client {i}",
+                "origin": f"https://client-{i}.example.com",
+                **({"scope-map": {"group": f"group-{i % groups}", "scopes": ["openid", "email"]}} if groups else {}),
+            })
+            for i in range(oauth2clients)
+        ],
+    }
+
+
+def percentile(latencies: list[float], fraction: float) -> float:
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+
+class Counters:
+    def __init__(self, stub: KanidmStub, api_client: InMemoryApiClient):
+        self.stub = stub
+        self.api_client = api_client
+
+    def snapshot(self) -> tuple[int, int, int]:
+        subprocesses = sum(
+            sample.value
+            for metric in kanidm_requests.collect()
+            for sample in metric.samples
+            if sample.name.endswith("_total") and sample.labels["backend"] == "cli"
+        )
+        return sum(self.stub.requests.values()), int(subprocesses), self.api_client.calls
+
+
+def report(phase: str, reconciles: int, elapsed: float, latencies: list[float], before: tuple, after: tuple):
+    kanidm_calls, subprocesses, k8s_calls = (a - b for a, b in zip(after, before))
+    print(
+        f"{phase:7} {reconciles:6} reconciles in {elapsed:7.2f}s {reconciles / elapsed:9.1f}/s"
+        f"  p50 {percentile(latencies, 0.5) * 1e3:8.1f}ms  p99 {percentile(latencies, 0.99) * 1e3:8.1f}ms"
+        f"  kanidm calls {kanidm_calls:6}  subprocesses {subprocesses:6}  k8s calls {k8s_calls:5}"
+    )
+
+
+async def invoke(handler: Callable[..., Awaitable], plural: str, body: dict, indexes: dict[str, Any]) -> float:
+    """Call a handler as kopf would, returning how long it took."""
+    # Handlers adopt what they deploy, finding their owner in kopf's context.
+    # This runs in its own task, so the context stays local to the call
+    execution.cause_var.set(causes.ResourceCause(
+        logger=logger,
+        indices=None,
+        memo=kopf.Memo(),
+        resource=kopf.Resource("kanidm.github.io", "v1alpha1", plural),
+        patch=kopf.Patch(),
+        body=kopf.Body(body),
+    ))
+    patch: dict = {}
+    started = time.perf_counter()
+    await handler(
+        spec=body["spec"],
+        name=body["metadata"]["name"],
+        namespace=NAMESPACE,
+        body=body,
+        patch=patch,
+        annotations=dict(body["metadata"].get("annotations", {})),
+        logger=logger,
+        **indexes,
+    )
+    elapsed = time.perf_counter() - started
+    # Keep the annotations the handler patched, for its next call to see
+    body["metadata"].setdefault("annotations", {}).update(patch.get("metadata", {}).get("annotations", {}))
+    return elapsed
+
+
+async def run_phase(resources: dict[str, list[dict]], indexes: dict[str, Any], concurrency: int) -> tuple[int, float, list[float]]:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(handler, plural, body):
+        async with semaphore:
+            return await invoke(handler, plural, body, indexes)
+
+    latencies = []
+    started = time.perf_counter()
+    # Users before the groups they are members of, before the oauth2 clients mapping those
+    for handler, plural in [(on_create_user, "users"), (on_create_group, "groups"), (on_create_oauth2client, "oauth2-clients")]:
+        latencies += await asyncio.gather(*(asyncio.create_task(bounded(handler, plural, body)) for body in resources[plural]))
+    return len(latencies), time.perf_counter() - started, latencies
+
+
+def fake_cli(directory: str) -> str:
+    """An executable running benchmarks/fake_kanidm.py with this interpreter."""
+    path = os.path.join(directory, "kanidm")
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_kanidm.py")
+    with open(path, "w") as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{script}" "$@"\n')
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+async def start_environment(
+    backend: str,
+    cli_directory: str,
+    kanidm_latency: float = 0.0,
+    k8s_latency: float = 0.0,
+) -> tuple[KanidmStub, InMemoryApiClient, dict[str, Any]]:
+    """Point the operator at a started kanidm stub and an in-memory kubernetes API.
+
+    Returns the stub, the API and the indexes to pass the handlers.
+    """
+    stub = KanidmStub(password=PASSWORD)
+    stub.delay = kanidm_latency
+    stub.referential_integrity = True
+    url = await stub.start()
+    # The fake CLI presents the password as its token rather than logging in
+    stub.tokens.add(PASSWORD)
+    util.kanidm_backend = backend
+    util.kanidm_exec = fake_cli(cli_directory)
+    # Everything goes to the stub, rather than kanidm's public or in-cluster URLs
+    kanidm_operator.client.kanidm_endpoints = lambda kanidm, namespace, ca: {"url": url}
+    api_client = InMemoryApiClient(k8s_latency)
+    deployer.api_client = api_client
+    sessions.clear()
+
+    indexes = {
+        "kanidm_index": {(NAMESPACE, KANIDM_NAME): [{"metadata": {"name": KANIDM_NAME, "namespace": NAMESPACE}, "spec": {"domain": "idm.example.com"}}]},
+        "credentials_index": {(NAMESPACE, "idm-admin"): [{"name": "idm-admin", "password": PASSWORD}]},
+        "tls_index": {},
+        "user_index": {},
+        "group_index": {},
+    }
+    return stub, api_client, indexes
+
+
+def index_resources(indexes: dict[str, Any], users: Iterable[dict], groups: Iterable[dict]):
+    """Index the users and groups as kopf would, for the handlers to find the resources they depend on."""
+    for index, bodies in (("user_index", users), ("group_index", groups)):
+        indexes[index] = {(NAMESPACE, KANIDM_NAME): [
+            {"name": body["metadata"]["name"], "spec": body["spec"], "processed": False} for body in bodies
+        ]}
+
+
+async def benchmark(args: argparse.Namespace, cli_directory: str):
+    stub, api_client, indexes = await start_environment(args.backend, cli_directory, args.kanidm_latency, args.k8s_latency)
+    resources = generate_resources(args.users, args.groups, args.oauth2_clients, args.members)
+    index_resources(indexes, resources["users"], resources["groups"])
+    counters = Counters(stub, api_client)
+    print(f"{args.backend} backend, {args.users} users, {args.groups} groups of {args.members}, "
+          f"{args.oauth2_clients} oauth2 clients, {args.concurrency} handlers at once")
+
+    try:
+        for phase in ("create", "resync"):
+            before = counters.snapshot()
+            count, elapsed, latencies = await run_phase(resources, indexes, args.concurrency)
+            report(phase, count, elapsed, latencies, before, counters.snapshot())
+
+        before = counters.snapshot()
+        started = time.perf_counter()
+        client = await util.kanidm_client(KANIDM_NAME, NAMESPACE, logger, indexes["kanidm_index"], indexes["credentials_index"], indexes["tls_index"])
+        indexed = {plural: [{
+            "name": r["metadata"]["name"],
+            "spec": r["spec"],
+            "owner": r,
+            "fingerprint": r["metadata"].get("annotations", {}).get(SECRET_FINGERPRINT_ANNOTATION),
+        } for r in items] for plural, items in resources.items()}
+        await bulk_reconcile_instance(client, NAMESPACE, logger, indexed["users"], indexed["groups"], indexed["oauth2-clients"])
+        elapsed = time.perf_counter() - started
+        report("bulk", sum(len(items) for items in resources.values()), elapsed, [elapsed], before, counters.snapshot())
+    finally:
+        await stub.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--backend", choices=["http", "cli"], default="http")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--members", type=int, default=10, help="members of each group")
+    parser.add_argument("--oauth2-clients", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=32, help="handlers run at once, as kopf does for different resources")
+    parser.add_argument("--kanidm-latency", type=float, default=0.0, help="seconds added to each kanidm API call")
+    parser.add_argument("--k8s-latency", type=float, default=0.0, help="seconds added to each kubernetes API call")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    with tempfile.TemporaryDirectory() as cli_directory:
+        asyncio.run(benchmark(args, cli_directory))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,25 @@
 # noqa: F401,W0611
 # pylint: disable=unused-import
 
-from .deploy.kanidm import on_create_kanidms, on_update_kanidms  # noqa
+from .deployer import compile_templates  # noqa
+from .http_client import close_http_session  # noqa
+from .metrics import (
+    start_lag_monitor,
+    stop_lag_monitor,
+    event_loop_lag_probe,
+    start_metrics_server,
+    stop_metrics_server,
+)  # noqa
+from .settings import configure_operator  # noqa
+from .tracing import start_span_exporter, stop_span_exporter  # noqa
+
+from .deploy.kanidm import kanidm_index, kanidm_pod_index, on_create_kanidms, on_update_kanidms  # noqa
+from .deploy.credentials import credentials_index, on_credentials_event  # noqa
+from .deploy.tls import tls_index  # noqa
+from .deploy.bulk import on_resume_kanidms  # noqa
+from .deploy.drift import check_kanidm_drift  # noqa
 from .deploy.group import (
+    group_index,
     on_create_group,
     #on_update_group_name,
     on_update_group_members,
@@ -10,11 +27,13 @@ from .deploy.group import (
 )  # noqa
 
 from .deploy.user import (
+    user_index,
     on_create_user, 
     on_delete_user  
 ) # noqa
 
 from .deploy.oauth2client import (
+    oauth2client_index,
     on_create_oauth2client,
     #on_update_oauth2client_name,
     on_delete_oauth2client,
@@ -0,0 +1,360 @@
+import abc
+import os
+from logging import Logger
+
+import kopf
+
+from kanidm_operator.deployer import slugify
+from kanidm_operator.limiter import instance_limiter, max_concurrent_operations
+from kanidm_operator.metrics import kanidm_logins
+from kanidm_operator.tracing import span
+from kanidm_operator.sessions import KanidmSession, sessions
+
+# Largest number of members added or removed from a group in one call
+member_batch_size = int(os.environ.get("KANIDM_MEMBER_BATCH_SIZE", "100"))
+# Talk to kanidm through its in-cluster services rather than its public domain
+internal_routing = os.environ.get("KANIDM_INTERNAL_ROUTING", "true").lower() == "true"
+
+
+def find_kanidm(kanidm_index: kopf.Index, namespace: str, name: str) -> dict | None:
+    """Look up a kanidm instance in the index maintained by kanidm_operator.deploy.kanidm.kanidm_index."""
+    for kanidm in kanidm_index.get((namespace, name), []):
+        return kanidm
+    return None
+
+
+def find_password(credentials_index: kopf.Index, namespace: str, username: str) -> str:
+    """Look up a password in the index maintained by kanidm_operator.deploy.credentials.credentials_index."""
+    secrets = list(credentials_index.get((namespace, slugify(username)), []))
+    if len(secrets) == 0:
+        raise kopf.TemporaryError(f"No secret found for user {username} in the namespace {namespace}", delay=10)
+    if len(secrets) > 1:
+        raise kopf.TemporaryError(f"Multiple secrets for {username} in the namespace {namespace} found!", delay=10)
+    if secrets[0]["password"] is None:
+        raise kopf.TemporaryError(f"Secret for {username} in the namespace {namespace} does not contain a password!", delay=10)
+    return secrets[0]["password"]
+
+
+def find_ca(tls_index: kopf.Index, namespace: str) -> str | None:
+    """Look up the CA of a kanidm certificate in the index maintained by kanidm_operator.deploy.tls.tls_index."""
+    for ca in tls_index.get(namespace, []):
+        if ca is not None:
+            return ca
+    return None
+
+
+def kanidm_endpoints(kanidm: dict, namespace: str, ca: str | None) -> dict:
+    """The URLs to reach a kanidm instance on, see KanidmSession."""
+    spec = kanidm["spec"]
+    endpoints = {"url": "https://" + spec["domain"]}
+    if internal_routing:
+        port = spec.get("webPort", 8443)
+        endpoints["internal_url"] = f"https://kanidm-svc.{namespace}.svc:{port}"
+        # None once high availability is disabled, so cached sessions stop reading from replicas
+        endpoints["read_url"] = None
+        if spec.get("highAvailability", {}).get("enabled", False):
+            endpoints["read_url"] = f"https://kanidm-read-svc.{namespace}.svc:{port}"
+        # The certificate is only issued for the public domain
+        endpoints["server_hostname"] = spec["domain"]
+        endpoints["ca"] = ca
+    return endpoints
+
+
+def member_key(member: str) -> str:
+    return member.split("@", 1)[0].lower()
+
+
+def first(attrs: dict[str, list[str]], attr: str) -> str | None:
+    return (attrs.get(attr) or [None])[0]
+
+
+def parse_scope_maps(scope_maps: list[str]) -> dict[str, list[str]]:
+    """Scopes by group from kanidm's `group@domain: {"scope", ...}` scope map values."""
+    parsed = {}
+    for scope_map in scope_maps:
+        group, _, scopes = scope_map.partition(":")
+        parsed[member_key(group.strip())] = sorted(
+            scope.strip().strip('"') for scope in scopes.strip().strip("{}").split(",") if scope.strip()
+        )
+    return parsed
+
+
+class KanidmClient(abc.ABC):
+    """
+    Common session handling and reconciliation logic shared by the kanidm
+    backends. Backends implement the primitive get/create/update/delete calls,
+    use kanidm_operator.deploy.util.kanidm_client to get a connected client.
+    """
+
+    # Name of the backend in metrics
+    backend = "unknown"
+
+    def __init__(self, kanidm_name: str, namespace: str, logger: Logger, username: str = "idm_admin"):
+        self.logger = logger
+        self.kanidm_name = kanidm_name
+        self.namespace = namespace
+        self.username = username
+        self.session_key = (kanidm_name, namespace, username)
+        self.session: KanidmSession | None = None
+        self.kanidm_spec: dict | None = None
+        # Number of requests made to kanidm by this client
+        self.calls = 0
+        # Bounds the requests in flight against the instance, across clients
+        self.limiter = instance_limiter(namespace, kanidm_name)
+
+    async def connect(self, kanidm_index: kopf.Index, credentials_index: kopf.Index, tls_index: kopf.Index, silence_missing_kanidm: bool = False):
+        """Attach to the cached session for this kanidm instance, discovering and logging in as needed."""
+        with span("kanidm connect", **{"kanidm.name": self.kanidm_name, "k8s.namespace": self.namespace, "kanidm.backend": self.backend}):
+            await self._connect(kanidm_index, credentials_index, tls_index, silence_missing_kanidm)
+
+    async def _connect(self, kanidm_index: kopf.Index, credentials_index: kopf.Index, tls_index: kopf.Index, silence_missing_kanidm: bool):
+        self.kanidm_spec = find_kanidm(kanidm_index, self.namespace, self.kanidm_name)
+        if self.kanidm_spec is None:
+            sessions.evict(self.session_key)
+            if silence_missing_kanidm:
+                return
+            raise kopf.TemporaryError(f"No Kanidm configuration named {self.kanidm_name} found in the namespace {self.namespace}", delay=10)
+
+        self.limiter = instance_limiter(
+            self.namespace,
+            self.kanidm_name,
+            self.kanidm_spec["spec"].get("maxConcurrentOperations") or max_concurrent_operations,
+        )
+        endpoints = kanidm_endpoints(self.kanidm_spec, self.namespace, find_ca(tls_index, self.namespace))
+        password = find_password(credentials_index, self.namespace, self.username)
+        self.session = sessions.get(self.session_key)
+        # A session for a previous incarnation of the instance, or for rotated
+        # credentials the secret watch has not evicted yet, is no use
+        if (
+            self.session is None
+            or self.session.password != password
+            or any(getattr(self.session, key) != value for key, value in endpoints.items())
+        ):
+            self.session = KanidmSession(username=self.username, password=password, **endpoints)
+            sessions.put(self.session_key, self.session)
+
+        await self.ensure_logged_in()
+
+    async def ensure_logged_in(self):
+        async with self.session.lock:
+            if not self.session.valid:
+                await self._login()
+
+    async def login(self):
+        async with self.session.lock:
+            await self._login()
+
+    async def relogin(self, logged_in_at: float | None):
+        """Log in again after kanidm rejected the session established at logged_in_at."""
+        async with self.session.lock:
+            # Another handler may have already replaced the rejected session
+            if self.session.logged_in_at == logged_in_at:
+                self.logger.info(f"Kanidm session for {self.session.username} was rejected, logging in again")
+                await self._login()
+
+    async def _login(self):
+        self.session.invalidate()
+        try:
+            with span("kanidm login", **{"kanidm.backend": self.backend, "kanidm.username": self.username}):
+                await self._authenticate()
+        except kopf.TemporaryError:
+            kanidm_logins.labels(backend=self.backend, outcome="error").inc()
+            # The credentials may have been rotated, rediscover them next time
+            sessions.evict(self.session_key)
+            raise
+        kanidm_logins.labels(backend=self.backend, outcome="success").inc()
+        self.session.mark_logged_in()
+
+    @abc.abstractmethod
+    async def _authenticate(self):
+        ...
+
+    @abc.abstractmethod
+    async def list_users(self) -> list[dict]:
+        ...
+
+    @abc.abstractmethod
+    async def get_user(self, username: str) -> dict | None:
+        ...
+
+    @abc.abstractmethod
+    async def _create_user(self, username: str, displayname: str):
+        ...
+
+    @abc.abstractmethod
+    async def _update_user_displayname(self, username: str, displayname: str):
+        ...
+
+    @abc.abstractmethod
+    async def delete_user(self, username: str):
+        ...
+
+    @abc.abstractmethod
+    async def set_user_emails(self, username: str, emails: list[str]):
+        ...
+
+    @abc.abstractmethod
+    async def list_groups(self) -> list[dict]:
+        ...
+
+    @abc.abstractmethod
+    async def get_group(self, name: str) -> dict | None:
+        ...
+
+    @abc.abstractmethod
+    async def _create_group(self, name: str):
+        ...
+
+    @abc.abstractmethod
+    async def set_group_members(self, name: str, members: list[str]):
+        ...
+
+    @abc.abstractmethod
+    async def add_group_members(self, name: str, members: list[str]):
+        ...
+
+    @abc.abstractmethod
+    async def remove_group_members(self, name: str, members: list[str]):
+        ...
+
+    @abc.abstractmethod
+    async def delete_group(self, name: str):
+        ...
+
+    @abc.abstractmethod
+    async def list_oauth2clients(self) -> list[dict]:
+        ...
+
+    @abc.abstractmethod
+    async def get_oauth2client(self, name: str) -> dict | None:
+        ...
+
+    @abc.abstractmethod
+    async def _create_oauth2client(self, name: str, displayname: str, origin: str):
+        ...
+
+    @abc.abstractmethod
+    async def get_oauth2client_secret(self, name: str) -> str:
+        ...
+
+    @abc.abstractmethod
+    async def reset_oauth2client_secret(self, name: str):
+        ...
+
+    @abc.abstractmethod
+    async def set_oauth2client_prefer_short_username(self, name: str):
+        ...
+
+    @abc.abstractmethod
+    async def set_oauth2client_pkce(self, name: str, enabled: bool):
+        ...
+
+    @abc.abstractmethod
+    async def set_oauth2client_landing_url(self, name: str, url: str):
+        ...
+
+    @abc.abstractmethod
+    async def update_oauth2client_scope_map(self, name: str, group: str, scopes: list[str]):
+        ...
+
+    @abc.abstractmethod
+    async def delete_oauth2client(self, name: str):
+        ...
+
+    async def create_user(self, username: str, displayname: str):
+        await self.reconcile_user(username, displayname, None, await self.get_user(username))
+
+    async def reconcile_user(self, username: str, displayname: str, emails: list[str] | None, user: dict | None):
+        """Bring a user in line with the spec, given its current entry (None if missing)."""
+        if user == None:
+            await self._create_user(username, displayname)
+            # Success, we created the user!
+            current_emails = []
+        else:
+            self.logger.debug(f"User {username} already exists, not creating. {user}")
+
+            # Now we check if the already existing user needs a display name change
+            if displayname not in user['attrs'].get("displayname", []):
+                await self._update_user_displayname(username, displayname)
+                # Success, we updated the user displayname!
+            current_emails = user['attrs'].get("mail", [])
+
+        if emails is not None and set(emails) != set(current_emails):
+            await self.set_user_emails(username, emails)
+
+    async def create_group(self, name: str) -> dict:
+        """Create the group if it is missing, returning its current entry."""
+        return await self.ensure_group(name, await self.get_group(name))
+
+    async def ensure_group(self, name: str, group: dict | None) -> dict:
+        """Create the group if its current entry is None, returning the entry."""
+        if group == None:
+            await self._create_group(name)
+            # Success, we created the group!
+            return {"attrs": {}}
+
+        self.logger.debug(f"Group {name} already exists, not creating. {group}")
+        return group
+
+    async def reconcile_group(self, name: str, members: list[str], group: dict | None) -> bool:
+        """Bring a group in line with the spec, given its current entry (None if missing)."""
+        group = await self.ensure_group(name, group)
+        return await self.reconcile_group_members(name, members, group)
+
+    async def reconcile_group_members(self, name: str, members: list[str], group: dict | None = None) -> bool:
+        """
+        Make the members of a group match members, adding and removing only
+        the difference. Pass the group entry if it was already fetched.
+        Returns whether anything was written.
+        """
+        if group is None:
+            group = await self.get_group(name)
+            if group is None:
+                raise kopf.TemporaryError(f"Group {name} does not exist", delay=10)
+
+        # kanidm reports members by their spn (name@domain), the resources
+        # usually list plain names
+        current = {member_key(m): m for m in group["attrs"].get("member", [])}
+        desired = {member_key(m): m for m in members}
+        to_add = [desired[k] for k in sorted(desired.keys() - current.keys())]
+        to_remove = [current[k] for k in sorted(current.keys() - desired.keys())]
+        if not to_add and not to_remove:
+            self.logger.debug(f"Members of group {name} are already up to date")
+            return False
+
+        self.logger.info(f"Updating members of group {name}: adding {len(to_add)}, removing {len(to_remove)}")
+        for i in range(0, len(to_add), member_batch_size):
+            await self.add_group_members(name, to_add[i:i + member_batch_size])
+        for i in range(0, len(to_remove), member_batch_size):
+            await self.remove_group_members(name, to_remove[i:i + member_batch_size])
+        return True
+
+    async def create_oauth2client(self, name: str, displayname: str, origin: str) -> str:
+        await self.ensure_oauth2client(name, displayname, origin, await self.get_oauth2client(name))
+        return await self.get_oauth2client_secret(name)
+
+    async def ensure_oauth2client(self, name: str, displayname: str, origin: str, existing: dict | None) -> dict:
+        """Create the oauth2 client if its current entry is None, returning the entry."""
+        if existing == None:
+            await self._create_oauth2client(name, displayname, origin)
+            # Success, we created the oauth token
+            return {"attrs": {}}
+
+        self.logger.debug(f"OAuth2 client {name} already exists, not creating. {existing}")
+        return existing
+
+    async def update_oauth2client(
+        self,
+        name: str,
+        prefer_short_username: bool | None = None,
+        pkce: bool | None = None,
+        landing_url: str | None = None,
+    ):
+        """Change the given settings of an oauth2 client, leaving those that are None alone.
+        Backends that can should apply them together, in one call."""
+        if prefer_short_username:
+            await self.set_oauth2client_prefer_short_username(name)
+        if pkce is not None:
+            await self.set_oauth2client_pkce(name, pkce)
+        if landing_url is not None:
+            await self.set_oauth2client_landing_url(name, landing_url)
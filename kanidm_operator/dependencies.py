@@ -0,0 +1,142 @@
+"""
+Ordering between the users, groups and oauth2 clients of a kanidm instance.
+
+Groups need their members to exist in kanidm, and oauth2 clients the group
+of their scope map. Rather than failing and retrying on a timer, a handler
+waits for the resources it depends on to be created, and is woken as soon as
+the handler creating them is done.
+
+The graph is implicit: the dependencies of a resource are read from its
+spec, and whether each one is still to be created from the kopf indexes of
+the resources declaring them. Names no resource declares, e.g. kanidm's
+builtin groups, are never waited for.
+"""
+
+import asyncio
+import os
+import time
+from logging import Logger
+from typing import Iterable
+
+import kopf
+from prometheus_client import Histogram
+
+from kanidm_operator.client import member_key
+from kanidm_operator.metrics import duration_buckets
+
+# Longest a handler waits for the resources it depends on before going ahead,
+# and retrying as usual if they are still missing, in seconds
+dependency_wait = float(os.environ.get("KANIDM_DEPENDENCY_WAIT", "60"))
+
+# Kinds of kanidm entries, as used in keys below
+USER = "user"
+GROUP = "group"
+
+EntryKey = tuple[str, str, str, str]
+
+dependency_wait_duration = Histogram(
+    "kanidm_operator_dependency_wait_seconds",
+    "Time handlers waited for the users and groups they depend on to be created",
+    ("kind",),
+    buckets=duration_buckets,
+)
+
+# Entries known to exist in kanidm, by (namespace, kanidmName, kind, name)
+_created: set[EntryKey] = set()
+# Futures of the handlers waiting for an entry to be created
+_waiters: dict[EntryKey, list[asyncio.Future]] = {}
+
+
+def entry_key(namespace: str, kanidm_name: str, kind: str, name: str) -> EntryKey:
+    return (namespace, kanidm_name, kind, member_key(name))
+
+
+def mark_created(namespace: str, kanidm_name: str, kind: str, names: Iterable[str]):
+    """Record entries as existing in kanidm, waking whoever waits for them."""
+    for name in names:
+        key = entry_key(namespace, kanidm_name, kind, name)
+        _created.add(key)
+        for waiter in _waiters.pop(key, []):
+            if not waiter.done():
+                waiter.set_result(None)
+
+
+def mark_deleted(namespace: str, kanidm_name: str, kind: str, name: str):
+    _created.discard(entry_key(namespace, kanidm_name, kind, name))
+
+
+def pending(
+    namespace: str,
+    kanidm_name: str,
+    kind: str,
+    names: Iterable[str],
+    index: kopf.Index,
+) -> list[str]:
+    """Which of names are declared by a resource in index, but not created in kanidm yet."""
+    declared = {
+        member_key(resource["spec"]["name"]): resource
+        for resource in index.get((namespace, kanidm_name), [])
+    }
+    return [
+        name for name in names
+        if member_key(name) in declared
+        and not declared[member_key(name)].get("processed")
+        and entry_key(namespace, kanidm_name, kind, name) not in _created
+    ]
+
+
+async def wait_for_created(
+    namespace: str,
+    kanidm_name: str,
+    dependencies: dict[str, list[str]],
+    logger: Logger,
+    timeout: float = dependency_wait,
+) -> bool:
+    """Wait for the entries, by kind, to be created, returning whether they all were within timeout."""
+    loop = asyncio.get_running_loop()
+    waiters: dict[str, list[asyncio.Future]] = {}
+    keys = []
+    for kind, names in dependencies.items():
+        for name in names:
+            key = entry_key(namespace, kanidm_name, kind, name)
+            if key not in _created:
+                waiter = loop.create_future()
+                _waiters.setdefault(key, []).append(waiter)
+                waiters.setdefault(kind, []).append(waiter)
+                keys.append(key)
+    if not waiters:
+        return True
+
+    described = " and ".join(f"{len(futures)} {kind}s" for kind, futures in waiters.items())
+    logger.info(f"Waiting for {described} to be created first")
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(asyncio.gather(*(w for futures in waiters.values() for w in futures)), timeout)
+        return True
+    except asyncio.TimeoutError:
+        logger.warning(f"Still waiting for {described} after {timeout}s, going ahead anyway")
+        return False
+    finally:
+        dependency_wait_duration.labels(kind=",".join(waiters)).observe(time.perf_counter() - started)
+        # Drop what is left of the waiters for entries still missing
+        for key in keys:
+            remaining = [w for w in _waiters.get(key, []) if not w.done()]
+            if remaining:
+                _waiters[key] = remaining
+            else:
+                _waiters.pop(key, None)
+
+
+async def wait_for_members(
+    namespace: str,
+    kanidm_name: str,
+    members: list[str],
+    user_index: kopf.Index,
+    group_index: kopf.Index,
+    logger: Logger,
+) -> bool:
+    """Wait for the members of a group declared as users or groups to be created."""
+    return await wait_for_created(namespace, kanidm_name, {
+        USER: pending(namespace, kanidm_name, USER, members, user_index),
+        GROUP: pending(namespace, kanidm_name, GROUP, members, group_index),
+    }, logger)
@@ -0,0 +1,220 @@
+"""
+Bulk reconciliation of the users, groups and oauth2 clients of a kanidm instance.
+
+Rather than every resource fetching its own entry from kanidm, each kind is
+listed once per instance and diffed against the resources in the kopf
+indexes. Only the resulting writes are issued, through a bounded pool of
+concurrent workers.
+
+Drift detection goes one step further and compares a fingerprint of the
+state each resource asks for with the one of its listed entry, only
+reconciling the resources whose fingerprints differ.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import time
+from logging import Logger
+from typing import Awaitable, Callable
+
+import kopf
+
+from kanidm_operator.client import KanidmClient, first, member_key, parse_scope_maps
+from kanidm_operator.dependencies import GROUP, USER, mark_created
+from kanidm_operator.metrics import instrumented
+from kanidm_operator.typing.kanidm import KanidmResource
+from .oauth2client import reconcile_oauth2client, written_fingerprint
+from .util import kanidm_client
+
+# Set to "false" to leave resources to their individual handlers on startup
+bulk_reconcile = os.environ.get("KANIDM_BULK_RECONCILE", "true").lower() == "true"
+# Maximum number of resources reconciled at once per kanidm instance
+bulk_concurrency = int(os.environ.get("KANIDM_BULK_CONCURRENCY", "8"))
+
+
+def entries_by_name(entries: list[dict], *name_attrs: str) -> dict[str, dict]:
+    """Map listed kanidm entries by the first of the name attributes they carry."""
+    by_name = {}
+    for entry in entries:
+        attrs = entry.get("attrs", {})
+        for attr in name_attrs:
+            if attrs.get(attr):
+                by_name[attrs[attr][0]] = entry
+                break
+    return by_name
+
+
+def fingerprint(state: dict) -> str:
+    return hashlib.sha256(json.dumps(state, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def user_state(spec: dict, entry: dict | None = None) -> dict | None:
+    """The state of a user the operator manages, as asked for by spec or, given one, as in its kanidm entry."""
+    if entry is None:
+        return {"displayname": spec["displayName"], "emails": sorted(set(spec.get("emails") or []))}
+    attrs = entry.get("attrs", {})
+    return {
+        # Any of the user's displaynames will do, as in reconcile_user
+        "displayname": spec["displayName"] if spec["displayName"] in attrs.get("displayname", []) else first(attrs, "displayname"),
+        "emails": sorted(set(attrs.get("mail", []))),
+    }
+
+
+def group_state(spec: dict, entry: dict | None = None) -> dict:
+    members = spec["members"] if entry is None else entry.get("attrs", {}).get("member", [])
+    return {"members": sorted({member_key(m) for m in members})}
+
+
+def oauth2client_state(spec: dict, entry: dict | None = None) -> dict:
+    """Only covers what reconcile_oauth2client sets, so settings it leaves alone are never seen as drift.
+    The display name and origin are only set on creation."""
+    attrs = None if entry is None else entry.get("attrs", {})
+    if attrs is None:
+        state = {"pkce": spec.get("enable-pkce", True)}
+    else:
+        state = {"pkce": attrs.get("oauth2_allow_insecure_client_disable_pkce") != ["true"]}
+    if spec.get("prefer-short-username"):
+        state["prefer_short_username"] = True if attrs is None else attrs.get("oauth2_prefer_short_username") == ["true"]
+    if "callback-url" in spec:
+        state["landing_url"] = spec["callback-url"] if attrs is None else first(attrs, "oauth2_rs_origin_landing")
+    if "scope-map" in spec:
+        group = member_key(spec["scope-map"].get("group", ""))
+        if attrs is None:
+            state["scopes"] = sorted(spec["scope-map"].get("scopes") or [])
+        else:
+            state["scopes"] = parse_scope_maps(attrs.get("oauth2_rs_scope_map", [])).get(group)
+    return state
+
+
+def drifted(state: Callable[..., dict], spec: dict, entry: dict | None) -> bool:
+    """Whether a resource's kanidm entry is missing or its fingerprint differs from the resource's."""
+    return entry is None or fingerprint(state(spec)) != fingerprint(state(spec, entry))
+
+
+async def run_bounded(
+    work: list[tuple[str, Callable[[], Awaitable]]],
+    concurrency: int,
+    logger: Logger,
+) -> int:
+    """Run the named work items, at most concurrency at a time, returning the number of failures."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def worker(name: str, item: Callable[[], Awaitable]) -> bool:
+        async with semaphore:
+            try:
+                await item()
+                return True
+            except (kopf.TemporaryError, kopf.PermanentError) as e:
+                logger.warning(f"Bulk reconcile of {name} failed, leaving it to its handler ({e})")
+                return False
+
+    results = await asyncio.gather(*(worker(name, item) for name, item in work))
+    return results.count(False)
+
+
+async def bulk_reconcile_instance(
+    cli_client: KanidmClient,
+    namespace: str,
+    logger: Logger,
+    users: list[dict],
+    groups: list[dict],
+    oauth2clients: list[dict],
+    concurrency: int = bulk_concurrency,
+    only_drifted: bool = False,
+) -> int:
+    """Reconcile the given indexed resources against one kanidm instance, returning the number of failures.
+
+    With only_drifted, resources whose entries match their fingerprint are left alone.
+    """
+    # Nothing written below changes the listings, so take them all at once
+    user_entries, group_entries, oauth2client_entries = await asyncio.gather(
+        cli_client.list_users(), cli_client.list_groups(), cli_client.list_oauth2clients(),
+    )
+    existing_users = entries_by_name(user_entries, "name")
+    existing_groups = entries_by_name(group_entries, "name")
+    existing_oauth2clients = entries_by_name(oauth2client_entries, "oauth2_rs_name", "name")
+    group_names = set(existing_groups) | {r["spec"]["name"] for r in groups}
+    # Handlers running alongside need not wait for what already exists
+    mark_created(namespace, cli_client.kanidm_name, USER, existing_users)
+    mark_created(namespace, cli_client.kanidm_name, GROUP, existing_groups)
+
+    if only_drifted:
+        users = [r for r in users if drifted(user_state, r["spec"], existing_users.get(r["spec"]["name"]))]
+        groups = [r for r in groups if drifted(group_state, r["spec"], existing_groups.get(r["spec"]["name"]))]
+        # A deleted or edited kubernetes Secret is drift too
+        written = await asyncio.gather(*(written_fingerprint(namespace, r["spec"]["name"]) for r in oauth2clients))
+        oauth2clients = [
+            r for r, fingerprint in zip(oauth2clients, written)
+            if drifted(oauth2client_state, r["spec"], existing_oauth2clients.get(r["spec"]["name"]))
+            or (r.get("fingerprint") is not None and fingerprint != r["fingerprint"])
+        ]
+        if users or groups or oauth2clients:
+            logger.info(f"Correcting drift of {len(users)} users, {len(groups)} groups and {len(oauth2clients)} oauth2 clients")
+
+    async def reconcile_user(spec: dict):
+        await cli_client.reconcile_user(spec["name"], spec["displayName"], spec.get("emails") or [], existing_users.get(spec["name"]))
+        mark_created(namespace, cli_client.kanidm_name, USER, [spec["name"]])
+
+    async def ensure_group(spec: dict):
+        existing_groups[spec["name"]] = await cli_client.ensure_group(spec["name"], existing_groups.get(spec["name"]))
+        mark_created(namespace, cli_client.kanidm_name, GROUP, [spec["name"]])
+
+    # In dependency order: users, then groups, then the members of groups,
+    # which can be users or groups, then oauth2 clients, as their scope maps
+    # reference groups
+    failures = await run_bounded([(f"user {r['spec']['name']}", lambda spec=r["spec"]: reconcile_user(spec)) for r in users], concurrency, logger)
+
+    failures += await run_bounded([
+        (f"group {r['spec']['name']}", lambda spec=r["spec"]: ensure_group(spec))
+        for r in groups if r["spec"]["name"] not in existing_groups
+    ], concurrency, logger)
+    failures += await run_bounded([
+        (f"group {r['spec']['name']}", lambda spec=r["spec"]: cli_client.reconcile_group_members(
+            spec["name"], spec["members"], existing_groups.get(spec["name"]),
+        ))
+        for r in groups if r["spec"]["name"] in existing_groups
+    ], concurrency, logger)
+
+    failures += await run_bounded([
+        (f"oauth2 client {r['spec']['name']}", lambda spec=r["spec"], owner=r.get("owner"), fingerprint=r.get("fingerprint"): reconcile_oauth2client(
+            cli_client, spec, namespace, logger, existing_oauth2clients.get(spec["name"]), group_names, owner, fingerprint,
+        ))
+        for r in oauth2clients
+    ], concurrency, logger)
+
+    return failures
+
+
+@kopf.on.resume("kanidm.github.io", "v1alpha1", "kanidms")
+@instrumented
+async def on_resume_kanidms(
+    spec: KanidmResource,
+    name: str,
+    namespace: str,
+    logger: Logger,
+    kanidm_index: kopf.Index,
+    credentials_index: kopf.Index,
+    tls_index: kopf.Index,
+    user_index: kopf.Index,
+    group_index: kopf.Index,
+    oauth2client_index: kopf.Index,
+    **kwargs,
+):
+    if not bulk_reconcile:
+        return
+
+    users = list(user_index.get((namespace, name), []))
+    groups = list(group_index.get((namespace, name), []))
+    oauth2clients = list(oauth2client_index.get((namespace, name), []))
+    if not users and not groups and not oauth2clients:
+        return
+
+    started = time.monotonic()
+    cli_client = await kanidm_client(name, namespace, logger, kanidm_index, credentials_index, tls_index)
+    failures = await bulk_reconcile_instance(cli_client, namespace, logger, users, groups, oauth2clients)
+    logger.info(
+        f"Bulk reconciled {len(users)} users, {len(groups)} groups and {len(oauth2clients)} oauth2 clients "
+        f"in {time.monotonic() - started:.2f}s with {cli_client.calls} kanidm operations ({failures} failed)"
+    )
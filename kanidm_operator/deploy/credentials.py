@@ -0,0 +1,58 @@
+"""
+Watches the credential secrets written by the operator (usersecret.yaml), so
+handlers resolve passwords locally and cached sessions are dropped as soon as
+their secret is rotated or removed.
+"""
+
+from base64 import b64decode
+from logging import Logger
+
+import kopf
+
+from kanidm_operator.deployer import slugify
+from kanidm_operator.metrics import instrumented
+from kanidm_operator.sessions import sessions
+
+CREDENTIALS_LABEL = "kanidm.github.io/credentials-for"
+
+
+def decode_password(data: dict[str, str] | None) -> str | None:
+    if not data or "password" not in data:
+        return None
+    return b64decode(data["password"].encode("utf-8")).decode("utf-8")
+
+
+@kopf.index("", "v1", "secrets", labels={CREDENTIALS_LABEL: kopf.PRESENT})
+async def credentials_index(
+    name: str,
+    namespace: str,
+    labels: dict[str, str],
+    body: dict,
+    **kwargs,
+):
+    """Index of the kanidm credential secrets by (namespace, slugified username)."""
+    return {(namespace, labels[CREDENTIALS_LABEL]): {
+        "name": name,
+        "password": decode_password(body.get("data")),
+    }}
+
+
+@kopf.on.event("", "v1", "secrets", labels={CREDENTIALS_LABEL: kopf.PRESENT})
+@instrumented
+async def on_credentials_event(
+    type: str,
+    namespace: str,
+    labels: dict[str, str],
+    body: dict,
+    logger: Logger,
+    **kwargs,
+):
+    password = None if type == "DELETED" else decode_password(body.get("data"))
+    evicted = sessions.evict_where(
+        lambda key, session: key[1] == namespace
+        and slugify(key[2]) == labels[CREDENTIALS_LABEL]
+        and session.password != password
+    )
+    if evicted:
+        logger.info(f"Credentials for {labels[CREDENTIALS_LABEL]} changed, dropped {evicted} cached kanidm session(s)")
+
@@ -0,0 +1,99 @@
+"""
+Periodic drift detection, correcting changes made to a kanidm instance behind
+the operator's back: a member removed in the kanidm UI, a workload edited or
+deleted with kubectl, and so on.
+
+One timer per kanidm instance checks everything that belongs to it, so the
+cost of a check is three listings and a read of each workload rather than a
+timer and lookups per resource. Writes are only made for what drifted.
+"""
+
+import asyncio
+import json
+import os
+import random
+from logging import Logger
+
+import kopf
+from kubernetes import client
+from prometheus_client import Counter
+
+from kanidm_operator.deployer import deployer
+from kanidm_operator.metrics import instrumented
+from kanidm_operator.typing.kanidm import KanidmResource
+from .bulk import bulk_reconcile_instance
+from .kanidm import (
+    REPLICATION_CERTIFICATES_ANNOTATION,
+    collect_replication_certificates,
+    prepare_instance,
+)
+from .util import kanidm_client
+
+# Set to "false" to never check instances for drift
+drift_detection = os.environ.get("KANIDM_DRIFT_DETECTION", "true").lower() == "true"
+# Seconds between checks of each instance
+drift_interval = float(os.environ.get("KANIDM_DRIFT_INTERVAL", "600"))
+# Up to how many seconds each check is delayed by at random, so instances
+# created or resumed together don't all check at the same moment
+drift_jitter = float(os.environ.get("KANIDM_DRIFT_JITTER", "60"))
+
+drift_corrections = Counter("kanidm_operator_drift_corrections_total", "Kubernetes resources re-applied after drifting from their render", ("kind",))
+
+
+async def correct_workload_drift(
+    spec: KanidmResource,
+    name: str,
+    namespace: str,
+    logger: Logger,
+    certificates: dict[str, str],
+) -> int:
+    """Re-apply the resources of an instance that are missing or were changed, returning how many."""
+    resources = [resource for group in prepare_instance(spec, name, namespace, certificates) for resource in group]
+    checks = await asyncio.gather(*(deployer.drifted(resource, namespace) for resource in resources))
+    drifted = [resource for resource, drift in zip(resources, checks) if drift]
+    for resource in drifted:
+        logger.warning(f"{resource['kind']} {resource['metadata']['name']} drifted from its spec, applying it again")
+        drift_corrections.labels(kind=resource["kind"]).inc()
+    # Forced, as the render cache can't tell a deleted or edited resource from an unchanged one
+    await deployer.apply_all(namespace, logger, *(resource for resource in drifted if resource["kind"] in ("ConfigMap", "PersistentVolumeClaim")), force=True)
+    await deployer.apply_all(namespace, logger, *(resource for resource in drifted if resource["kind"] not in ("ConfigMap", "PersistentVolumeClaim")), force=True)
+    return len(drifted)
+
+
+@kopf.timer("kanidm.github.io", "v1alpha1", "kanidms", interval=drift_interval, initial_delay=drift_interval)
+@instrumented
+async def check_kanidm_drift(
+    spec: KanidmResource,
+    name: str,
+    namespace: str,
+    logger: Logger,
+    patch: dict,
+    annotations: dict[str, str],
+    kanidm_index: kopf.Index,
+    credentials_index: kopf.Index,
+    tls_index: kopf.Index,
+    kanidm_pod_index: kopf.Index,
+    user_index: kopf.Index,
+    group_index: kopf.Index,
+    oauth2client_index: kopf.Index,
+    **kwargs,
+):
+    # Until created, the instance belongs to on_create_kanidms
+    if not drift_detection or annotations.get("kanidm.github.io/processed") != "true":
+        return
+    await asyncio.sleep(random.uniform(0, drift_jitter))
+
+    certificates = json.loads(annotations.get(REPLICATION_CERTIFICATES_ANNOTATION, "{}"))
+    await correct_workload_drift(spec, name, namespace, logger, certificates)
+    if spec["highAvailability"]["enabled"]:
+        # Replicas added since creation, on_update_kanidms pins their certificates
+        collected = await collect_replication_certificates(client.CoreV1Api(), spec, name, namespace, kanidm_pod_index, certificates)
+        if collected != certificates:
+            patch.setdefault("metadata", {}).setdefault("annotations", {})[REPLICATION_CERTIFICATES_ANNOTATION] = json.dumps(collected)
+
+    users = list(user_index.get((namespace, name), []))
+    groups = list(group_index.get((namespace, name), []))
+    oauth2clients = list(oauth2client_index.get((namespace, name), []))
+    if users or groups or oauth2clients:
+        cli_client = await kanidm_client(name, namespace, logger, kanidm_index, credentials_index, tls_index)
+        await bulk_reconcile_instance(cli_client, namespace, logger, users, groups, oauth2clients, only_drifted=True)
@@ -1,23 +1,51 @@
+import copy
 from logging import Logger
 
 import kopf
 
+from kanidm_operator.dependencies import GROUP, mark_created, mark_deleted, wait_for_members
+from kanidm_operator.metrics import instrumented
 from kanidm_operator.typing.group import GroupResource
-from .util import KanidmCLIClient
+from .util import kanidm_client
+
+
+@kopf.index("kanidm.github.io", "v1alpha1", "groups")
+async def group_index(
+    spec: GroupResource,
+    name: str,
+    namespace: str,
+    annotations: dict[str, str],
+    **kwargs,
+):
+    """Index of the group resources by (namespace, kanidmName), for bulk reconciliation and ordering."""
+    return {(namespace, spec["kanidmName"]): {
+        "name": name,
+        "spec": copy.deepcopy(dict(spec)),
+        "processed": annotations.get("kanidm.github.io/processed") == "true",
+    }}
 
 
 @kopf.on.create("kanidm.github.io", "v1alpha1", "groups")
+@instrumented
 async def on_create_group(
     spec: GroupResource,
     patch: dict,
     namespace: str,
     logger: Logger,
+    kanidm_index: kopf.Index,
+    credentials_index: kopf.Index,
+    tls_index: kopf.Index,
+    user_index: kopf.Index,
+    group_index: kopf.Index,
     **kwargs,
 ):
     logger.info(f"Trying to create group {spec['name']} to kanidm in the namespace {namespace}")
-    cli_client = KanidmCLIClient(spec["kanidmName"], namespace, logger)
-    cli_client.create_group(spec['name'])
-    cli_client.set_group_members(spec['name'], spec['members'])
+    cli_client = await kanidm_client(spec["kanidmName"], namespace, logger, kanidm_index, credentials_index, tls_index)
+    # Create the group before waiting on its members, so groups nesting each other can't wait on one another
+    group = await cli_client.ensure_group(spec['name'], await cli_client.get_group(spec['name']))
+    mark_created(namespace, spec["kanidmName"], GROUP, [spec['name']])
+    await wait_for_members(namespace, spec["kanidmName"], spec['members'], user_index, group_index, logger)
+    await cli_client.reconcile_group_members(spec['name'], spec['members'], group)
 
     patch.setdefault("metadata", {}).setdefault("annotations", {})["kanidm.github.io/processed"] = "true"
 
@@ -28,23 +56,35 @@ async def on_create_group(
 
 
 @kopf.on.field("kanidm.github.io", "v1alpha1", "groups", field="spec.members")
+@instrumented
 async def on_update_group_members(
     spec: GroupResource,
     namespace: str,
     logger: Logger,
+    kanidm_index: kopf.Index,
+    credentials_index: kopf.Index,
+    tls_index: kopf.Index,
+    user_index: kopf.Index,
+    group_index: kopf.Index,
     patch: dict,
     **kwargs,
 ):
-    cli_client = KanidmCLIClient(spec["kanidmName"], namespace, logger)
-    cli_client.set_group_members(spec['name'], spec['members'])
+    cli_client = await kanidm_client(spec["kanidmName"], namespace, logger, kanidm_index, credentials_index, tls_index)
+    await wait_for_members(namespace, spec["kanidmName"], spec['members'], user_index, group_index, logger)
+    await cli_client.reconcile_group_members(spec['name'], spec['members'])
 
 @kopf.on.delete("kanidm.github.io", "v1alpha1", "groups")
+@instrumented
 async def on_delete_group(
     spec: GroupResource,
     namespace: str,
     logger: Logger,
+    kanidm_index: kopf.Index,
+    credentials_index: kopf.Index,
+    tls_index: kopf.Index,
     **kwargs,
 ):
-    cli_client = KanidmCLIClient(spec["kanidmName"], namespace, logger, silence_missing_kanidm=True)
+    cli_client = await kanidm_client(spec["kanidmName"], namespace, logger, kanidm_index, credentials_index, tls_index, silence_missing_kanidm=True)
     if cli_client.kanidm_spec is not None:
-        cli_client.delete_group(spec['name'])
+        await cli_client.delete_group(spec['name'])
+    mark_deleted(namespace, spec["kanidmName"], GROUP, spec['name'])
@@ -5,160 +5,469 @@ Will read the kanidms.kanidm.github.io CRD to deploy either:
   - In Single Instance mode : 1 kanidm instance with UI as a deployment
 """
 
+import asyncio
+import copy
+import os
 import re
 import json
 from logging import Logger
-import time
 
 from kubernetes import client
-from kubernetes.client.models.v1_pod import V1Pod
-from kubernetes.client.models.v1_pod_status import V1PodStatus
 import kopf
 
-from kanidm_operator.deployer import Deployer
+from kanidm_operator.deployer import deployer, render_hash
+from kanidm_operator.metrics import instrumented
 from kanidm_operator.typing.kanidm import KanidmResource
 from kubernetes.stream import stream
 
-@kopf.on.create("kanidm.github.io", "v1alpha1", "kanidms")
-async def on_create_kanidms(
+@kopf.index("kanidm.github.io", "v1alpha1", "kanidms")
+async def kanidm_index(
     spec: KanidmResource,
     name: str,
     namespace: str,
-    logger: Logger,
-    patch: dict,
+    uid: str,
     **kwargs,
 ):
-    logger.info(f"Creating kanidm instance {name} in namespace {namespace}")
-    deployer = Deployer(namespace, spec["version"], logger)
+    """Index of the kanidm instances by (namespace, name), so handlers can find them without listing."""
+    return {(namespace, name): {
+        "metadata": {"name": name, "namespace": namespace, "uid": uid},
+        "spec": copy.deepcopy(dict(spec)),
+    }}
+
+# Port kanidm servers replicate with each other on, in high availability mode
+REPLICATION_PORT = 8444
+# Label on the kanidm server pods naming the instance they belong to
+INSTANCE_LABEL = "kanidm.github.io/instance"
+# Replication certificates collected so far, as JSON by origin
+REPLICATION_CERTIFICATES_ANNOTATION = "kanidm.github.io/replication-certificates"
+# Resources only deployed in high availability mode, as (apiVersion, kind, name)
+HIGH_AVAILABILITY_RESOURCES = [
+    ("apps/v1", "StatefulSet", "kanidm-replica"),
+    ("v1", "ConfigMap", "kanidm-replica-config"),
+    ("v1", "Service", "kanidm-repl"),
+    ("v1", "Service", "kanidm-replica"),
+    ("v1", "Service", "kanidm-read-svc"),
+]
+
+# Seconds a new instance has to become ready and hand over its credentials
+boot_timeout = float(os.environ.get("KANIDM_BOOT_TIMEOUT", "900"))
+# Longest wait between checks on a booting instance, in seconds
+boot_backoff_max = float(os.environ.get("KANIDM_BOOT_BACKOFF_MAX", "30"))
+
+
+def writer_origin(namespace: str) -> str:
+    return f"repl://kanidm-repl.{namespace}.svc.cluster.local:{REPLICATION_PORT}"
+
+
+def replica_origin(namespace: str, index: int) -> str:
+    return f"repl://kanidm-replica-{index}.kanidm-replica.{namespace}.svc.cluster.local:{REPLICATION_PORT}"
+
+
+def replication_topology(
+    namespace: str,
+    replicas: int,
+    certificates: dict[str, str],
+) -> tuple[dict, list[dict]]:
+    """Replication settings of the write replica and of each read replica.
+
+    The read replicas pull from the write replica, which allows them to. Each
+    side pins the other's replication certificate, so partners are only
+    configured once their certificate (by origin) is known.
+    """
+    writer = {"origin": writer_origin(namespace), "partners": []}
+    readers = []
+    for index in range(replicas):
+        origin = replica_origin(namespace, index)
+        if origin in certificates:
+            writer["partners"].append({
+                "origin": origin,
+                "type": "allow-pull",
+                "cert_key": "consumer_cert",
+                "cert": certificates[origin],
+            })
+        partners = []
+        if writer["origin"] in certificates:
+            partners.append({
+                "origin": writer["origin"],
+                "type": "pull",
+                "cert_key": "supplier_cert",
+                "cert": certificates[writer["origin"]],
+                # A new read replica initialises itself from the write replica
+                "automatic_refresh": True,
+            })
+        readers.append({"pod": f"kanidm-replica-{index}", "origin": origin, "partners": partners})
+    return writer, readers
+
+
+def prepare_workloads(
+    spec: KanidmResource,
+    name: str,
+    namespace: str,
+    certificates: dict[str, str] | None = None,
+) -> tuple[list[dict], list[dict]]:
+    """Render the server configs and the workloads running kanidm from them."""
+    version = spec["version"]
+    server_variables = dict(
+        domain=spec["domain"],
+        log_level=spec.get("logLevel", "info"),
+        ldap_port=spec.get("ldapPort", "3890"),
+        http_port=spec.get("webPort", "8443"),
+        db_fs_type=spec["database"]["fsType"],
+        db_arc_size=spec["database"]["arcSize"],
+        trust_x_forwarded_for=spec["ingress"]["trustXForwardedFor"],
+    )
+    workload_variables = dict(
+        instance=name,
+        http_port=spec.get("webPort", "8443"),
+        ldap_port=spec.get("ldapPort", "3890"),
+        image=f"kanidm/server:{spec['version']}",
+    )
+    high_availability = spec["highAvailability"]["enabled"]
+    writer, readers = None, []
+    if high_availability:
+        writer, readers = replication_topology(namespace, spec["highAvailability"]["replicas"], certificates or {})
+
+    server_config = deployer.prepare(
+        "server.toml",
+        namespace,
+        version,
+        backup_enabled=spec["backup"]["enabled"],
+        backup_schedule=spec["backup"]["schedule"],
+        backup_versions=spec["backup"]["versions"],
+        role="WriteReplica",
+        replication=writer,
+        replication_port=REPLICATION_PORT,
+        **server_variables,
+    )
+    configs = [server_config]
+    workloads = [deployer.prepare(
+        "deployment.yaml",
+        namespace,
+        version,
+        config_hash=render_hash(server_config["data"]),
+        replication_port=REPLICATION_PORT if high_availability else None,
+        **workload_variables,
+    )]
+
+    if high_availability:
+        replica_config = deployer.prepare(
+            "replica-config.yaml",
+            namespace,
+            version,
+            backup_enabled=False,
+            role="ReadOnlyReplica",
+            replicas=readers,
+            replication_port=REPLICATION_PORT,
+            **server_variables,
+        )
+        configs.append(replica_config)
+        workloads.append(deployer.prepare(
+            "statefulset-replicas.yaml",
+            namespace,
+            version,
+            replicas=spec["highAvailability"]["replicas"],
+            config_hash=render_hash(replica_config["data"]),
+            replication_port=REPLICATION_PORT,
+            db_storage_class=spec["database"]["storageClass"],
+            db_storage_size=spec["database"]["storageSize"],
+            **workload_variables,
+        ))
+    return configs, workloads
+
+
+# Printed before each account's output when recovering accounts
+RECOVERY_MARKER = "--- kanidm-operator recover-account"
+
+
+def parse_recovered_passwords(output: str) -> dict[str, str]:
+    """Passwords by account from the output of recover_accounts.
+
+    kanidmd mixes its logs, which may themselves be JSON, into the output, so
+    every JSON object in each account's section is decoded and the one with
+    a password kept.
+    """
+    decoder = json.JSONDecoder()
+    passwords = {}
+    for section in output.split(RECOVERY_MARKER)[1:]:
+        account, _, text = section.partition("\n")
+        position = text.find("{")
+        while position != -1:
+            try:
+                value, end = decoder.raw_decode(text, position)
+            except json.JSONDecodeError:
+                position = text.find("{", position + 1)
+                continue
+            if isinstance(value, dict) and "password" in value:
+                passwords[account.strip()] = value["password"]
+                break
+            position = text.find("{", end)
+    return passwords
+
+
+async def recover_accounts(core: client.CoreV1Api, pod_name: str, namespace: str, accounts: list[str]) -> dict[str, str]:
+    """Reset the passwords of the accounts in one exec session, returning them by account."""
+    script = "; ".join(
+        f"echo '{RECOVERY_MARKER} {account}'; kanidmd recover-account -o json {account}"
+        for account in accounts
+    )
+    resp = await asyncio.to_thread(stream, core.connect_get_namespaced_pod_exec,
+            pod_name,
+            namespace,
+            container="kanidm",
+            command=["sh", "-c", script],
+            stderr=False, stdin=False, stdout=True, tty=False,
+    )
+    return parse_recovered_passwords(resp)
+
+
+async def replication_certificate(core: client.CoreV1Api, pod_name: str, namespace: str) -> str | None:
+    resp = await asyncio.to_thread(stream, core.connect_get_namespaced_pod_exec,
+            pod_name,
+            namespace,
+            container="kanidm",
+            command=["kanidmd", "show-replication-certificate"],
+            stderr=True, stdin=False, stdout=True, tty=False,
+    )
+    # As with recover-account, the certificate is mixed in with kanidmd's logs
+    match = re.search(r"certificate:\s*\"?([A-Za-z0-9+/=_-]{16,})\"?", resp)
+    return None if match is None else match.group(1)
+
+
+async def collect_replication_certificates(
+    core: client.CoreV1Api,
+    spec: KanidmResource,
+    name: str,
+    namespace: str,
+    kanidm_pod_index: kopf.Index,
+    certificates: dict[str, str],
+) -> dict[str, str]:
+    """Collect the replication certificates of every ready kanidm server not already in certificates.
+
+    kanidm generates these certificates on first start, so they can only be
+    collected once the servers are running.
+    """
+    writers = ready_pods(kanidm_pod_index, namespace, name, "kanidm")
+    replicas = set(ready_pods(kanidm_pod_index, namespace, name, "kanidm-replica"))
+    pods = {writer_origin(namespace): writers[0] if writers else None}
+    for index in range(spec["highAvailability"]["replicas"]):
+        pod_name = f"kanidm-replica-{index}"
+        pods[replica_origin(namespace, index)] = pod_name if pod_name in replicas else None
+
+    certificates = dict(certificates)
+    for origin, pod_name in pods.items():
+        if origin in certificates or pod_name is None:
+            continue
+        certificate = await replication_certificate(core, pod_name, namespace)
+        if certificate is not None:
+            certificates[origin] = certificate
+    return certificates
+
+
+@kopf.index("", "v1", "pods", labels={INSTANCE_LABEL: kopf.PRESENT})
+async def kanidm_pod_index(
+    name: str,
+    namespace: str,
+    labels: dict[str, str],
+    status: dict,
+    **kwargs,
+):
+    """Index of the kanidm server pods by (namespace, kanidm name), kept current by the pod watch."""
+    ready = any(
+        condition.get("type") == "Ready" and condition.get("status") == "True"
+        for condition in status.get("conditions") or []
+    )
+    return {(namespace, labels[INSTANCE_LABEL]): {
+        "name": name,
+        "component": labels.get("app.kubernetes.io/name"),
+        "ready": ready,
+    }}
+
+
+def ready_pods(kanidm_pod_index: kopf.Index, namespace: str, name: str, component: str) -> list[str]:
+    """Names of the ready pods of one component (kanidm or kanidm-replica) of a kanidm instance."""
+    return sorted(
+        pod["name"]
+        for pod in kanidm_pod_index.get((namespace, name), [])
+        if pod["component"] == component and pod["ready"]
+    )
+
+
+def boot_delay(retry: int) -> float:
+    """Exponential backoff while waiting on kanidm to boot."""
+    return min(2.0 ** retry, boot_backoff_max)
+
 
-    deployer.deploy(
+def prepare_instance(
+    spec: KanidmResource,
+    name: str,
+    namespace: str,
+    certificates: dict[str, str],
+) -> tuple[list[dict], list[dict], list[dict], list[dict]]:
+    """Render every resource of an instance, as (independent resources, volumes, configs, workloads)."""
+    version = spec["version"]
+    certificate = deployer.prepare(
         "certificate.yaml",
+        namespace,
+        version,
         hostname=spec["domain"],
         certificate_issuer=spec["certificate"]["issuer"],
-        version=spec["version"],
     )
-    deployer.deploy(
+    pvc_backups = deployer.prepare(
         "pvc-backups.yaml",
+        namespace,
+        version,
         backup_storage_class=spec["backup"]["storageClass"],
         backup_storage_size=spec["backup"]["storageSize"],
     )
-    deployer.deploy(
+    pvc_db = deployer.prepare(
         "pvc-db.yaml",
+        namespace,
+        version,
         db_storage_class=spec["database"]["storageClass"],
         db_storage_size=spec["database"]["storageSize"],
     )
-    deployer.deploy(
+    service = deployer.prepare(
         "service.yaml",
+        namespace,
+        version,
         http_port=spec["webPort"],
         ldap_port=spec["ldapPort"],
     )
-    deployer.deploy(
-        "server.toml",
-        domain=spec["domain"],
-        log_level=spec.get("logLevel", "info"),
-        ldap_port=spec.get("ldapPort", "3890"),
-        http_port=spec.get("webPort", "8443"),
-        database_fs_type=spec["database"]["fsType"],
-        database_arc_size=spec["database"]["arcSize"],
-        backup_enabled=spec["backup"]["enabled"],
-        backup_schedule=spec["backup"]["schedule"],
-        backup_versions=spec["backup"]["versions"],
-        trust_x_forwarded_for=spec["ingress"]["trustXForwardedFor"],
-        role="WriteReplica",
-    )
-
-    if not spec["highAvailability"]["enabled"]:
-        deployer.deploy(
-            "deployment.yaml",
-            http_port=spec.get("webPort", "8443"),
-            ldap_port=spec.get("ldapPort", "3890"),
-            image=f"kanidm/server:{spec['version']}",
-        )
-    # TODO: Handle HighAvailability mode
+    configs, workloads = prepare_workloads(spec, name, namespace, certificates)
 
+    independent = [certificate, service]
+    if spec["highAvailability"]["enabled"]:
+        independent += [
+            deployer.prepare(
+                "service-replication.yaml",
+                namespace,
+                version,
+                service_name=service_name,
+                pod_name=pod_name,
+                replication_port=REPLICATION_PORT,
+            )
+            for service_name, pod_name in [("kanidm-repl", "kanidm"), ("kanidm-replica", "kanidm-replica")]
+        ]
+        independent.append(deployer.prepare(
+            "service-read.yaml",
+            namespace,
+            version,
+            http_port=spec["webPort"],
+            ldap_port=spec["ldapPort"],
+        ))
     if spec.get("ingress").get("enabled", False):
-        deployer.deploy(
+        independent.append(deployer.prepare(
             "ingress.yaml",
+            namespace,
+            version,
             hostname=spec["domain"],
             http_port=spec["webPort"],
             annotations={} if "annotations" not in spec["ingress"] else spec["ingress"]["annotations"],
-        )
+        ))
+    return independent, [pvc_backups, pvc_db], configs, workloads
 
-    logger.info(f"All k8s resources for kanidm {name} have been deployed, waiting for pod to be ready")
-    done = False
-    core = client.CoreV1Api()
-    while not done:
-        pods: list[V1Pod] = core.list_namespaced_pod(
-            namespace,
-            label_selector="app.kubernetes.io/name=kanidm",
-        ).items
-        
-        if len(pods) == 0:
-            logger.info(f"Waiting for kanidm {name} pod to be created")
-            time.sleep(5)
-            continue
 
-        pod = pods[0]
-        status: V1PodStatus = pod.status
+async def rollout_instance(
+    namespace: str,
+    logger: Logger,
+    independent: list[dict],
+    volumes: list[dict],
+    configs: list[dict],
+    workloads: list[dict],
+):
+    async def rollout_workloads():
+        # The workloads mount the config and volumes, so only they wait for them
+        await deployer.apply_all(namespace, logger, *configs, *volumes)
+        await deployer.apply_all(namespace, logger, *workloads)
 
-        if status.phase != "Running":
-            logger.info(f"Waiting for kanidm {name} pod to be ready, current status: {status.phase}")
-            time.sleep(5)
-            continue
+    await asyncio.gather(rollout_workloads(), deployer.apply_all(namespace, logger, *independent))
 
-        logger.info("Kanidm pod is running, trying to fetch admin and idm_admin passwords")
-        
-        resp = stream(core.connect_get_namespaced_pod_exec,
-                pod.metadata.name,
-                namespace,
-                container="kanidm",
-                command=["kanidmd", "recover-account", "-o", "json", "admin"],
-                stderr=False, stdin=False, stdout=True, tty=False,
-            )
-        # We have to separate out the json from the rest of the response, as
-        # kanidmd pollutes its output with logs
-        resp_json = re.search(r"\{[\"a-zA-Z0-9:]*\}", resp, re.MULTILINE)
-        if resp_json is None:
-            logger.info(f"Failed to parse admin password, perhaps kanidm is still booting? Retrying")
-            # If kanidm has not booted yet, then the socket will not be available, so wait a bit
-            time.sleep(2)
-            continue
-        admin_password: str = json.loads(resp_json.group(0))["password"]
-        resp = stream(core.connect_get_namespaced_pod_exec,
-                pod.metadata.name,
-                namespace,
-                container="kanidm",
-                command=["kanidmd", "recover-account", "-o", "json", "idm_admin"],
-                stderr=False, stdin=False, stdout=True, tty=False,
-        )
-        resp_json = re.search(r"\{[\"a-zA-Z0-9:]*\}", resp, re.MULTILINE)
-        if resp_json is None:
-            logger.warning(f"Failed to parse idm_admin password, this should not happen!")
-            # If kanidm has not booted yet, then the socket will not be available, so wait a bit
-            time.sleep(2)
-            continue
-        idm_admin_password: str = json.loads(resp_json.group(0))["password"]
-        deployer.deploy(
-            "usersecret.yaml",
-            username="admin",
-            password=admin_password,
-        )
-        deployer.deploy(
-            "usersecret.yaml",
-            username="idm_admin",
-            password=idm_admin_password,
-        )
+
+@kopf.on.create("kanidm.github.io", "v1alpha1", "kanidms")
+@instrumented
+async def on_create_kanidms(
+    spec: KanidmResource,
+    name: str,
+    namespace: str,
+    logger: Logger,
+    patch: dict,
+    annotations: dict[str, str],
+    kanidm_pod_index: kopf.Index,
+    **kwargs,
+):
+    logger.info(f"Creating kanidm instance {name} in namespace {namespace}")
+    version = spec["version"]
+    certificates = json.loads(annotations.get(REPLICATION_CERTIFICATES_ANNOTATION, "{}"))
+
+    # Render everything up front, so a bad spec fails before anything is applied
+    await rollout_instance(namespace, logger, *prepare_instance(spec, name, namespace, certificates))
+
+    # Everything above is skipped on retries as unchanged, the subhandlers
+    # below retry with backoff until the servers are ready, then are done
+    core = client.CoreV1Api()
+
+    @kopf.subhandler(id="credentials", timeout=boot_timeout)
+    async def fetch_credentials(retry: int, patch: dict, **kwargs):
+        pods = ready_pods(kanidm_pod_index, namespace, name, "kanidm")
+        if not pods:
+            raise kopf.TemporaryError(f"Waiting for kanidm {name} pod to be ready", delay=boot_delay(retry))
+        pod_name = pods[0]
+
+        logger.info("Kanidm pod is ready, trying to fetch admin and idm_admin passwords")
+        passwords = await recover_accounts(core, pod_name, namespace, ["admin", "idm_admin"])
+        missing = [account for account in ["admin", "idm_admin"] if account not in passwords]
+        if missing:
+            # If kanidm has not booted yet, then the socket will not be available
+            raise kopf.TemporaryError(f"Failed to recover {', '.join(missing)}, perhaps kanidm is still booting?", delay=boot_delay(retry))
+        await deployer.apply_all(namespace, logger, *(
+            deployer.prepare("usersecret.yaml", namespace, version, username=account, password=password)
+            for account, password in passwords.items()
+        ))
         logger.info("Kanidm admin and idm_admin passwords have been fetched and stored in secrets")
-        done = True
-    
-    patch.setdefault("metadata", {}).setdefault("annotations", {})["kanidm.github.io/processed"] = "true"
+        patch.setdefault("metadata", {}).setdefault("annotations", {})["kanidm.github.io/processed"] = "true"
+
+    if spec["highAvailability"]["enabled"]:
+        @kopf.subhandler(id="replication", timeout=boot_timeout)
+        async def configure_replication(retry: int, patch: dict, **kwargs):
+            collected = await collect_replication_certificates(core, spec, name, namespace, kanidm_pod_index, certificates)
+            if collected != certificates:
+                # Keep what was collected, as the rollout above re-renders from it
+                patch.setdefault("metadata", {}).setdefault("annotations", {})[REPLICATION_CERTIFICATES_ANNOTATION] = json.dumps(collected)
+            missing = spec["highAvailability"]["replicas"] + 1 - len(collected)
+            if missing > 0:
+                raise kopf.TemporaryError(f"Waiting for the replication certificates of {missing} kanidm servers", delay=boot_delay(retry))
+
+            # Pin the certificates, restarting the servers through their config hash
+            configs, workloads = prepare_workloads(spec, name, namespace, collected)
+            await deployer.apply_all(namespace, logger, *configs)
+            await deployer.apply_all(namespace, logger, *workloads)
+            logger.info(f"Replication configured between the write replica and {len(collected) - 1} read replicas")
 
 @kopf.on.update("kanidm.github.io", "v1alpha1", "kanidms")
+@instrumented
 async def on_update_kanidms(
     spec: KanidmResource,
     name: str,
     namespace: str,
     logger: Logger,
+    annotations: dict[str, str],
+    old: dict,
+    patch: dict,
     **kwargs,
 ):
-    pass
+    # Also runs when the replication certificates annotation changes, pinning them.
+    # Only what the change touched is applied, the rest is skipped as unchanged
+    high_availability = spec["highAvailability"]["enabled"]
+    certificates = json.loads(annotations.get(REPLICATION_CERTIFICATES_ANNOTATION, "{}")) if high_availability else {}
+    await rollout_instance(namespace, logger, *prepare_instance(spec, name, namespace, certificates))
+
+    if not high_availability and ((old or {}).get("spec") or {}).get("highAvailability", {}).get("enabled", False):
+        # The write replica no longer replicates, remove the read replicas and what routes to them
+        logger.info(f"High availability of kanidm {name} was disabled, removing its read replicas")
+        await asyncio.gather(*(
+            deployer.delete(api_version, kind, namespace, resource_name, logger)
+            for api_version, kind, resource_name in HIGH_AVAILABILITY_RESOURCES
+        ))
+        if REPLICATION_CERTIFICATES_ANNOTATION in annotations:
+            # Replicas added back later generate new certificates
+            patch.setdefault("metadata", {}).setdefault("annotations", {})[REPLICATION_CERTIFICATES_ANNOTATION] = None
@@ -1,84 +1,219 @@
+import copy
+import hashlib
+from base64 import b64decode
 from logging import Logger
 
 import kopf
+
+from kanidm_operator.client import KanidmClient, first, member_key, parse_scope_maps
+from kanidm_operator.dependencies import GROUP, pending, wait_for_created
+from kanidm_operator.metrics import instrumented
 from kanidm_operator.typing.oauth2client import OAuth2ClientResource
-from kanidm_operator.deployer import Deployer
+from kanidm_operator.deployer import deployer, slugify
+
+from .util import kanidm_client
+
+# Fingerprint of the secret last written to the client's kubernetes Secret
+SECRET_FINGERPRINT_ANNOTATION = "kanidm.github.io/secret-fingerprint"
+# Set to a new value, e.g. the current time, to have the client's secret rotated
+ROTATE_SECRET_ANNOTATION = "kanidm.github.io/rotate-secret"
+# The value of the rotation annotation last acted on
+SECRET_ROTATED_ANNOTATION = "kanidm.github.io/secret-rotated"
+
+
+def secret_fingerprint(secret: str) -> str:
+    return hashlib.sha256(secret.encode("utf-8")).hexdigest()[:16]
+
+
+async def written_fingerprint(namespace: str, name: str) -> str | None:
+    """Fingerprint of the secret in an oauth2 client's kubernetes Secret, None
+    if the Secret is missing or its secret doesn't match its annotation."""
+    live = await deployer.read("v1", "Secret", namespace, f"{slugify(name)}-oauth2-credentials")
+    if live is None or "secret" not in (live.get("data") or {}):
+        return None
+    annotated = ((live.get("metadata") or {}).get("annotations") or {}).get(SECRET_FINGERPRINT_ANNOTATION)
+    actual = secret_fingerprint(b64decode(live["data"]["secret"]).decode("utf-8"))
+    return actual if annotated == actual else None
+
+
+def oauth2client_changes(spec: OAuth2ClientResource, entry: dict) -> dict:
+    """The settings of an oauth2 client differing from its spec, given its current entry,
+    as arguments to KanidmClient.update_oauth2client."""
+    attrs = entry.get("attrs", {})
+    changes = {}
+    # prefer-short-username is needed for gitea/forgejo
+    if spec.get("prefer-short-username") and attrs.get("oauth2_prefer_short_username") != ["true"]:
+        changes["prefer_short_username"] = True
+    # Default to enabling PKCE
+    pkce = spec.get("enable-pkce", True)
+    if pkce != (attrs.get("oauth2_allow_insecure_client_disable_pkce") != ["true"]):
+        changes["pkce"] = pkce
+    if "callback-url" in spec and first(attrs, "oauth2_rs_origin_landing") != spec["callback-url"]:
+        changes["landing_url"] = spec["callback-url"]
+    return changes
+
+
+async def reconcile_oauth2client(
+    cli_client: KanidmClient,
+    spec: OAuth2ClientResource,
+    namespace: str,
+    logger: Logger,
+    existing: dict | None,
+    groups: set[str] | None = None,
+    owner: dict | None = None,
+    fingerprint: str | None = None,
+    rotate: bool = False,
+) -> str:
+    """Bring an oauth2 client in line with its spec, given its current entry
+    (None if missing), only writing the settings that differ. groups, if
+    given, are the names of the groups known to exist in kanidm, saving a
+    lookup for the scope map. owner is the resource owning its secret, when
+    not reconciled from its own handler.
+
+    fingerprint is the one of the secret already in the client's kubernetes
+    Secret, if known. The secret is then only read from kanidm again for a
+    new client, or when rotating it. Returns the fingerprint of the secret
+    in the kubernetes Secret."""
+    if "scope-map" in spec:
+        if "group" not in spec['scope-map']:
+            raise kopf.PermanentError("scope-map must contain a group entry")
+        if "scopes" not in spec['scope-map'] or not isinstance(spec['scope-map']['scopes'], list):
+            raise kopf.PermanentError("scope-map must contain a scopes entry which is an array")
+
+    # Create the oauth2 client
+    entry = await cli_client.ensure_oauth2client(spec['name'], spec['displayName'], spec['origin'], existing)
+
+    changes = oauth2client_changes(spec, entry)
+    if changes:
+        logger.info(f"Updating {', '.join(changes)} of oauth2 client {spec['name']}")
+        await cli_client.update_oauth2client(spec['name'], **changes)
+
+    if "scope-map" in spec:
+        group = spec['scope-map']['group']
+        scope_maps = parse_scope_maps(entry["attrs"].get("oauth2_rs_scope_map", []))
+        if scope_maps.get(member_key(group)) == sorted(spec['scope-map']['scopes']):
+            logger.debug(f"Scope map of oauth2 client {spec['name']} is already up to date")
+        else:
+            if groups is not None:
+                group_exists = group in groups
+            else:
+                group_exists = await cli_client.get_group(group) is not None
+            if not group_exists:
+                raise kopf.TemporaryError(f"Group {group} does not exist", delay=10)
+
+            await cli_client.update_oauth2client_scope_map(spec['name'], group, spec['scope-map']['scopes'])
+
+    force = False
+    if existing is not None and fingerprint is not None and not rotate:
+        # The kubernetes Secret still holds the current secret
+        if await written_fingerprint(namespace, spec["name"]) == fingerprint:
+            return fingerprint
+        logger.info(f"Kubernetes Secret of oauth2 client {spec['name']} is missing or was changed, writing it again")
+        # Unchanged since it was last rendered, so only written if forced
+        force = True
+    secret = await cli_client.get_oauth2client_secret(spec['name'])
+    # A secret differing from the known one was already rotated by an earlier
+    # attempt that failed to write it, rotating it again would be wasted
+    if rotate and existing is not None and (fingerprint is None or secret_fingerprint(secret) == fingerprint):
+        logger.info(f"Rotating the secret of oauth2 client {spec['name']}")
+        await cli_client.reset_oauth2client_secret(spec['name'])
+        secret = await cli_client.get_oauth2client_secret(spec['name'])
+
+    # Save the secret in a k8s secret, in one write so consumers never see a
+    # client id and secret that don't belong together
+    await deployer.deploy(
+        "oauth2secret.yaml",
+        namespace,
+        "N/A",
+        logger,
+        owner=owner,
+        force=force,
+        name=spec["name"],
+        secret=secret,
+        client_id=spec["name"],
+        fingerprint=secret_fingerprint(secret),
+    )
+    return secret_fingerprint(secret)
+
+
+@kopf.index("kanidm.github.io", "v1alpha1", "oauth2-clients")
+async def oauth2client_index(
+    spec: OAuth2ClientResource,
+    name: str,
+    namespace: str,
+    uid: str,
+    annotations: dict[str, str],
+    **kwargs,
+):
+    """Index of the oauth2 client resources by (namespace, kanidmName), for bulk reconciliation."""
+    return {(namespace, spec["kanidmName"]): {
+        "name": name,
+        "spec": copy.deepcopy(dict(spec)),
+        "fingerprint": annotations.get(SECRET_FINGERPRINT_ANNOTATION),
+        # Bulk reconciles run from the kanidm handlers, the secret belongs to the client
+        "owner": {
+            "apiVersion": "kanidm.github.io/v1alpha1",
+            "kind": "OAuth2Client",
+            "metadata": {"name": name, "namespace": namespace, "uid": uid},
+        },
+    }}
 
-from .util import KanidmCLIClient
 
 @kopf.on.create("kanidm.github.io", "v1alpha1", "oauth2-clients")
 @kopf.on.update("kanidm.github.io", "v1alpha1", "oauth2-clients")
+@instrumented
 async def on_create_oauth2client(
     spec: OAuth2ClientResource,
     patch: dict,
     namespace: str,
     logger: Logger,
+    kanidm_index: kopf.Index,
+    credentials_index: kopf.Index,
+    tls_index: kopf.Index,
+    group_index: kopf.Index,
+    annotations: dict[str, str],
     body: dict,
     **kwargs,
 ):
-    cli_client = KanidmCLIClient(spec["kanidmName"], namespace, logger)
-    # Create the oauth2 client and fetch the secret for the client
-    secret = cli_client.create_oauth2client(spec['name'], spec['displayName'], spec['origin'])
-
-    # Save the secret in a k8s secret
-    deployer = Deployer(namespace, "N/A", logger)
-    deployer.deploy(
-        "oauth2secret.yaml",
-        name=spec["name"],
-        secret=secret,
-        client_id=spec["name"],
+    cli_client = await kanidm_client(spec["kanidmName"], namespace, logger, kanidm_index, credentials_index, tls_index)
+    if "group" in spec.get("scope-map", {}):
+        # Rather than retrying until the group of the scope map shows up, wait for its handler to create it
+        await wait_for_created(namespace, spec["kanidmName"], {
+            GROUP: pending(namespace, spec["kanidmName"], GROUP, [spec["scope-map"]["group"]], group_index),
+        }, logger)
+    rotation = annotations.get(ROTATE_SECRET_ANNOTATION)
+    rotate = rotation is not None and rotation != annotations.get(SECRET_ROTATED_ANNOTATION)
+    fingerprint = await reconcile_oauth2client(
+        cli_client, spec, namespace, logger, await cli_client.get_oauth2client(spec['name']),
+        fingerprint=annotations.get(SECRET_FINGERPRINT_ANNOTATION),
+        rotate=rotate,
     )
 
-    # prefer-short-username is needed for gitea/forgejo
-    if "prefer-short-username" in spec and spec["prefer-short-username"]:
-        result = cli_client.command(['system', 'oauth2', 'prefer-short-username', spec['name']])
-        if result.returncode != 0:
-            raise kopf.TemporaryError(f"Failed to set prefer-short-username for oauth2 client {spec['name']}")
-    
-    # Default to enabling PKCE
-    if "enable-pkce" in spec and not spec["enable-pkce"]:
-        result = cli_client.command(['system', 'oauth2', 'warning-insecure-client-disable-pkce', spec['name']])
-    else:
-        result = cli_client.command(['system', 'oauth2', 'enable-pkce', spec['name']])
-    if result.returncode != 0:
-        raise kopf.TemporaryError(f"Failed to set enable-pkce for oauth2 client {spec['name']}")
-
-    if "callback-url" in spec:
-        result = cli_client.command(['system', 'oauth2', 'set-landing-url', spec['name'], spec['callback-url']])
-        if result.returncode != 0:
-            raise kopf.TemporaryError(f"Failed to set-landing-url for oauth2 client {spec['name']}")
-
-    if "scope-map" in spec:
-        if "group" not in spec['scope-map']:
-            raise kopf.PermanentError("scope-map must contain a group entry")
-        
-        group = cli_client.get_group(spec['scope-map']['group'])
-        if group is None:
-            raise kopf.TemporaryError(f"Group {spec['scope-map']['group']} does not exist", delay=10)
+    patch_annotations = patch.setdefault("metadata", {}).setdefault("annotations", {})
+    patch_annotations["kanidm.github.io/processed"] = "true"
+    patch_annotations[SECRET_FINGERPRINT_ANNOTATION] = fingerprint
+    # Only recorded once the new secret is in the kubernetes Secret, a failed rotation is retried
+    if rotate:
+        patch_annotations[SECRET_ROTATED_ANNOTATION] = rotation
 
-        if "scopes" not in spec['scope-map'] or not isinstance(spec['scope-map']['scopes'], list):
-            raise kopf.PermanentError("scope-map must contain a scopes entry which is an array")
-        
-        result = cli_client.command(['system', 'oauth2', 'update-scope-map', spec['name'], spec['scope-map']['group']] + spec['scope-map']['scopes'])
-        if result.returncode != 0:
-            raise kopf.TemporaryError(f"Failed to set scope-map for oauth2 client {spec['name']}")
-        
-    patch.setdefault("metadata", {}).setdefault("annotations", {})["kanidm.github.io/processed"] = "true"
-        
 #@kopf.on.field("kanidm.github.io"  , "v1alpha1", "oauth2-clients", field="spec.name")
 #@kopf.on.field("kanidm.github.io", "v1alpha1", "oauth2-clients", field="spec.kanidmName")
 #async def on_update_oauth2client_name(**kwargs):
 #    raise kopf.PermanentError("User name and kanidmName cannot be changed")
 
 @kopf.on.delete("kanidm.github.io", "v1alpha1", "oauth2-clients")
+@instrumented
 async def on_delete_oauth2client(
     spec: OAuth2ClientResource,
     name: str,
     namespace: str,
     logger: Logger,
+    kanidm_index: kopf.Index,
+    credentials_index: kopf.Index,
+    tls_index: kopf.Index,
     annotations: dict[str, str],
     **kwargs,
 ):
-    cli_client = KanidmCLIClient(spec["kanidmName"], namespace, logger, silence_missing_kanidm=True)
+    cli_client = await kanidm_client(spec["kanidmName"], namespace, logger, kanidm_index, credentials_index, tls_index, silence_missing_kanidm=True)
     if cli_client.kanidm_spec is not None:
-        cli_client.delete_oauth2client(spec['name'])
+        await cli_client.delete_oauth2client(spec['name'])
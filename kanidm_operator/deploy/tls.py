@@ -0,0 +1,24 @@
+"""
+Watches the TLS secrets cert-manager issues for kanidm (certificate.yaml), so
+the operator can verify kanidm's in-cluster services against their CA.
+"""
+
+from base64 import b64decode
+
+import kopf
+
+TLS_LABEL = "kanidm.github.io/tls-for"
+
+
+@kopf.index("", "v1", "secrets", labels={TLS_LABEL: kopf.PRESENT})
+async def tls_index(
+    namespace: str,
+    body: dict,
+    **kwargs,
+):
+    """Index of the CA of kanidm certificates by namespace, None if the issuer doesn't provide it."""
+    data = body.get("data") or {}
+    if not data.get("ca.crt"):
+        # e.g. ACME issuers, whose certificates are trusted by the system CAs
+        return {namespace: None}
+    return {namespace: b64decode(data["ca.crt"].encode("utf-8")).decode("utf-8")}
@@ -1,24 +1,49 @@
+import copy
 from logging import Logger
 
 import kopf
+
+from kanidm_operator.dependencies import USER, mark_created, mark_deleted
+from kanidm_operator.metrics import instrumented
 from kanidm_operator.typing.user import UserResource
 
-from .util import KanidmCLIClient
+from .util import kanidm_client
+
+@kopf.index("kanidm.github.io", "v1alpha1", "users")
+async def user_index(
+    spec: UserResource,
+    name: str,
+    namespace: str,
+    annotations: dict[str, str],
+    **kwargs,
+):
+    """Index of the user resources by (namespace, kanidmName), for bulk reconciliation and ordering."""
+    return {(namespace, spec["kanidmName"]): {
+        "name": name,
+        "spec": copy.deepcopy(dict(spec)),
+        "processed": annotations.get("kanidm.github.io/processed") == "true",
+    }}
 
 @kopf.on.create("kanidm.github.io", "v1alpha1", "users")
 @kopf.on.update("kanidm.github.io", "v1alpha1", "users")
+@instrumented
 async def on_create_user(
     spec: UserResource,
     patch: dict,
     namespace: str,
     logger: Logger,
+    kanidm_index: kopf.Index,
+    credentials_index: kopf.Index,
+    tls_index: kopf.Index,
     body: dict,
     **kwargs,
 ):
     logger.info(f"Trying to add user {spec['name']} to kanidm in the namespace {namespace}")
-    cli_client = KanidmCLIClient(spec["kanidmName"], namespace, logger)
-    cli_client.create_user(spec['name'], spec['displayName'])
-    cli_client.set_user_emails(spec['name'], spec['emails'])
+    cli_client = await kanidm_client(spec["kanidmName"], namespace, logger, kanidm_index, credentials_index, tls_index)
+    user = await cli_client.get_user(spec['name'])
+    await cli_client.reconcile_user(spec['name'], spec['displayName'], spec.get('emails') or [], user)
+    # Wake the groups waiting on the user as a member
+    mark_created(namespace, spec["kanidmName"], USER, [spec['name']])
 
     patch.setdefault("metadata", {}).setdefault("annotations", {})["kanidm.github.io/processed"] = "true"
 
@@ -28,16 +53,21 @@ async def on_create_user(
 #    raise kopf.PermanentError("User name and kanidmName cannot be changed")
 
 @kopf.on.delete("kanidm.github.io", "v1alpha1", "users")
+@instrumented
 async def on_delete_user(
     spec: UserResource,
     name: str,
     namespace: str,
     logger: Logger,
+    kanidm_index: kopf.Index,
+    credentials_index: kopf.Index,
+    tls_index: kopf.Index,
     annotations: dict[str, str],
     **kwargs,
 ):
     logger.info(f"Trying to add user {spec['name']} to kanidm in the namespace {namespace}")
     # If kanidm is already gone, then don't worry about deleting
-    cli_client = KanidmCLIClient(spec["kanidmName"], namespace, logger, silence_missing_kanidm=True)
+    cli_client = await kanidm_client(spec["kanidmName"], namespace, logger, kanidm_index, credentials_index, tls_index, silence_missing_kanidm=True)
     if cli_client.kanidm_spec is not None:
-        cli_client.delete_user(spec['name'])
+        await cli_client.delete_user(spec['name'])
+    mark_deleted(namespace, spec["kanidmName"], USER, spec['name'])
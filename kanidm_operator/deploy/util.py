@@ -1,200 +1,211 @@
 import os
-from kubernetes import client as kube_client, config
 import kopf
-from kubernetes.client.models.v1_secret import V1Secret
-from kubernetes.client.models.v1_secret_list import V1SecretList
-from kanidm_operator.deployer import slugify
+from kanidm_operator.client import KanidmClient
+from kanidm_operator.http_client import KanidmHTTPClient
+from kanidm_operator.metrics import kanidm_request_duration, kanidm_requests
+from kanidm_operator.tracing import span
 from logging import Logger
-from base64 import b64decode
+import asyncio
 import subprocess
 import json
-import yaml
+import re
 
 kanidm_exec = os.environ.get("KANIDM_EXEC", "kanidm")
+# Either "http" to talk to the kanidm REST API directly, or "cli" to drive the
+# kanidm CLI tool
+kanidm_backend = os.environ.get("KANIDM_BACKEND", "http")
+
+# Output of the kanidm CLI when the server rejected the session token
+auth_failure = re.compile(
+    r"Http\(401|NotAuthenticated|SessionExpired|Unauthori[sz]ed|No valid (authentication )?session",
+    re.IGNORECASE,
+)
+
+def parse_entries(output: str) -> list[dict]:
+    """Parse the `key: value` blocks printed by the kanidm CLI into entries.
+
+    The text output isn't valid YAML (https://github.com/kanidm/kanidm/issues/1998),
+    so read it line by line, collecting repeated keys into the attribute lists.
+    """
+    entries = []
+    attrs = {}
+    for line in output.splitlines():
+        if line.startswith("---"):
+            if attrs:
+                entries.append({"attrs": attrs})
+            attrs = {}
+            continue
+        key, sep, value = line.partition(": ")
+        if not sep:
+            continue
+        attrs.setdefault(key.strip(), []).append(value.strip())
+    if attrs:
+        entries.append({"attrs": attrs})
+    return entries
+
+
+def parse_json_lines(output: bytes, kind: str) -> list[dict]:
+    try:
+        return [json.loads(line) for line in output.decode().splitlines() if line.strip()]
+    except json.JSONDecodeError as e:
+        raise kopf.TemporaryError(f"Failed to parse {kind} list from kanidm CLI ({e})", delay=10)
+
+
+def cli_operation(args) -> str:
+    """The subcommand of a kanidm CLI call, e.g. "person get", without its arguments."""
+    return " ".join(args[:3 if args[0] == "system" else 2])
+
+
+class KanidmCLIClient(KanidmClient):
+    backend = "cli"
+
+    async def _run(self, args) -> subprocess.CompletedProcess:
+        self.calls += 1
+        operation = cli_operation(args)
+        async with self.limiter.slot():
+            return await self._run_process(args, operation)
+
+    async def _run_process(self, args, operation: str) -> subprocess.CompletedProcess:
+        with (
+            kanidm_request_duration.labels(backend=self.backend, operation=operation).time(),
+            span(f"kanidm {operation}", **{"kanidm.backend": self.backend, "kanidm.name": self.kanidm_name, "kanidm.args": " ".join(args[len(operation.split()):])}) as current,
+        ):
+            process = await asyncio.create_subprocess_exec(
+                kanidm_exec, *args,
+                env=self.session.env,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            stdout, stderr = await process.communicate()
+            if current is not None:
+                current.set(**{"process.exit_code": process.returncode})
+        kanidm_requests.labels(backend=self.backend, operation=operation, outcome="success" if process.returncode == 0 else "error").inc()
+        return subprocess.CompletedProcess([kanidm_exec, *args], process.returncode, stdout, stderr)
+
+    async def command(self, args) -> subprocess.CompletedProcess:
+        logged_in_at = self.session.logged_in_at
+        result = await self._run(args)
+        if result.returncode != 0 and auth_failure.search(result.stdout.decode() + result.stderr.decode()):
+            # The cached session was rejected (expired, revoked, or the
+            # server restarted), log in again and retry once
+            await self.relogin(logged_in_at)
+            result = await self._run(args)
+        return result
+
+    async def _checked_command(self, args, action: str) -> subprocess.CompletedProcess:
+        result = await self.command(args)
+        if result.returncode != 0:
+            raise kopf.TemporaryError(f"Failed to {action} ({result.returncode}), stdout={result.stdout.decode()}, stderr={result.stderr.decode()}", delay=10)
+        return result
 
-class KanidmCLIClient:
-    def __init__(self, kanidm_name: str, namespace: str, logger: Logger, username: str = "idm_admin", silence_missing_kanidm: bool = False):
-        self.logger = logger
-
-        if os.getenv("KUBERNETES_SERVICE_HOST"):
-            config.load_incluster_config()
-        else:
-            config.load_kube_config()
-
-        customapi = kube_client.CustomObjectsApi()
-        
-        # First discover the kanidm instance we're working on
-        kanidms = customapi.list_cluster_custom_object(
-                "kanidm.github.io",
-                version='v1alpha1',
-                plural="kanidms"
-                )
-        self.kanidm_spec = None
-        for k in kanidms["items"]:
-            #logger.info(f"Checking {repr(k)}")
-            if k["metadata"]["name"] == kanidm_name:
-                self.kanidm_spec = k
-                break
-
-        
-        if self.kanidm_spec is None:
-            if silence_missing_kanidm:
-                return
-            raise kopf.TemporaryError(f"No Kanidm configuration named {kanidm_name} found in the namespace {namespace}", delay=10)
-
-        coreapi = kube_client.CoreV1Api()
-        # Now get the user's password secret
-        secrets: V1SecretList = coreapi.list_namespaced_secret(
-            namespace,
-            label_selector=f"kanidm.github.io/credentials-for={slugify(username)}",
-        )
-
-        if len(secrets.items) == 0:
-            raise kopf.TemporaryError(f"No secret found for user {username} in the namespace {namespace}", delay=10)
-        if len(secrets.items) > 1:
-            raise kopf.TemporaryError(f"Multiple secrets for {username} in the namespace {namespace} found!", delay=10)
-        
-        #logger.info(f"Secrets are {repr(secrets.items)}")
-
-        secret: V1Secret = secrets.items[0]
-        if "password" not in secret.data:
-            raise kopf.TemporaryError(f"Secret for {username} in the namespace {namespace} does not contain a password!", delay=10)
-        
-        password = b64decode(secret.data["password"].encode("utf-8")).decode("utf-8")
-
-        self.env = dict(
-            KANIDM_URL="https://"+self.kanidm_spec['spec']["domain"],
-            KANIDM_NAME=username,
-            KANIDM_PASSWORD=password,
-        )
-
-        self.login()
-
-    def command(self, args):
-        return subprocess.run([kanidm_exec, *args], env=self.env, capture_output=True)
-
-    def login(self):        
-        login_result = self.command(["login"])
+    async def _authenticate(self):
+        login_result = await self._run(["login"])
         if login_result.returncode != 0:
             raise kopf.TemporaryError(f"Failed to login to kanidm, stdout={login_result.stdout}, stderr={login_result.stderr}", delay=10)
 
-    def get_user(self, username):
-        get_result = self.command(["person", "get", "-o", "json", username])
-        if get_result.returncode != 0:
-            raise kopf.TemporaryError(f"Failed to get user ({get_result.returncode}), stdout={get_result.stdout.decode()}, stderr={get_result.stderr.decode()}", delay=10)
-        
+    async def get_user(self, username):
+        get_result = await self._checked_command(["person", "get", "-o", "json", username], "get user")
+
         #We had a successful query, check if there's no matching entries
         if "No matching entries" in get_result.stdout.decode():
             return None
-        
+
         try:
             return json.loads(get_result.stdout)
         except json.JSONDecodeError as e:
             raise kopf.TemporaryError(f"Failed to parse user data from kanidm CLI for {username} ({e})", delay=10)
 
-    def get_group(self,name):
-        get_result = self.command(["group", "get", "-o", "json", name])
-        if get_result.returncode != 0:
-            raise kopf.TemporaryError(f"Failed to get group ({get_result.returncode}), stdout={get_result.stdout.decode()}, stderr={get_result.stderr.decode()}", delay=10)
-        
+    async def get_group(self,name):
+        get_result = await self._checked_command(["group", "get", "-o", "json", name], "get group")
+
         #We had a successful query, check if there's no matching entries
         if "No matching group" in get_result.stderr.decode():
             return None
-        
+
         try:
             return json.loads(get_result.stdout)
         except json.JSONDecodeError as e:
             raise kopf.TemporaryError(f"Failed to parse group data from kanidm CLI for {name} ({e})\nstdout={get_result.stdout.decode()}\nstderr={get_result.stderr.decode()}", delay=10)
 
-    def get_oauth2client(self,name):
-        get_result = self.command(["system", "oauth2", "get", name])
-        if get_result.returncode != 0:
-            raise kopf.TemporaryError(f"Failed to get oauth2client ({get_result.returncode}), stdout={get_result.stdout.decode()}, stderr={get_result.stderr.decode()}", delay=10)
-        
+    async def get_oauth2client(self,name):
+        get_result = await self._checked_command(["system", "oauth2", "get", name], "get oauth2client")
+
         #We had a successful query, check if there's no matching entries
         if "No matching entries" in get_result.stdout.decode():
             return None
-        
-        output = get_result.stdout.decode().lstrip('-\n')
-        # We know that the output contains incorrectly formatted lines for YAML
-        # https://github.com/kanidm/kanidm/issues/1998
-        # We can fix this by removing the line starting with "oauth2_rs_scope_map:"
-        output = "\n".join([l for l in output.split("\n") if not l.startswith("oauth2_rs_scope_map:")])
-        try:
-            return yaml.safe_load(output)
-        except yaml.YAMLError as e:
-            raise kopf.TemporaryError(f"Failed to parse oauth2client data from kanidm CLI for {name} ({e})\nstdout={get_result.stdout.decode()}\nstderr={get_result.stderr.decode()}", delay=10)
-
-    def create_user(self, username: str, displayname: str):
-        # First, check if user already exists
-        existing_user_data = self.get_user(username)
-        if existing_user_data == None:
-            create_result = self.command(["person", "create", username, displayname])
-            if create_result.returncode != 0:
-                raise kopf.TemporaryError(f"Failed to create user ({create_result.returncode}), stdout={create_result.stdout.decode()}, stderr={create_result.stderr.decode()}", delay=10)
-            # Success, we created the user!
-            return    
-
-        self.logger.warning(f"User {username} already exists, not creating. {existing_user_data}")
-        
-        # Now we check if the already existing user needs a display name change
-        if existing_user_data['attrs']["displayname"] != displayname:
-            update_result = self.command(["person", "update", username, "--displayname", displayname])
-            if update_result.returncode != 0:
-                raise kopf.TemporaryError(f"Failed to update user displayname ({update_result.returncode}), stdout={update_result.stdout.decode()}, stderr={update_result.stderr.decode()}", delay=10)
-            # Success, we updated the user displayname!
-        return
-    
-    def delete_user(self, username: str):
-        result = self.command(["person", "delete", username])
-        if result.returncode != 0:
-            raise kopf.TemporaryError(f"Failed to delete user ({result.returncode}), stdout={result.stdout.decode()}, stderr={result.stderr.decode()}", delay=10)
 
-    def set_user_emails(self, username: str, emails: list[str]):
-        result = self.command(["person", "update", username] + [k for m in emails for k in ["-m", m]])
-        if result.returncode != 0:
-            raise kopf.TemporaryError(f"Failed to update emails for user ({result.returncode}), stdout={result.stdout.decode()}, stderr={result.stderr.decode()}", delay=10)
-
-    def create_group(self, name: str):
-        # First, check if user already exists
-        existing_group_data = self.get_group(name)
-        if existing_group_data == None:
-            create_result = self.command(["group", "create", name])
-            if create_result.returncode != 0:
-                raise kopf.TemporaryError(f"Failed to create group ({create_result.returncode}), stdout={create_result.stdout.decode()}, stderr={create_result.stderr.decode()}", delay=10)
-            # Success, we created the user!
-            return    
-
-        self.logger.warning(f"Group {name} already exists, not creating. {existing_group_data}")
-
-    def set_group_members(self, name: str, members: list[str]):
-        result = self.command(["group", "set-members", name] + members)
-        if result.returncode != 0:
-            raise kopf.TemporaryError(f"Failed to update members for group ({result.returncode}), stdout={result.stdout.decode()}, stderr={result.stderr.decode()}", delay=10)
-        
-    def delete_group(self, name: str):
-        result = self.command(["group", "delete", name])
-        if result.returncode != 0:
-            raise kopf.TemporaryError(f"Failed to delete group ({result.returncode}), stdout={result.stdout.decode()}, stderr={result.stderr.decode()}", delay=10)
-
-    def create_oauth2client(self, name: str, displayname: str, origin: str):
-        # First, check if user already exists
-        existing_client_data = self.get_oauth2client(name)
-        if existing_client_data == None:
-            create_result = self.command(["system", "oauth2", "create", name, displayname, origin])
-            if create_result.returncode != 0:
-                raise kopf.TemporaryError(f"Failed to create oauth2 client ({create_result.returncode}), stdout={create_result.stdout.decode()}, stderr={create_result.stderr.decode()}", delay=10)
-            # Success, we created the oauth token
-        else:
-            self.logger.warning(f"OAuth2 client {name} already exists, not creating. {existing_client_data}")
-
-        secret  = self.command(["system", "oauth2", "show-basic-secret", name])
-        if secret.returncode != 0:
-            raise kopf.TemporaryError(f"Failed to get secret for oauth2 client ({secret.returncode}), stdout={secret.stdout.decode()}, stderr={secret.stderr.decode()}", delay=10)
-        
+        entries = parse_entries(get_result.stdout.decode())
+        return entries[0] if entries else None
+
+    async def list_users(self) -> list[dict]:
+        list_result = await self._checked_command(["person", "list", "-o", "json"], "list users")
+        return parse_json_lines(list_result.stdout, "user")
+
+    async def list_groups(self) -> list[dict]:
+        list_result = await self._checked_command(["group", "list", "-o", "json"], "list groups")
+        return parse_json_lines(list_result.stdout, "group")
+
+    async def list_oauth2clients(self) -> list[dict]:
+        list_result = await self._checked_command(["system", "oauth2", "list"], "list oauth2clients")
+        return parse_entries(list_result.stdout.decode())
+
+    async def _create_user(self, username: str, displayname: str):
+        await self._checked_command(["person", "create", username, displayname], "create user")
+
+    async def _update_user_displayname(self, username: str, displayname: str):
+        await self._checked_command(["person", "update", username, "--displayname", displayname], "update user displayname")
+
+    async def delete_user(self, username: str):
+        await self._checked_command(["person", "delete", username], "delete user")
+
+    async def set_user_emails(self, username: str, emails: list[str]):
+        await self._checked_command(["person", "update", username] + [k for m in emails for k in ["-m", m]], "update emails for user")
+
+    async def _create_group(self, name: str):
+        await self._checked_command(["group", "create", name], "create group")
+
+    async def set_group_members(self, name: str, members: list[str]):
+        await self._checked_command(["group", "set-members", name] + members, "update members for group")
+
+    async def add_group_members(self, name: str, members: list[str]):
+        await self._checked_command(["group", "add-members", name] + members, "add members to group")
+
+    async def remove_group_members(self, name: str, members: list[str]):
+        await self._checked_command(["group", "remove-members", name] + members, "remove members from group")
+
+    async def delete_group(self, name: str):
+        await self._checked_command(["group", "delete", name], "delete group")
+
+    async def _create_oauth2client(self, name: str, displayname: str, origin: str):
+        await self._checked_command(["system", "oauth2", "create", name, displayname, origin], "create oauth2 client")
+
+    async def get_oauth2client_secret(self, name: str) -> str:
+        secret = await self._checked_command(["system", "oauth2", "show-basic-secret", name], "get secret for oauth2 client")
         return secret.stdout.decode().strip()
-    
-    def delete_oauth2client(self, name: str):
-        result = self.command(["system", "oauth2", "delete", name])
-        if result.returncode != 0:
-            raise kopf.TemporaryError(f"Failed to delete oauth2client ({result.returncode}), stdout={result.stdout.decode()}, stderr={result.stderr.decode()}", delay=10)
+
+    async def reset_oauth2client_secret(self, name: str):
+        await self._checked_command(["system", "oauth2", "reset-secrets", name], f"reset secrets of oauth2 client {name}")
+
+    async def set_oauth2client_prefer_short_username(self, name: str):
+        await self._checked_command(["system", "oauth2", "prefer-short-username", name], f"set prefer-short-username for oauth2 client {name}")
+
+    async def set_oauth2client_pkce(self, name: str, enabled: bool):
+        subcommand = "enable-pkce" if enabled else "warning-insecure-client-disable-pkce"
+        await self._checked_command(["system", "oauth2", subcommand, name], f"set enable-pkce for oauth2 client {name}")
+
+    async def set_oauth2client_landing_url(self, name: str, url: str):
+        await self._checked_command(["system", "oauth2", "set-landing-url", name, url], f"set-landing-url for oauth2 client {name}")
+
+    async def update_oauth2client_scope_map(self, name: str, group: str, scopes: list[str]):
+        await self._checked_command(["system", "oauth2", "update-scope-map", name, group] + scopes, f"set scope-map for oauth2 client {name}")
+
+    async def delete_oauth2client(self, name: str):
+        await self._checked_command(["system", "oauth2", "delete", name], "delete oauth2client")
+
+
+async def kanidm_client(kanidm_name: str, namespace: str, logger: Logger, kanidm_index: kopf.Index, credentials_index: kopf.Index, tls_index: kopf.Index, username: str = "idm_admin", silence_missing_kanidm: bool = False) -> KanidmClient:
+    """Get a client for the named kanidm instance using the configured backend, logged in if the instance exists."""
+    client_class = KanidmCLIClient if kanidm_backend == "cli" else KanidmHTTPClient
+    client = client_class(kanidm_name, namespace, logger, username=username)
+    await client.connect(kanidm_index, credentials_index, tls_index, silence_missing_kanidm=silence_missing_kanidm)
+    return client
@@ -1,19 +1,52 @@
+import asyncio
+import copy
+import hashlib
+import json
+import os
+import time
 from base64 import b64encode
 from typing import Any, Callable
 from logging import Logger
 
-from jinja2 import Environment, PackageLoader, select_autoescape
-from kubernetes.client import (
-    CoreV1Api,
-    CustomObjectsApi,
-    AppsV1Api,
-    NetworkingV1Api,
-    BatchV1Api
-)
+from jinja2 import Environment, FileSystemBytecodeCache, PackageLoader, select_autoescape
+from kubernetes.client import ApiClient, Configuration
 import kopf
 import yaml
 import kubernetes.client.exceptions as k8s_exceptions
 
+from kanidm_operator.metrics import k8s_applies, k8s_apply_duration
+from kanidm_operator.tracing import Span, span
+
+# Field manager owning the fields the operator applies
+field_manager = os.environ.get("KANIDM_FIELD_MANAGER", "kanidm-operator")
+# Take over fields owned by other managers rather than failing with a conflict
+apply_force = os.environ.get("KANIDM_APPLY_FORCE", "false").lower() == "true"
+# Seconds an unchanged resource is skipped for before it is applied again anyway,
+# repairing any drift or out of band deletion
+render_cache_ttl = float(os.environ.get("KANIDM_RENDER_CACHE_TTL", "3600"))
+
+RENDER_HASH_ANNOTATION = "kanidm.github.io/render-hash"
+
+# libyaml's loader is much faster, when pyyaml was built with it
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Connections kept open to the kubernetes API, shared by all handlers
+k8s_pool_size = int(os.environ.get("KANIDM_K8S_POOL_SIZE", "16"))
+# Optional directory to cache compiled templates in across restarts
+template_cache_dir = os.environ.get("KANIDM_TEMPLATE_CACHE_DIR")
+
+# Hash and time of the last successful apply, by (apiVersion, kind, namespace, name)
+_applied_hashes: dict[tuple[str, str, str, str], tuple[str, float]] = {}
+# Generation of each resource as of its last apply, changed by edits made since
+_applied_generations: dict[tuple[str, str, str, str], int] = {}
+
+
+def reset_cache():
+    """Forget every apply, so the next apply of each resource goes to the API server."""
+    _applied_hashes.clear()
+    _applied_generations.clear()
+
+
 def b64enc(value: Any, encoding="utf-8") -> str:
     if isinstance(value, bytes):
         return b64encode(value).decode(encoding)
@@ -24,18 +57,23 @@ def slugify(value: str) -> str:
     return value.lower().replace(" ", "-").replace("_", "-")
 
 
+def render_hash(resource: dict[str, Any]) -> str:
+    """A stable hash of a rendered resource, ignoring any previous render hash."""
+    resource = copy.deepcopy(resource)
+    resource.get("metadata", {}).get("annotations", {}).pop(RENDER_HASH_ANNOTATION, None)
+    return hashlib.sha256(json.dumps(resource, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
 class Deployer:
-    def __init__(self, namespace: str, version: str, logger: Logger):
-        self.logger = logger
-        self.namespace = namespace
-        self.version = version
-        self.apis = {
-            "v1": CoreV1Api(),
-            "batch/v1": BatchV1Api(),
-            "apps/v1": AppsV1Api(),
-            "networking.k8s.io/v1": NetworkingV1Api(),
-            "cert-manager.io/v1": CustomObjectsApi(),
-        }
+    """Renders and applies the operator's templates.
+
+    One deployer is shared by the whole process (see `deployer` below), so the
+    templates are compiled once and every handler reuses the same kubernetes
+    connection pool. The namespace and version are passed on each call.
+    """
+
+    def __init__(self, api_client: ApiClient | None = None):
+        self._api_client = api_client
         self.env = Environment(
             loader=PackageLoader(
                 "kanidm_operator",
@@ -43,143 +81,257 @@ class Deployer:
                 encoding="utf-8",
             ),
             autoescape=select_autoescape(["toml", "yaml", "yml", "json"]),
+            bytecode_cache=FileSystemBytecodeCache(template_cache_dir) if template_cache_dir else None,
+            # Templates never change while the operator runs
+            auto_reload=False,
         )
         self.env.filters["b64enc"] = b64enc
         self.env.filters["slugify"] = slugify
-        self.logger.info("Deployer initialization complete, env loaded.")
 
-    def _create_resource(
+    @property
+    def api_client(self) -> ApiClient:
+        # Created on first use, as the kubernetes config is loaded by kopf at login
+        if self._api_client is None:
+            configuration = Configuration.get_default_copy()
+            configuration.connection_pool_maxsize = k8s_pool_size
+            self._api_client = ApiClient(configuration)
+        return self._api_client
+
+    @api_client.setter
+    def api_client(self, api_client: ApiClient | None):
+        self._api_client = api_client
+
+    def compile_templates(self) -> int:
+        """Compile every template now rather than on first use, returning how many there are."""
+        names = self.env.list_templates()
+        for name in names:
+            self.env.get_template(name)
+        return len(names)
+
+    def _resource_path(self, api_version: str, plural: str, namespace: str, name: str) -> str:
+        # Core resources live under /api, everything else under /apis/<group>
+        prefix = "/api" if "/" not in api_version else "/apis"
+        return f"{prefix}/{api_version}/namespaces/{namespace}/{plural}/{name}"
+
+    def _read_resource(self, api_version: str, plural: str, namespace: str, name: str) -> dict[str, Any] | None:
+        try:
+            return self.api_client.call_api(
+                self._resource_path(api_version, plural, namespace, name),
+                "GET",
+                header_params={"Accept": "application/json"},
+                response_type="object",
+                auth_settings=["BearerToken"],
+                _return_http_data_only=True,
+            )
+        except k8s_exceptions.ApiException as e:
+            if e.status == 404:
+                return None
+            raise e
+
+    def _delete_resource(self, api_version: str, plural: str, namespace: str, name: str) -> bool:
+        try:
+            self.api_client.call_api(
+                self._resource_path(api_version, plural, namespace, name),
+                "DELETE",
+                header_params={"Accept": "application/json"},
+                response_type="object",
+                auth_settings=["BearerToken"],
+                _return_http_data_only=True,
+            )
+            return True
+        except k8s_exceptions.ApiException as e:
+            if e.status == 404:
+                return False
+            raise e
+
+    def _apply_resource(
         self,
-        api,
-        method_name: str,
+        api_version: str,
+        plural: str,
         namespace: str,
         body: dict[str, Any],
-        **kwargs,
     ):
-        method = getattr(api, method_name)
+        path = self._resource_path(api_version, plural, namespace, body["metadata"]["name"])
+        # A single idempotent server-side apply, creating or updating as needed
         try:
-            return method(namespace=namespace, body=body, **kwargs)
+            return self.api_client.call_api(
+                path,
+                "PATCH",
+                query_params=[("fieldManager", field_manager), ("force", "true" if apply_force else "false")],
+                header_params={
+                    "Accept": "application/json",
+                    "Content-Type": "application/apply-patch+yaml",
+                },
+                body=body,
+                response_type="object",
+                auth_settings=["BearerToken"],
+                _return_http_data_only=True,
+            )
         except k8s_exceptions.ApiException as e:
             if e.status == 409:
-                self.logger.debug(f"Calling {method_name} and object already exists, attempting patch.")
-                #self.logger.debug(f"Body is {repr(body)}.")
-                #self.logger.debug(f"kwargs is {repr(kwargs)}.")
-                # Try a patch instead
-                method_name = method_name.replace("create", "patch")
-                method = getattr(api, method_name)
-                return method(name=body['metadata']['name'], namespace=namespace, body=body, **kwargs)
-            else:
-                raise e
-        return None
+                # Only possible without force, another manager owns some of the fields
+                raise kopf.TemporaryError(f"Conflict applying {plural} {body['metadata']['name']}, fields are owned by another manager: {e.body}", delay=10)
+            raise e
 
-    def create_resource_factory(
-        self,
-        api_version: str,
-        kind: str,
-        namespace: str | None = None,
-    ) -> Callable[[dict[str, Any]], None]:
-        api = self.apis[api_version]
-        if namespace is None:
-            namespace = self.namespace
+    def plural(self, kind: str) -> str:
         match kind:
             case "Secret":
-                return lambda body: self._create_resource(
-                    api,
-                    "create_namespaced_secret",
-                    namespace,
-                    body,
-                )
+                plural = "secrets"
             case "Deployment":
-                return lambda body: self._create_resource(
-                    api,
-                    "create_namespaced_deployment",
-                    namespace,
-                    body,
-                )
+                plural = "deployments"
+            case "StatefulSet":
+                plural = "statefulsets"
             case "Service":
-                return lambda body: self._create_resource(
-                    api,
-                    "create_namespaced_service",
-                    namespace,
-                    body,
-                )
+                plural = "services"
             case "Ingress":
-                return lambda body: self._create_resource(
-                    api,
-                    "create_namespaced_ingress",
-                    namespace,
-                    body,
-                )
+                plural = "ingresses"
             case "Certificate":
-                return lambda body: self._create_resource(
-                    api,
-                    "create_namespaced_custom_object",
-                    group="cert-manager.io",
-                    version="v1",
-                    namespace=namespace,
-                    plural="certificates",
-                    body=body,
-                )
+                plural = "certificates"
             case "ConfigMap":
-                return lambda body: self._create_resource(
-                    api,
-                    "create_namespaced_config_map",
-                    namespace,
-                    body,
-                )
+                plural = "configmaps"
             case "ServiceAccount":
-                return lambda body: self._create_resource(
-                    api,
-                    "create_namespaced_service_account",
-                    namespace,
-                    body,
-                )
+                plural = "serviceaccounts"
             case "Role":
-                return lambda body: self._create_resource(
-                    api,
-                    "create_namespaced_role",
-                    namespace,
-                    body,
-                )
+                plural = "roles"
             case "RoleBinding":
-                return lambda body: self._create_resource(
-                    api,
-                    "create_namespaced_role_binding",
-                    namespace,
-                    body,
-                )
+                plural = "rolebindings"
             case "PersistentVolumeClaim":
-                return lambda body: self._create_resource(
-                    api,
-                    "create_namespaced_persistent_volume_claim",
-                    namespace,
-                    body,
-                )
+                plural = "persistentvolumeclaims"
             case "Job":
-                return lambda body: self._create_resource(
-                    api,
-                    "create_namespaced_job",
-                    namespace,
-                    body,
-                )
+                plural = "jobs"
             case _:
                 raise NotImplementedError(f"Unknown kind: {kind}")
+        return plural
+
+    def create_resource_factory(
+        self,
+        api_version: str,
+        kind: str,
+        namespace: str,
+    ) -> Callable[[dict[str, Any]], None]:
+        plural = self.plural(kind)
+        return lambda body: self._apply_resource(api_version, plural, namespace, body)
 
-    def deploy(
+    def render(
         self,
         template_name: str,
+        namespace: str,
+        version: str,
         **extra_variables,
-    ) -> None:
-        variables = {
-            "namespace": self.namespace,
-            "version": self.version,
-        }
-        template = self.env.get_template(name=template_name, globals=variables)
-        rendered_yaml = template.render(**extra_variables)
-        resource = yaml.safe_load(rendered_yaml)
-        kopf.adopt(resource)
-        return self.create_resource_factory(
+    ) -> dict[str, Any]:
+        with span("deployer render", **{"deployer.template": template_name}):
+            template = self.env.get_template(name=template_name)
+            rendered_yaml = template.render(namespace=namespace, version=version, **extra_variables)
+            return yaml.load(rendered_yaml, Loader=SafeLoader)
+
+    def prepare(
+        self,
+        template_name: str,
+        namespace: str,
+        version: str,
+        owner: dict[str, Any] | None = None,
+        **extra_variables,
+    ) -> dict[str, Any]:
+        """Render a template into a resource owned by owner, by default the object being handled."""
+        resource = self.render(template_name, namespace, version, **extra_variables)
+        kopf.adopt(resource, owner=owner)
+        return resource
+
+    async def apply(self, resource: dict[str, Any], namespace: str, logger: Logger, force: bool = False) -> None:
+        """Apply a rendered resource, unless it is unchanged since it was last applied or force is set."""
+        namespace = resource.get("metadata", {}).get("namespace") or namespace
+        with span("k8s apply", **{
+            "k8s.kind": resource["kind"],
+            "k8s.namespace": namespace,
+            "k8s.name": resource["metadata"]["name"],
+        }) as current:
+            return await self._apply(resource, namespace, logger, current, force)
+
+    async def _apply(self, resource: dict[str, Any], namespace: str, logger: Logger, current: Span | None, force: bool) -> None:
+        create = self.create_resource_factory(
             api_version=resource["apiVersion"],
             kind=resource["kind"],
-            namespace=resource.get("metadata", {}).get("namespace", None),
-        )(body=resource)
+            namespace=namespace,
+        )
+
+        digest = render_hash(resource)
+        key = (resource["apiVersion"], resource["kind"], namespace, resource["metadata"]["name"])
+        applied = _applied_hashes.get(key)
+        if not force and applied is not None and applied[0] == digest and time.monotonic() - applied[1] < render_cache_ttl:
+            logger.debug(f"{resource['kind']} {key[3]} is unchanged since it was last applied, skipping")
+            k8s_applies.labels(kind=resource["kind"], outcome="skipped").inc()
+            if current is not None:
+                current.set(**{"deployer.skipped": True})
+            return None
+        resource.setdefault("metadata", {}).setdefault("annotations", {})[RENDER_HASH_ANNOTATION] = digest
+
+        # The kubernetes client is synchronous, keep it off the event loop
+        try:
+            with k8s_apply_duration.labels(kind=resource["kind"]).time():
+                result = await asyncio.to_thread(create, resource)
+        except Exception:
+            k8s_applies.labels(kind=resource["kind"], outcome="error").inc()
+            raise
+        k8s_applies.labels(kind=resource["kind"], outcome="applied").inc()
+        _applied_hashes[key] = (digest, time.monotonic())
+        if isinstance(result, dict) and "generation" in result.get("metadata", {}):
+            _applied_generations[key] = result["metadata"]["generation"]
+        return result
+
+    async def read(self, api_version: str, kind: str, namespace: str, name: str) -> dict[str, Any] | None:
+        """The live copy of a resource, None if it doesn't exist."""
+        return await asyncio.to_thread(self._read_resource, api_version, self.plural(kind), namespace, name)
+
+    async def delete(self, api_version: str, kind: str, namespace: str, name: str, logger: Logger) -> None:
+        """Delete a resource if it exists, forgetting it was applied so it is applied again if rendered again."""
+        key = (api_version, kind, namespace, name)
+        _applied_hashes.pop(key, None)
+        _applied_generations.pop(key, None)
+        if await asyncio.to_thread(self._delete_resource, api_version, self.plural(kind), namespace, name):
+            logger.info(f"Deleted {kind} {name}")
+
+    async def drifted(self, resource: dict[str, Any], namespace: str) -> bool:
+        """Whether the live copy of a rendered resource differs from it.
+
+        Rather than comparing whole objects, which the API server fills with
+        defaults, this compares a fingerprint: the render hash it was applied
+        with, its generation (bumped by any edit to its spec) and, for kinds
+        without a spec, its data.
+        """
+        namespace = resource.get("metadata", {}).get("namespace") or namespace
+        key = (resource["apiVersion"], resource["kind"], namespace, resource["metadata"]["name"])
+        live = await self.read(*key)
+        if live is None:
+            return True
+        metadata = live.get("metadata", {})
+        if (metadata.get("annotations") or {}).get(RENDER_HASH_ANNOTATION) != render_hash(resource):
+            return True
+        if key in _applied_generations and metadata.get("generation") != _applied_generations[key]:
+            return True
+        return "data" in resource and live.get("data") != resource["data"]
+
+    async def apply_all(self, namespace: str, logger: Logger, *resources: dict[str, Any], force: bool = False) -> None:
+        """Apply independent resources concurrently, see apply."""
+        await asyncio.gather(*(self.apply(resource, namespace, logger, force) for resource in resources))
+
+    async def deploy(
+        self,
+        template_name: str,
+        namespace: str,
+        version: str,
+        logger: Logger,
+        owner: dict[str, Any] | None = None,
+        force: bool = False,
+        **extra_variables,
+    ) -> None:
+        with span("deployer deploy", **{"deployer.template": template_name, "k8s.namespace": namespace}):
+            return await self.apply(self.prepare(template_name, namespace, version, owner=owner, **extra_variables), namespace, logger, force)
+
+
+deployer = Deployer()
+
+
+@kopf.on.startup()
+async def compile_templates(logger: Logger, **kwargs):
+    count = deployer.compile_templates()
+    logger.info(f"Compiled {count} deployment templates")
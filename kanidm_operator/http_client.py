@@ -0,0 +1,287 @@
+"""
+Backend talking to the kanidm REST API directly.
+
+All clients share one keep-alive connection pool, so a reconcile costs a few
+HTTP requests on already established TLS connections rather than a process
+spawn, TLS handshake and token file round-trip per call.
+"""
+
+import asyncio
+import os
+import ssl
+import time
+from typing import Any
+
+import aiohttp
+import kopf
+
+from kanidm_operator.client import KanidmClient
+from kanidm_operator.metrics import kanidm_request_duration, kanidm_requests
+from kanidm_operator.tracing import span
+
+# CA bundle used to verify kanidm, same variable as the kanidm CLI tool
+kanidm_ca_path = os.environ.get("KANIDM_CA_PATH")
+# Connection pool limits shared by every kanidm instance
+http_pool_size = int(os.environ.get("KANIDM_HTTP_POOL_SIZE", "32"))
+http_timeout = float(os.environ.get("KANIDM_HTTP_TIMEOUT", "30"))
+# Seconds to use the public URL for after kanidm's in-cluster services were unreachable
+internal_retry_interval = float(os.environ.get("KANIDM_INTERNAL_RETRY_INTERVAL", "60"))
+
+AUTH_SESSION_HEADER = "X-KANIDM-AUTH-SESSION-ID"
+
+_http_session: aiohttp.ClientSession | None = None
+# SSL contexts pinning the CA of each kanidm certificate, by CA
+_ssl_contexts: dict[str, ssl.SSLContext] = {}
+
+
+def pinned_ssl_context(ca: str) -> ssl.SSLContext:
+    if ca not in _ssl_contexts:
+        _ssl_contexts[ca] = ssl.create_default_context(cadata=ca)
+    return _ssl_contexts[ca]
+
+
+def http_session() -> aiohttp.ClientSession:
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=http_pool_size,
+                ssl=ssl.create_default_context(cafile=kanidm_ca_path),
+            ),
+            # Auth state is carried in headers, never share cookies between sessions
+            cookie_jar=aiohttp.DummyCookieJar(),
+            timeout=aiohttp.ClientTimeout(total=http_timeout),
+        )
+    return _http_session
+
+
+@kopf.on.cleanup()
+async def close_http_session(**kwargs):
+    global _http_session
+    if _http_session is not None:
+        await _http_session.close()
+        _http_session = None
+
+
+def http_operation(method: str, path: str) -> str:
+    """The endpoint of a kanidm REST call, e.g. "GET /v1/person/:name", without its arguments."""
+    parts = path.split("?", 1)[0].split("/")
+    # Entry names follow the kind, attribute names are part of the endpoint
+    return method + " " + "/".join(
+        part if index < 3 or part.startswith("_") or parts[index - 1] == "_attr" else ":name"
+        for index, part in enumerate(parts)
+    )
+
+
+class KanidmHTTPClient(KanidmClient):
+    backend = "http"
+
+    def _route(self, method: str, internal: bool = True) -> tuple[str, dict[str, Any]]:
+        """Base URL and TLS settings to send a request with.
+
+        Requests go to the in-cluster services when possible, with reads
+        spread over the read replicas, and to the public URL otherwise.
+        """
+        session = self.session
+        if not internal or session.internal_url is None or time.monotonic() < session.internal_unreachable_until:
+            return session.url, {}
+        options = {}
+        if session.server_hostname is not None:
+            options["server_hostname"] = session.server_hostname
+        if session.ca is not None:
+            options["ssl"] = pinned_ssl_context(session.ca)
+        if method == "GET" and session.read_url is not None:
+            return session.read_url, options
+        return session.internal_url, options
+
+    async def _send(self, method: str, path: str, body: Any = None, headers: dict[str, str] | None = None, writer: bool = False) -> tuple[int, Any, dict]:
+        url, options = self._route("POST" if writer else method)
+        try:
+            return await self._send_to(url, method, path, body, headers, options)
+        except aiohttp.ClientConnectorError as e:
+            # Only resent when the connection was never established, a request that
+            # timed out or lost its connection may have been applied, kopf retries it
+            if url == self.session.url:
+                raise
+            self.logger.warning(f"Kanidm is unreachable on {url} ({e}), using {self.session.url} for {internal_retry_interval}s")
+            self.session.internal_unreachable_until = time.monotonic() + internal_retry_interval
+            url, options = self._route(method, internal=False)
+            return await self._send_to(url, method, path, body, headers, options)
+
+    async def _send_to(self, url: str, method: str, path: str, body: Any, headers: dict[str, str] | None, options: dict[str, Any]) -> tuple[int, Any, dict]:
+        self.calls += 1
+        operation = http_operation(method, path)
+        outcome = "error"
+        try:
+            async with self.limiter.slot():
+                with (
+                    kanidm_request_duration.labels(backend=self.backend, operation=operation).time(),
+                    span(f"kanidm {operation}", **{"kanidm.backend": self.backend, "kanidm.name": self.kanidm_name, "url.full": url + path}) as current,
+                ):
+                    async with http_session().request(method, url + path, json=body, headers=headers, **options) as response:
+                        if response.content_type == "application/json":
+                            data = await response.json()
+                        else:
+                            data = await response.text()
+                    if current is not None:
+                        current.set(**{"http.response.status_code": response.status})
+            outcome = "success" if response.status < 400 else "error"
+            return response.status, data, dict(response.headers)
+        finally:
+            kanidm_requests.labels(backend=self.backend, operation=operation, outcome=outcome).inc()
+
+    async def request(self, method: str, path: str, body: Any = None, missing_ok: bool = False) -> Any:
+        writer = False
+        relogged = False
+        while True:
+            logged_in_at = self.session.logged_in_at
+            try:
+                status, data, _ = await self._send(method, path, body, headers={"Authorization": f"Bearer {self.session.token}"}, writer=writer)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise kopf.TemporaryError(f"Failed to {method} {path} on kanidm ({e})", delay=10)
+            if status == 401 and method == "GET" and not writer and self.session.read_url is not None:
+                # A read replica may not have replicated a new session yet,
+                # ask the write replica before giving up on the session
+                writer = True
+                continue
+            if status == 401 and not relogged:
+                # The cached session was rejected (expired, revoked, or the
+                # server restarted), log in again and retry once
+                relogged = True
+                await self.relogin(logged_in_at)
+                continue
+            break
+
+        if status == 404 and missing_ok:
+            return None
+        if status >= 400:
+            raise kopf.TemporaryError(f"Failed to {method} {path} on kanidm ({status}), response={data}", delay=10)
+        return data
+
+    async def _authenticate(self):
+        steps = [
+            {"init2": {"username": self.session.username, "issue": "token", "privileged": True}},
+            {"begin": "password"},
+            {"cred": {"password": self.session.password}},
+        ]
+        headers = {}
+        try:
+            for step in steps:
+                status, data, response_headers = await self._send("POST", "/v1/auth", {"step": step}, headers=headers)
+                if status != 200 or not isinstance(data, dict):
+                    raise kopf.TemporaryError(f"Failed to login to kanidm ({status}), response={data}", delay=10)
+                if AUTH_SESSION_HEADER in response_headers:
+                    headers[AUTH_SESSION_HEADER] = response_headers[AUTH_SESSION_HEADER]
+                elif "sessionid" in data:
+                    headers[AUTH_SESSION_HEADER] = data["sessionid"]
+        except aiohttp.ClientError as e:
+            raise kopf.TemporaryError(f"Failed to login to kanidm ({e})", delay=10)
+
+        state = data.get("state", {})
+        if not isinstance(state, dict) or "success" not in state:
+            raise kopf.TemporaryError(f"Failed to login to kanidm, state={state}", delay=10)
+        self.session.token = state["success"]
+
+    async def _get_entry(self, path: str) -> dict | None:
+        # kanidm answers queries for missing entries with null, or a 404
+        return await self.request("GET", path, missing_ok=True) or None
+
+    async def _list_entries(self, path: str) -> list[dict]:
+        return await self.request("GET", path) or []
+
+    async def list_users(self) -> list[dict]:
+        return await self._list_entries("/v1/person")
+
+    async def get_user(self, username: str) -> dict | None:
+        return await self._get_entry(f"/v1/person/{username}")
+
+    async def _create_user(self, username: str, displayname: str):
+        await self.request("POST", "/v1/person", {"attrs": {"name": [username], "displayname": [displayname]}})
+
+    async def _update_user_displayname(self, username: str, displayname: str):
+        await self.request("PATCH", f"/v1/person/{username}", {"attrs": {"displayname": [displayname]}})
+
+    async def delete_user(self, username: str):
+        await self.request("DELETE", f"/v1/person/{username}")
+
+    async def set_user_emails(self, username: str, emails: list[str]):
+        await self.request("PUT", f"/v1/person/{username}/_attr/mail", emails)
+
+    async def list_groups(self) -> list[dict]:
+        return await self._list_entries("/v1/group")
+
+    async def get_group(self, name: str) -> dict | None:
+        return await self._get_entry(f"/v1/group/{name}")
+
+    async def _create_group(self, name: str):
+        await self.request("POST", "/v1/group", {"attrs": {"name": [name]}})
+
+    async def set_group_members(self, name: str, members: list[str]):
+        await self.request("PUT", f"/v1/group/{name}/_attr/member", members)
+
+    async def add_group_members(self, name: str, members: list[str]):
+        await self.request("POST", f"/v1/group/{name}/_attr/member", members)
+
+    async def remove_group_members(self, name: str, members: list[str]):
+        await self.request("DELETE", f"/v1/group/{name}/_attr/member", members)
+
+    async def delete_group(self, name: str):
+        await self.request("DELETE", f"/v1/group/{name}")
+
+    async def list_oauth2clients(self) -> list[dict]:
+        return await self._list_entries("/v1/oauth2")
+
+    async def get_oauth2client(self, name: str) -> dict | None:
+        return await self._get_entry(f"/v1/oauth2/{name}")
+
+    async def _create_oauth2client(self, name: str, displayname: str, origin: str):
+        await self.request("POST", "/v1/oauth2/_basic", {"attrs": {
+            "oauth2_rs_name": [name],
+            "displayname": [displayname],
+            "oauth2_rs_origin": [origin],
+        }})
+
+    async def get_oauth2client_secret(self, name: str) -> str:
+        secret = await self.request("GET", f"/v1/oauth2/{name}/_basic_secret")
+        if not secret:
+            raise kopf.TemporaryError(f"No basic secret returned for oauth2 client {name}", delay=10)
+        return secret.strip()
+
+    async def reset_oauth2client_secret(self, name: str):
+        # Purging the secret has kanidm generate a new one, as `kanidm system oauth2 reset-secrets` does
+        await self._update_oauth2client(name, {"oauth2_rs_basic_secret": []})
+
+    async def _update_oauth2client(self, name: str, attrs: dict[str, list[str]]):
+        await self.request("PATCH", f"/v1/oauth2/{name}", {"attrs": attrs})
+
+    async def set_oauth2client_prefer_short_username(self, name: str):
+        await self._update_oauth2client(name, {"oauth2_prefer_short_username": ["true"]})
+
+    async def set_oauth2client_pkce(self, name: str, enabled: bool):
+        await self._update_oauth2client(name, {"oauth2_allow_insecure_client_disable_pkce": [] if enabled else ["true"]})
+
+    async def set_oauth2client_landing_url(self, name: str, url: str):
+        await self._update_oauth2client(name, {"oauth2_rs_origin_landing": [url]})
+
+    async def update_oauth2client(
+        self,
+        name: str,
+        prefer_short_username: bool | None = None,
+        pkce: bool | None = None,
+        landing_url: str | None = None,
+    ):
+        attrs = {}
+        if prefer_short_username:
+            attrs["oauth2_prefer_short_username"] = ["true"]
+        if pkce is not None:
+            attrs["oauth2_allow_insecure_client_disable_pkce"] = [] if pkce else ["true"]
+        if landing_url is not None:
+            attrs["oauth2_rs_origin_landing"] = [landing_url]
+        if attrs:
+            await self._update_oauth2client(name, attrs)
+
+    async def update_oauth2client_scope_map(self, name: str, group: str, scopes: list[str]):
+        await self.request("POST", f"/v1/oauth2/{name}/_scopemap/{group}", scopes)
+
+    async def delete_oauth2client(self, name: str):
+        await self.request("DELETE", f"/v1/oauth2/{name}")
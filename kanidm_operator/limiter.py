@@ -0,0 +1,75 @@
+"""
+Bounds the operations in flight against each kanidm instance.
+
+kopf runs handlers for many users, groups and oauth2 clients at once, and
+without a bound a mass import turns into as many concurrent CLI processes or
+REST calls against the one kanidm server. Every kanidm request of every
+client goes through the limiter of its instance, so the bound holds across
+handlers.
+"""
+
+import asyncio
+import contextlib
+import os
+import time
+from typing import AsyncIterator
+
+from prometheus_client import Gauge, Histogram
+
+# Operations in flight against each kanidm instance, unless its spec sets maxConcurrentOperations
+max_concurrent_operations = int(os.environ.get("KANIDM_MAX_CONCURRENT_OPERATIONS", "8"))
+
+InstanceKey = tuple[str, str]
+
+kanidm_queue_wait = Histogram(
+    "kanidm_operator_kanidm_queue_wait_seconds",
+    "Time operations waited for a free slot on their kanidm instance",
+    ("namespace", "kanidm"),
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
+kanidm_operations_waiting = Gauge("kanidm_operator_kanidm_operations_waiting", "Operations waiting for a free slot on their kanidm instance", ("namespace", "kanidm"))
+kanidm_operations_in_flight = Gauge("kanidm_operator_kanidm_operations_in_flight", "Operations in flight against each kanidm instance", ("namespace", "kanidm"))
+
+
+class InstanceLimiter:
+    def __init__(self, key: InstanceKey, limit: int):
+        self.key = key
+        self.limit = limit
+        self.semaphore = asyncio.Semaphore(limit)
+
+    @contextlib.asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        namespace, kanidm = self.key
+        kanidm_operations_waiting.labels(namespace=namespace, kanidm=kanidm).inc()
+        started = time.perf_counter()
+        try:
+            await self.semaphore.acquire()
+        finally:
+            kanidm_operations_waiting.labels(namespace=namespace, kanidm=kanidm).dec()
+        kanidm_queue_wait.labels(namespace=namespace, kanidm=kanidm).observe(time.perf_counter() - started)
+        kanidm_operations_in_flight.labels(namespace=namespace, kanidm=kanidm).inc()
+        try:
+            yield
+        finally:
+            kanidm_operations_in_flight.labels(namespace=namespace, kanidm=kanidm).dec()
+            self.semaphore.release()
+
+
+_limiters: dict[InstanceKey, InstanceLimiter] = {}
+
+
+def instance_limiter(namespace: str, kanidm_name: str, limit: int | None = None) -> InstanceLimiter:
+    """The limiter shared by every client of a kanidm instance.
+
+    Without a limit, the instance's current limiter is returned as is. A
+    changed limit takes effect for new operations straight away, the ones
+    already holding a slot of the previous limiter finish undisturbed.
+    """
+    key = (namespace, kanidm_name)
+    limiter = _limiters.get(key)
+    if limit is None and limiter is not None:
+        return limiter
+    limit = max(1, limit or max_concurrent_operations)
+    if limiter is None or limiter.limit != limit:
+        limiter = _limiters[key] = InstanceLimiter(key, limit)
+    return limiter
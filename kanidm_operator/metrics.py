@@ -0,0 +1,145 @@
+"""
+Operator health and performance metrics, served in the Prometheus text format
+on /metrics.
+
+The event loop lag is the delay between when a timer was due and when the
+event loop got around to running it. Every handler shares the one kopf event
+loop, so any blocking call in a handler shows up here as lag.
+"""
+
+import asyncio
+import functools
+import logging
+import os
+import time
+from typing import Awaitable, Callable
+from wsgiref.simple_server import WSGIServer
+
+import kopf
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram, start_http_server
+
+from kanidm_operator.tracing import span
+
+# How often the event loop lag is sampled, in seconds
+lag_sample_interval = float(os.environ.get("KANIDM_OPERATOR_LAG_INTERVAL", "0.5"))
+# Lag above which a warning is logged, as it means handlers are being starved
+lag_warning_threshold = float(os.environ.get("KANIDM_OPERATOR_LAG_WARNING", "1.0"))
+# Port /metrics is served on, 0 to disable it
+metrics_port = int(os.environ.get("KANIDM_OPERATOR_METRICS_PORT", "9090"))
+
+logger = logging.getLogger(__name__)
+
+# Buckets of the duration histograms, kanidm CLI commands can take tens of seconds
+duration_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def sample_value(name: str, **labels: str) -> float:
+    """Current value of a sample in the default registry, 0 if it was never recorded."""
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+event_loop_lag = Gauge("kanidm_operator_event_loop_lag_seconds", "Most recently measured event loop lag")
+event_loop_lag_max = Gauge("kanidm_operator_event_loop_lag_max_seconds", "Largest event loop lag measured since startup")
+
+handler_duration = Histogram("kanidm_operator_handler_duration_seconds", "Time taken by each kopf handler", ("handler", "outcome"), buckets=duration_buckets)
+handlers_in_progress = Gauge("kanidm_operator_handlers_in_progress", "Handlers currently running, i.e. the depth of the work queue", ("handler",))
+kanidm_requests = Counter("kanidm_operator_kanidm_requests_total", "Requests made to kanidm, CLI commands or REST calls", ("backend", "operation", "outcome"))
+kanidm_request_duration = Histogram("kanidm_operator_kanidm_request_duration_seconds", "Time taken by requests to kanidm", ("backend", "operation"), buckets=duration_buckets)
+kanidm_logins = Counter("kanidm_operator_kanidm_logins_total", "Logins to kanidm", ("backend", "outcome"))
+k8s_applies = Counter("kanidm_operator_k8s_applies_total", "Kubernetes resources applied by the Deployer, or skipped as unchanged", ("kind", "outcome"))
+k8s_apply_duration = Histogram("kanidm_operator_k8s_apply_duration_seconds", "Time taken to apply a kubernetes resource", ("kind",), buckets=duration_buckets)
+
+
+def instrumented(handler: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+    """Record the duration and concurrency of an async kopf handler, and trace it.
+
+    Goes below the kopf decorators, which then register the wrapper under the
+    handler's own name.
+    """
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        handlers_in_progress.labels(handler=name).inc()
+        outcome = "error"
+        started = time.perf_counter()
+        try:
+            with span(
+                f"handler {name}",
+                **{
+                    "k8s.kind": (kwargs.get("body") or {}).get("kind"),
+                    "k8s.namespace": kwargs.get("namespace"),
+                    "k8s.name": kwargs.get("name"),
+                },
+            ):
+                result = await handler(*args, **kwargs)
+            outcome = "success"
+            return result
+        except kopf.TemporaryError:
+            outcome = "retry"
+            raise
+        finally:
+            handler_duration.labels(handler=name, outcome=outcome).observe(time.perf_counter() - started)
+            handlers_in_progress.labels(handler=name).dec()
+
+    return wrapper
+
+
+async def monitor_event_loop_lag(interval: float = lag_sample_interval):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - started - interval)
+        event_loop_lag.set(lag)
+        if lag > sample_value("kanidm_operator_event_loop_lag_max_seconds"):
+            event_loop_lag_max.set(lag)
+        if lag > lag_warning_threshold:
+            logger.warning(f"Event loop was blocked for {lag:.2f}s, handlers are being delayed")
+
+
+_lag_monitor: asyncio.Task | None = None
+
+
+@kopf.on.startup()
+async def start_lag_monitor(**kwargs):
+    global _lag_monitor
+    _lag_monitor = asyncio.create_task(monitor_event_loop_lag())
+
+
+@kopf.on.cleanup()
+async def stop_lag_monitor(**kwargs):
+    global _lag_monitor
+    if _lag_monitor is not None:
+        _lag_monitor.cancel()
+        _lag_monitor = None
+
+
+_metrics_server: WSGIServer | None = None
+
+
+@kopf.on.startup()
+async def start_metrics_server(logger: logging.Logger, **kwargs):
+    global _metrics_server
+    if metrics_port == 0:
+        return
+    # Served from a thread of its own, so scrapes don't wait on the event loop
+    _metrics_server, _ = start_http_server(metrics_port)
+    logger.info(f"Serving metrics on port {metrics_port}")
+
+
+@kopf.on.cleanup()
+async def stop_metrics_server(**kwargs):
+    global _metrics_server
+    if _metrics_server is not None:
+        _metrics_server.shutdown()
+        _metrics_server.server_close()
+        _metrics_server = None
+
+
+@kopf.on.probe(id="event_loop_lag")
+def event_loop_lag_probe(**kwargs):
+    return {
+        "seconds": sample_value("kanidm_operator_event_loop_lag_seconds"),
+        "max_seconds": sample_value("kanidm_operator_event_loop_lag_max_seconds"),
+    }
@@ -0,0 +1,112 @@
+"""
+Process-wide cache of authenticated kanidm sessions.
+
+Establishing a session needs the credentials secret and a full login, so
+sessions are shared between every handler. A cached session is reused until it
+is older than its TTL (at which point the client logs in again with the stored
+credentials) or it is evicted, after which the next client fetches the
+credentials from scratch.
+"""
+
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Callable
+
+# How long a login is trusted before we proactively log in again. Kanidm drops
+# the read-write privileges of a session after 15 minutes by default.
+session_ttl = float(os.environ.get("KANIDM_SESSION_TTL", "600"))
+# Maximum number of (kanidmName, namespace, username) sessions kept around.
+session_cache_size = int(os.environ.get("KANIDM_SESSION_CACHE_SIZE", "128"))
+
+SessionKey = tuple[str, str, str]
+
+
+class KanidmSession:
+    def __init__(
+        self,
+        url: str,
+        username: str,
+        password: str,
+        ttl: float = session_ttl,
+        internal_url: str | None = None,
+        read_url: str | None = None,
+        server_hostname: str | None = None,
+        ca: str | None = None,
+    ):
+        # Public URL of kanidm, used by the CLI and when the internal one is unreachable
+        self.url = url
+        # In-cluster service of the write replica, and of all replicas for reads
+        self.internal_url = internal_url
+        self.read_url = read_url
+        # Name the in-cluster services' certificate is issued for, and its CA
+        self.server_hostname = server_hostname
+        self.ca = ca
+        # Until when (monotonic) the in-cluster services are considered unreachable
+        self.internal_unreachable_until = 0.0
+        self.username = username
+        self.password = password
+        self.ttl = ttl
+        self.logged_in_at: float | None = None
+        # Bearer token, only used by the HTTP backend (the CLI keeps its own)
+        self.token: str | None = None
+        # Serialises logins so concurrent handlers don't all log in at once
+        self.lock = asyncio.Lock()
+
+    @property
+    def env(self) -> dict[str, str]:
+        return dict(
+            KANIDM_URL=self.url,
+            KANIDM_NAME=self.username,
+            KANIDM_PASSWORD=self.password,
+        )
+
+    @property
+    def valid(self) -> bool:
+        return self.logged_in_at is not None and time.monotonic() - self.logged_in_at < self.ttl
+
+    def mark_logged_in(self):
+        self.logged_in_at = time.monotonic()
+
+    def invalidate(self):
+        self.logged_in_at = None
+        self.token = None
+
+
+class SessionCache:
+    """LRU cache of sessions keyed by (kanidmName, namespace, username)."""
+
+    def __init__(self, max_size: int = session_cache_size):
+        self.max_size = max_size
+        self._sessions: OrderedDict[SessionKey, KanidmSession] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get(self, key: SessionKey) -> KanidmSession | None:
+        session = self._sessions.get(key)
+        if session is not None:
+            self._sessions.move_to_end(key)
+        return session
+
+    def put(self, key: SessionKey, session: KanidmSession):
+        self._sessions[key] = session
+        self._sessions.move_to_end(key)
+        while len(self._sessions) > self.max_size:
+            self._sessions.popitem(last=False)
+
+    def evict(self, key: SessionKey) -> KanidmSession | None:
+        return self._sessions.pop(key, None)
+
+    def evict_where(self, predicate: Callable[[SessionKey, KanidmSession], bool]) -> int:
+        stale = [key for key, session in self._sessions.items() if predicate(key, session)]
+        for key in stale:
+            del self._sessions[key]
+        return len(stale)
+
+    def clear(self):
+        self._sessions.clear()
+
+
+sessions = SessionCache()
@@ -0,0 +1,20 @@
+"""
+Tuning of kopf itself, applied once on startup.
+"""
+
+import os
+from logging import Logger
+
+import kopf
+
+# Seconds of quiet kopf waits for after an event on a resource before handling
+# it, bursts of edits within it are handled once, from the latest one
+coalesce_window = float(os.environ.get("KANIDM_COALESCE_WINDOW", "1.0"))
+
+
+@kopf.on.startup()
+async def configure_operator(settings: kopf.OperatorSettings, logger: Logger, **kwargs):
+    # Field handlers diff the last handled spec against the latest one, so the
+    # skipped intermediate edits are still applied by the one reconcile
+    settings.batching.batch_window = coalesce_window
+    logger.info(f"Coalescing edits to the same resource within {coalesce_window}s")
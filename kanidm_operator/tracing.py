@@ -0,0 +1,177 @@
+"""
+Tracing spans around each step of a reconcile: the handler, the kanidm
+client's connect, login and requests, and the Deployer's renders and applies.
+
+Spans follow the OpenTelemetry data model and are exported in batches as
+OTLP/JSON, to a collector (OTEL_EXPORTER_OTLP_ENDPOINT) and/or appended to a
+file, one span per line (KANIDM_TRACE_FILE). Tracing is off unless one of the
+two is set.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import secrets
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Iterator
+
+import aiohttp
+import kopf
+
+# OTLP/HTTP collector to send spans to, e.g. http://otel-collector:4318
+otlp_endpoint = os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT")
+# File to append spans to, one OTLP/JSON span per line
+trace_file = os.environ.get("KANIDM_TRACE_FILE")
+# Seconds between span exports
+trace_export_interval = float(os.environ.get("KANIDM_TRACE_EXPORT_INTERVAL", "5"))
+# Finished spans kept until the next export, the oldest are dropped beyond it
+trace_buffer_size = int(os.environ.get("KANIDM_TRACE_BUFFER_SIZE", "10000"))
+
+tracing_enabled = bool(otlp_endpoint or trace_file)
+
+SERVICE_NAME = "kanidm-operator"
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: str | None
+    attributes: dict[str, Any] = field(default_factory=dict)
+    start_ns: int = field(default_factory=time.time_ns)
+    end_ns: int | None = None
+    error: str | None = None
+
+    @property
+    def duration(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+    def set(self, **attributes: Any):
+        self.attributes.update(attributes)
+
+    def to_otlp(self) -> dict[str, Any]:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [otlp_attribute(key, value) for key, value in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error is not None else {"code": 1},
+        }
+        if self.parent_id is not None:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def otlp_attribute(key: str, value: Any) -> dict[str, Any]:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+_current_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar("kanidm_operator_span", default=None)
+_finished: deque[Span] = deque(maxlen=trace_buffer_size)
+
+
+def current_span() -> Span | None:
+    return _current_span.get()
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Span | None]:
+    """Trace the enclosed block as a child of the current span.
+
+    Tasks inherit the current span when they are created, so work gathered
+    from a handler is attributed to it.
+    """
+    if not tracing_enabled:
+        yield None
+        return
+    parent = _current_span.get()
+    current = Span(
+        name,
+        trace_id=parent.trace_id if parent is not None else secrets.token_hex(16),
+        span_id=secrets.token_hex(8),
+        parent_id=parent.span_id if parent is not None else None,
+        attributes={key: value for key, value in attributes.items() if value is not None},
+    )
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current.end_ns = time.time_ns()
+        _current_span.reset(token)
+        _finished.append(current)
+
+
+def otlp_payload(spans: list[Span]) -> dict[str, Any]:
+    return {"resourceSpans": [{
+        "resource": {"attributes": [otlp_attribute("service.name", SERVICE_NAME)]},
+        "scopeSpans": [{"scope": {"name": "kanidm_operator"}, "spans": [s.to_otlp() for s in spans]}],
+    }]}
+
+
+def write_spans(path: str, spans: list[Span]):
+    with open(path, "a", encoding="utf-8") as f:
+        for s in spans:
+            f.write(json.dumps(s.to_otlp()) + "\n")
+
+
+async def export_spans():
+    """Export the spans finished since the last export."""
+    spans = list(_finished)
+    _finished.clear()
+    if not spans:
+        return
+    if trace_file:
+        await asyncio.to_thread(write_spans, trace_file, spans)
+    if otlp_endpoint:
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.post(f"{otlp_endpoint.rstrip('/')}/v1/traces", json=otlp_payload(spans)) as response:
+                    if response.status >= 400:
+                        logger.warning(f"Failed to export {len(spans)} spans ({response.status})")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Failed to export {len(spans)} spans ({e})")
+
+
+async def export_spans_periodically(interval: float = trace_export_interval):
+    while True:
+        await asyncio.sleep(interval)
+        await export_spans()
+
+
+_exporter: asyncio.Task | None = None
+
+
+@kopf.on.startup()
+async def start_span_exporter(**kwargs):
+    global _exporter
+    if tracing_enabled:
+        _exporter = asyncio.create_task(export_spans_periodically())
+
+
+@kopf.on.cleanup()
+async def stop_span_exporter(**kwargs):
+    global _exporter
+    if _exporter is not None:
+        _exporter.cancel()
+        _exporter = None
+        await export_spans()
@@ -64,3 +64,4 @@ class KanidmResource(TypedDict):
     highAvailability: HighAvailabilityResource
     certificate: CertificateResource
     ingress: IngressResource
+    maxConcurrentOperations: int | None
@@ -0,0 +1,30 @@
+import pytest
+
+from kanidm_operator import dependencies, limiter
+from kanidm_operator.deployer import reset_cache
+
+
+@pytest.fixture(autouse=True)
+def render_cache():
+    # The render cache is process wide, don't let one test's applies skip another's
+    reset_cache()
+    yield
+    reset_cache()
+
+
+@pytest.fixture(autouse=True)
+def instance_limiters():
+    # Each test runs its own event loop, which the limiters' semaphores are bound to
+    limiter._limiters.clear()
+    yield
+    limiter._limiters.clear()
+
+
+@pytest.fixture(autouse=True)
+def dependency_state():
+    # Entries marked created by one test would satisfy another's dependencies
+    dependencies._created.clear()
+    dependencies._waiters.clear()
+    yield
+    dependencies._created.clear()
+    dependencies._waiters.clear()
@@ -0,0 +1,187 @@
+"""
+A minimal in-memory stand-in for the kanidm REST API, enough to exercise the
+operator's HTTP backend without a kanidm server.
+"""
+
+import asyncio
+import secrets
+from collections import Counter
+
+from aiohttp import web
+
+
+class KanidmStub:
+    def __init__(self, username: str = "idm_admin", password: str = "password"):
+        self.credentials = {username: password}
+        self.auth_sessions: dict[str, str] = {}
+        self.tokens: set[str] = set()
+        self.entries: dict[str, dict[str, dict[str, list[str]]]] = {"person": {}, "group": {}, "oauth2": {}}
+        self.secrets: dict[str, str] = {}
+        self.requests: Counter[str] = Counter()
+        # Seconds each request takes, and the most requests seen in flight at once
+        self.delay = 0.0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        # Reject members that don't exist, as kanidm's referential integrity does
+        self.referential_integrity = False
+        self.app = web.Application(middlewares=[self.count_and_authorize])
+        self.app.add_routes([
+            web.post("/v1/auth", self.auth),
+            web.get("/v1/{kind}", self.list_entries),
+            web.post("/v1/oauth2/_basic", self.create_oauth2),
+            web.post("/v1/{kind}", self.create),
+            web.get("/v1/oauth2/{name}/_basic_secret", self.basic_secret),
+            web.post("/v1/oauth2/{name}/_scopemap/{group}", self.scope_map),
+            web.get("/v1/{kind}/{name}", self.get),
+            web.patch("/v1/{kind}/{name}", self.patch),
+            web.delete("/v1/{kind}/{name}", self.delete),
+            web.put("/v1/{kind}/{name}/_attr/{attr}", self.set_attr),
+            web.post("/v1/{kind}/{name}/_attr/{attr}", self.add_attr),
+            web.delete("/v1/{kind}/{name}/_attr/{attr}", self.remove_attr),
+        ])
+        self.runner: web.AppRunner | None = None
+        self.url: str | None = None
+
+    async def start(self) -> str:
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self.url
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    def revoke_tokens(self):
+        self.tokens.clear()
+
+    @web.middleware
+    async def count_and_authorize(self, request: web.Request, handler):
+        self.requests[request.method] += 1
+        if request.path != "/v1/auth":
+            token = request.headers.get("Authorization", "").removeprefix("Bearer ")
+            if token not in self.tokens:
+                return web.json_response("notauthenticated", status=401)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+            return await handler(request)
+        finally:
+            self.in_flight -= 1
+
+    async def auth(self, request: web.Request):
+        step = (await request.json())["step"]
+        if "init2" in step:
+            session_id = secrets.token_hex(8)
+            self.auth_sessions[session_id] = step["init2"]["username"]
+            return web.json_response(
+                {"sessionid": session_id, "state": {"choose": ["password"]}},
+                headers={"X-KANIDM-AUTH-SESSION-ID": session_id},
+            )
+        username = self.auth_sessions.get(request.headers.get("X-KANIDM-AUTH-SESSION-ID"))
+        if username is None:
+            return web.json_response("invalidsession", status=401)
+        if "begin" in step:
+            return web.json_response({"state": {"continue": ["password"]}})
+        if step["cred"]["password"] != self.credentials.get(username):
+            return web.json_response({"state": {"denied": "incorrect password"}})
+        token = secrets.token_hex(16)
+        self.tokens.add(token)
+        return web.json_response({"state": {"success": token}})
+
+    def _entries(self, request: web.Request) -> dict[str, dict[str, list[str]]]:
+        kind = request.match_info["kind"]
+        if kind not in self.entries:
+            raise web.HTTPNotFound()
+        return self.entries[kind]
+
+    async def list_entries(self, request: web.Request):
+        return web.json_response([{"attrs": attrs} for attrs in self._entries(request).values()])
+
+    async def get(self, request: web.Request):
+        attrs = self._entries(request).get(request.match_info["name"])
+        return web.json_response(None if attrs is None else {"attrs": attrs})
+
+    async def create(self, request: web.Request):
+        attrs = (await request.json())["attrs"]
+        entries = self._entries(request)
+        name = attrs["name"][0]
+        if name in entries:
+            return web.json_response("duplicate", status=409)
+        entries[name] = {k: list(v) for k, v in attrs.items()}
+        return web.json_response(None)
+
+    async def create_oauth2(self, request: web.Request):
+        attrs = (await request.json())["attrs"]
+        name = attrs["oauth2_rs_name"][0]
+        self.entries["oauth2"][name] = {k: list(v) for k, v in attrs.items()}
+        self.secrets[name] = secrets.token_hex(24)
+        return web.json_response(None)
+
+    async def basic_secret(self, request: web.Request):
+        return web.json_response(self.secrets.get(request.match_info["name"]))
+
+    async def scope_map(self, request: web.Request):
+        entry = self.entries["oauth2"].get(request.match_info["name"])
+        if entry is None:
+            raise web.HTTPNotFound()
+        scopes = await request.json()
+        group = request.match_info["group"]
+        entry.setdefault("oauth2_rs_scope_map", [])
+        entry["oauth2_rs_scope_map"] = [m for m in entry["oauth2_rs_scope_map"] if not m.startswith(f"{group}:")]
+        entry["oauth2_rs_scope_map"].append(f"{group}: {{{', '.join(scopes)}}}")
+        return web.json_response(None)
+
+    def _entry(self, request: web.Request) -> dict[str, list[str]]:
+        entry = self._entries(request).get(request.match_info["name"])
+        if entry is None:
+            raise web.HTTPNotFound()
+        return entry
+
+    async def patch(self, request: web.Request):
+        entry = self._entry(request)
+        attrs = (await request.json())["attrs"]
+        if attrs.pop("oauth2_rs_basic_secret", None) == []:
+            self.secrets[request.match_info["name"]] = secrets.token_hex(24)
+        for attr, values in attrs.items():
+            if values:
+                entry[attr] = list(values)
+            else:
+                entry.pop(attr, None)
+        return web.json_response(None)
+
+    async def delete(self, request: web.Request):
+        self._entry(request)
+        del self._entries(request)[request.match_info["name"]]
+        return web.json_response(None)
+
+    def _check_members(self, request: web.Request, values: list[str]):
+        if not self.referential_integrity or request.match_info["attr"] != "member":
+            return
+        for value in values:
+            name = value.split("@", 1)[0]
+            if name not in self.entries["person"] and name not in self.entries["group"]:
+                raise web.HTTPBadRequest(text='"refint"', content_type="application/json")
+
+    async def set_attr(self, request: web.Request):
+        values = list(await request.json())
+        self._check_members(request, values)
+        self._entry(request)[request.match_info["attr"]] = values
+        return web.json_response(None)
+
+    async def add_attr(self, request: web.Request):
+        added = await request.json()
+        self._check_members(request, added)
+        values = self._entry(request).setdefault(request.match_info["attr"], [])
+        values.extend(v for v in added if v not in values)
+        return web.json_response(None)
+
+    async def remove_attr(self, request: web.Request):
+        entry = self._entry(request)
+        removed = set(await request.json())
+        entry[request.match_info["attr"]] = [v for v in entry.get(request.match_info["attr"], []) if v not in removed]
+        return web.json_response(None)
@@ -0,0 +1,72 @@
+import asyncio
+import logging
+from base64 import b64encode
+
+from kanidm_operator.client import find_kanidm, kanidm_endpoints
+from kanidm_operator.deploy.credentials import on_credentials_event
+from kanidm_operator.deploy.util import parse_entries
+from kanidm_operator.http_client import KanidmHTTPClient
+from kanidm_operator.sessions import KanidmSession, sessions
+
+
+def test_find_kanidm_is_namespace_scoped():
+    kanidm_index = {
+        ("team-a", "kanidm"): [{"metadata": {"name": "kanidm", "namespace": "team-a"}, "spec": {"domain": "a.example.com"}}],
+        ("team-b", "kanidm"): [{"metadata": {"name": "kanidm", "namespace": "team-b"}, "spec": {"domain": "b.example.com"}}],
+    }
+    assert find_kanidm(kanidm_index, "team-b", "kanidm")["spec"]["domain"] == "b.example.com"
+    assert find_kanidm(kanidm_index, "team-c", "kanidm") is None
+
+
+def test_rotated_credentials_evict_sessions():
+    sessions.put(("kanidm", "team-a", "idm_admin"), KanidmSession("https://a.example.com", "idm_admin", "old"))
+    sessions.put(("kanidm", "team-b", "idm_admin"), KanidmSession("https://b.example.com", "idm_admin", "old"))
+    try:
+        asyncio.run(on_credentials_event(
+            type="MODIFIED",
+            namespace="team-a",
+            labels={"kanidm.github.io/credentials-for": "idm-admin"},
+            body={"data": {"password": b64encode(b"new").decode()}},
+            logger=logging.getLogger(__name__),
+        ))
+        assert sessions.get(("kanidm", "team-a", "idm_admin")) is None
+        assert sessions.get(("kanidm", "team-b", "idm_admin")) is not None
+    finally:
+        sessions.clear()
+
+
+def test_clients_of_an_instance_share_its_limiter():
+    kanidm = {"metadata": {"name": "kanidm", "namespace": "team-a"}, "spec": {"domain": "a.example.com", "maxConcurrentOperations": 3}}
+    kanidm_index = {("team-a", "kanidm"): [kanidm]}
+    credentials_index = {("team-a", "idm-admin"): [{"password": "password"}]}
+    # Already logged in, so connecting needs no kanidm
+    session = KanidmSession(username="idm_admin", password="password", **kanidm_endpoints(kanidm, "team-a", None))
+    session.mark_logged_in()
+    sessions.put(("kanidm", "team-a", "idm_admin"), session)
+    try:
+        async def connect():
+            client = KanidmHTTPClient("kanidm", "team-a", logging.getLogger(__name__))
+            await client.connect(kanidm_index, credentials_index, {})
+            return client
+
+        first, second = asyncio.run(connect()), asyncio.run(connect())
+        assert first.limiter is second.limiter
+        assert first.limiter.limit == 3
+    finally:
+        sessions.clear()
+
+
+def test_cli_entries_are_parsed_from_text_output():
+    output = "---\noauth2_rs_name: forgejo\noauth2_rs_scope_map: git-users: {\"openid\"}\noauth2_rs_origin: https://git.example.com\n---\noauth2_rs_name: grafana\n"
+    entries = parse_entries(output)
+    assert [e["attrs"]["oauth2_rs_name"] for e in entries] == [["forgejo"], ["grafana"]]
+    assert entries[0]["attrs"]["oauth2_rs_scope_map"] == ["git-users: {\"openid\"}"]
+    assert parse_entries("") == []
+
+
+def test_reads_stop_going_to_replicas_once_high_availability_is_disabled():
+    kanidm = {"metadata": {"name": "kanidm", "namespace": "team-a"}, "spec": {"domain": "a.example.com", "highAvailability": {"enabled": True, "replicas": 2}}}
+    assert kanidm_endpoints(kanidm, "team-a", None)["read_url"] == "https://kanidm-read-svc.team-a.svc:8443"
+    kanidm["spec"]["highAvailability"]["enabled"] = False
+    # Set rather than left out, so sessions cached with the read URL are replaced
+    assert kanidm_endpoints(kanidm, "team-a", None)["read_url"] is None
@@ -0,0 +1,43 @@
+import asyncio
+import logging
+
+from kanidm_operator import dependencies
+from kanidm_operator.dependencies import GROUP, USER, mark_created, pending, wait_for_members
+
+logger = logging.getLogger(__name__)
+
+
+def index(*names: str, processed: bool = False) -> dict:
+    return {("kanidm", "kanidm"): [{"name": name, "spec": {"name": name}, "processed": processed} for name in names]}
+
+
+def test_only_declared_resources_not_yet_created_are_waited_for():
+    user_index = index("anna", "bob")
+    mark_created("kanidm", "kanidm", USER, ["bob"])
+    # idm_admins is builtin, no resource declares it
+    assert pending("kanidm", "kanidm", USER, ["anna@idm.example.com", "bob", "idm_admins"], user_index) == ["anna@idm.example.com"]
+    assert pending("kanidm", "kanidm", USER, ["carol"], index("carol", processed=True)) == []
+
+
+def test_groups_are_woken_when_their_members_are_created():
+    async def scenario():
+        waiting = asyncio.create_task(wait_for_members(
+            "kanidm", "kanidm", ["dave", "git-users"], index("dave"), index("git-users"), logger,
+        ))
+        await asyncio.sleep(0.05)
+        mark_created("kanidm", "kanidm", USER, ["dave"])
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        mark_created("kanidm", "kanidm", GROUP, ["git-users"])
+        assert await asyncio.wait_for(waiting, 1)
+
+    asyncio.run(scenario())
+
+
+def test_waiting_gives_up_after_the_timeout():
+    async def scenario():
+        created = await dependencies.wait_for_created("kanidm", "kanidm", {USER: ["erin"]}, logger, timeout=0.05)
+        assert not created
+        assert not dependencies._waiters
+
+    asyncio.run(scenario())
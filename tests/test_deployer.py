@@ -0,0 +1,199 @@
+import asyncio
+import copy
+import logging
+import tomllib
+
+from kubernetes.client.exceptions import ApiException
+import kopf
+import pytest
+
+from kanidm_operator.deploy.drift import correct_workload_drift
+from kanidm_operator.deploy.kanidm import REPLICATION_CERTIFICATES_ANNOTATION, on_update_kanidms, prepare_instance, prepare_workloads, replica_origin, replication_topology, rollout_instance, writer_origin
+from kanidm_operator.deployer import RENDER_HASH_ANNOTATION, Deployer, deployer, render_hash
+
+logger = logging.getLogger(__name__)
+
+high_availability_spec = {
+    "version": "1.2.2",
+    "domain": "idm.example.com",
+    "webPort": 8443,
+    "ldapPort": 3890,
+    "certificate": {"issuer": "letsencrypt"},
+    "database": {"fsType": "other", "arcSize": 2048, "storageClass": "standard", "storageSize": "1Gi"},
+    "backup": {"enabled": False, "schedule": "", "versions": 7, "storageClass": "standard", "storageSize": "1Gi"},
+    "ingress": {"enabled": False, "trustXForwardedFor": False},
+    "highAvailability": {"enabled": True, "replicas": 2},
+}
+
+
+class RecordingApiClient:
+    def __init__(self):
+        self.calls = []
+        # Applied resources by path, as the API server would return them
+        self.live = {}
+
+    def call_api(self, path, method, **kwargs):
+        if method == "GET":
+            if path not in self.live:
+                raise ApiException(status=404)
+            return copy.deepcopy(self.live[path])
+        if method == "DELETE":
+            if path not in self.live:
+                raise ApiException(status=404)
+            self.calls.append((path, method, kwargs))
+            return self.live.pop(path)
+        self.calls.append((path, method, kwargs))
+        self.live[path] = copy.deepcopy(kwargs["body"])
+        return kwargs["body"]
+
+
+def test_resources_are_server_side_applied():
+    deployer = Deployer(RecordingApiClient())
+
+    config = deployer.render("server.toml", "kanidm", "1.1.0", domain="idm.example.com", log_level="info", ldap_port=3890, http_port=8443,
+        db_fs_type="other", db_arc_size=2048, backup_enabled=False, backup_schedule="", backup_versions=7,
+        trust_x_forwarded_for=False, role="WriteReplica")
+    certificate = deployer.render("certificate.yaml", "kanidm", "1.1.0", hostname="idm.example.com", certificate_issuer="letsencrypt")
+    for resource in [config, certificate]:
+        deployer.create_resource_factory(resource["apiVersion"], resource["kind"], "kanidm")(resource)
+
+    (config_path, method, kwargs), (certificate_path, _, _) = deployer.api_client.calls
+    assert method == "PATCH"
+    assert config_path == f"/api/v1/namespaces/kanidm/configmaps/{config['metadata']['name']}"
+    assert certificate_path == f"/apis/cert-manager.io/v1/namespaces/kanidm/certificates/{certificate['metadata']['name']}"
+    assert kwargs["header_params"]["Content-Type"] == "application/apply-patch+yaml"
+    assert ("fieldManager", "kanidm-operator") in kwargs["query_params"]
+    assert ("force", "false") in kwargs["query_params"]
+    server_config = tomllib.loads(config["data"]["server.toml"])
+    assert (server_config["db_fs_type"], server_config["db_arc_size"]) == ("other", 2048)
+
+
+def test_conflicting_applies_are_retried():
+    class ConflictingApiClient:
+        def call_api(self, path, method, **kwargs):
+            raise ApiException(status=409)
+
+    deployer = Deployer(ConflictingApiClient())
+    service = deployer.render("service.yaml", "kanidm", "1.1.0", http_port=8443, ldap_port=3890)
+    with pytest.raises(kopf.TemporaryError, match="owned by another manager"):
+        asyncio.run(deployer.apply(service, "kanidm", logger))
+
+
+def test_unchanged_resources_are_not_applied_again():
+    deployer = Deployer(RecordingApiClient())
+
+    def render(port):
+        return deployer.render("service.yaml", "kanidm", "1.1.0", http_port=port, ldap_port=3890)
+
+    asyncio.run(deployer.apply(render(8443), "kanidm", logger))
+    asyncio.run(deployer.apply(render(8443), "kanidm", logger))
+    assert len(deployer.api_client.calls) == 1
+    applied = deployer.api_client.calls[0][2]["body"]
+    assert applied["metadata"]["annotations"][RENDER_HASH_ANNOTATION] == render_hash(render(8443))
+
+    asyncio.run(deployer.apply(render(9443), "kanidm", logger))
+    assert len(deployer.api_client.calls) == 2
+
+
+def test_replica_configs_pin_partner_certificates():
+    writer, readers = replication_topology("kanidm", 2, {
+        writer_origin("kanidm"): "writer-certificate",
+        replica_origin("kanidm", 0): "replica-0-certificate",
+    })
+    deployer = Deployer(RecordingApiClient())
+    variables = dict(domain="idm.example.com", log_level="info", ldap_port=3890, http_port=8443,
+        trust_x_forwarded_for=False, replication_port=8444)
+
+    writer_config = tomllib.loads(deployer.render("server.toml", "kanidm", "1.2.2", role="WriteReplica",
+        replication=writer, **variables)["data"]["server.toml"])
+    # Replica 1 has no certificate yet, so isn't a partner yet
+    assert writer_config["replication"] == {
+        "origin": writer_origin("kanidm"),
+        "bindaddress": "0.0.0.0:8444",
+        replica_origin("kanidm", 0): {"type": "allow-pull", "consumer_cert": "replica-0-certificate"},
+    }
+
+    replica_configs = deployer.render("replica-config.yaml", "kanidm", "1.2.2", role="ReadOnlyReplica",
+        replicas=readers, **variables)["data"]
+    assert sorted(replica_configs) == ["kanidm-replica-0.toml", "kanidm-replica-1.toml"]
+    replica_config = tomllib.loads(replica_configs["kanidm-replica-1.toml"])
+    assert replica_config["role"] == "ReadOnlyReplica"
+    assert replica_config["replication"][writer_origin("kanidm")] == {
+        "type": "pull", "supplier_cert": "writer-certificate", "automatic_refresh": True,
+    }
+
+
+def test_high_availability_workloads_are_applied(monkeypatch):
+    monkeypatch.setattr(deployer, "_api_client", RecordingApiClient())
+    # Rendered outside of a handler, there is no object being handled to adopt them
+    monkeypatch.setattr(kopf, "adopt", lambda resource, owner=None: None)
+
+    configs, workloads = prepare_workloads(high_availability_spec, "kanidm", "kanidm")
+    asyncio.run(deployer.apply_all("kanidm", logger, *configs))
+    asyncio.run(deployer.apply_all("kanidm", logger, *workloads))
+
+    paths = [path for path, _, _ in deployer.api_client.calls]
+    assert "/apis/apps/v1/namespaces/kanidm/deployments/kanidm" in paths
+    assert "/apis/apps/v1/namespaces/kanidm/statefulsets/kanidm-replica" in paths
+
+
+def test_drift_is_detected_by_fingerprint():
+    deployer = Deployer(RecordingApiClient())
+    config = deployer.render("server.toml", "kanidm", "1.1.0", domain="idm.example.com", log_level="info", ldap_port=3890, http_port=8443,
+        backup_enabled=False, trust_x_forwarded_for=False, role="WriteReplica")
+    path = f"/api/v1/namespaces/kanidm/configmaps/{config['metadata']['name']}"
+
+    assert asyncio.run(deployer.drifted(config, "kanidm"))
+    asyncio.run(deployer.apply(copy.deepcopy(config), "kanidm", logger))
+    assert not asyncio.run(deployer.drifted(config, "kanidm"))
+
+    # Edited out of band
+    deployer.api_client.live[path]["data"]["server.toml"] += "\nlog_level = \"debug\""
+    assert asyncio.run(deployer.drifted(config, "kanidm"))
+    # Deleted out of band, forcing skips the unchanged render check
+    del deployer.api_client.live[path]
+    asyncio.run(deployer.apply(copy.deepcopy(config), "kanidm", logger, force=True))
+    assert not asyncio.run(deployer.drifted(config, "kanidm"))
+    assert len(deployer.api_client.calls) == 2
+
+
+def test_drifted_resources_are_applied_again(monkeypatch):
+    monkeypatch.setattr(deployer, "_api_client", RecordingApiClient())
+    monkeypatch.setattr(kopf, "adopt", lambda resource, owner=None: None)
+    asyncio.run(rollout_instance("kanidm", logger, *prepare_instance(high_availability_spec, "kanidm", "kanidm", {})))
+    live = deployer.api_client.live
+    [config_path] = [path for path in live if path.endswith("/configmaps/kanidm-config")]
+    [service_path] = [path for path in live if path.endswith("/services/kanidm-svc")]
+    applied = len(deployer.api_client.calls)
+
+    # Edited and deleted out of band, while their renders are unchanged
+    live[config_path]["data"]["server.toml"] += "\nlog_level = \"debug\""
+    del live[service_path]
+    assert asyncio.run(correct_workload_drift(high_availability_spec, "kanidm", "kanidm", logger, {})) == 2
+    assert len(deployer.api_client.calls) == applied + 2
+    assert service_path in live
+    assert asyncio.run(correct_workload_drift(high_availability_spec, "kanidm", "kanidm", logger, {})) == 0
+
+
+def test_disabling_high_availability_removes_the_read_replicas(monkeypatch):
+    monkeypatch.setattr(deployer, "_api_client", RecordingApiClient())
+    monkeypatch.setattr(kopf, "adopt", lambda resource, owner=None: None)
+    asyncio.run(rollout_instance("kanidm", logger, *prepare_instance(high_availability_spec, "kanidm", "kanidm", {})))
+    live = deployer.api_client.live
+    assert any(path.endswith("/statefulsets/kanidm-replica") for path in live)
+
+    spec = {**high_availability_spec, "highAvailability": {"enabled": False, "replicas": 2}}
+    patch = {}
+    asyncio.run(on_update_kanidms(spec=spec, name="kanidm", namespace="kanidm", logger=logger,
+        annotations={REPLICATION_CERTIFICATES_ANNOTATION: "{}"}, old={"spec": high_availability_spec}, patch=patch))
+    deleted = {path.rsplit("/", 2)[-2] + "/" + path.rsplit("/", 1)[-1] for path, method, _ in deployer.api_client.calls if method == "DELETE"}
+    assert deleted == {"statefulsets/kanidm-replica", "configmaps/kanidm-replica-config", "services/kanidm-repl", "services/kanidm-replica", "services/kanidm-read-svc"}
+    assert not any(path.endswith(resource) for path in live for resource in deleted)
+    assert any(path.endswith("/deployments/kanidm") for path in live)
+    assert patch["metadata"]["annotations"][REPLICATION_CERTIFICATES_ANNOTATION] is None
+
+    # Later updates have nothing left to remove
+    calls = len(deployer.api_client.calls)
+    asyncio.run(on_update_kanidms(spec=spec, name="kanidm", namespace="kanidm", logger=logger,
+        annotations={}, old={"spec": spec}, patch={}))
+    assert len(deployer.api_client.calls) == calls
@@ -0,0 +1,402 @@
+import asyncio
+import logging
+
+import kopf
+import pytest
+from kubernetes.client.exceptions import ApiException
+
+from kanidm_operator.deploy.bulk import bulk_reconcile_instance, drifted, oauth2client_state
+from kanidm_operator.deploy.oauth2client import oauth2client_changes, reconcile_oauth2client, secret_fingerprint
+from kanidm_operator.deployer import Deployer, deployer
+from kanidm_operator.http_client import KanidmHTTPClient, close_http_session
+from kanidm_operator.limiter import instance_limiter
+from kanidm_operator.metrics import sample_value
+from kanidm_operator.sessions import KanidmSession
+from kanidm_stub import KanidmStub
+from test_deployer import RecordingApiClient
+
+logger = logging.getLogger(__name__)
+
+
+async def connect(stub: KanidmStub) -> KanidmHTTPClient:
+    url = await stub.start()
+    client = KanidmHTTPClient("kanidm-instance", "kanidm", logger)
+    client.session = KanidmSession(url, "idm_admin", "password")
+    await client.ensure_logged_in()
+    return client
+
+
+def run(scenario):
+    async def wrapper():
+        stub = KanidmStub()
+        try:
+            await scenario(stub, await connect(stub))
+        finally:
+            await close_http_session()
+            await stub.stop()
+    asyncio.run(wrapper())
+
+
+def test_users_groups_and_oauth2_clients():
+    async def scenario(stub: KanidmStub, client: KanidmHTTPClient):
+        assert await client.get_user("marcus") is None
+        await client.create_user("marcus", "Marcus")
+        await client.set_user_emails("marcus", ["marcus@example.com"])
+        user = await client.get_user("marcus")
+        assert user["attrs"]["displayname"] == ["Marcus"]
+        assert user["attrs"]["mail"] == ["marcus@example.com"]
+
+        # Existing users only get their displayname updated
+        await client.create_user("marcus", "Marcus B")
+        assert (await client.get_user("marcus"))["attrs"]["displayname"] == ["Marcus B"]
+
+        await client.create_group("git-users")
+        await client.set_group_members("git-users", ["marcus"])
+        assert (await client.get_group("git-users"))["attrs"]["member"] == ["marcus"]
+
+        secret = await client.create_oauth2client("forgejo", "Forgejo", "https://git.example.com")
+        assert secret == stub.secrets["forgejo"]
+        await client.set_oauth2client_pkce("forgejo", False)
+        assert stub.entries["oauth2"]["forgejo"]["oauth2_allow_insecure_client_disable_pkce"] == ["true"]
+        await client.set_oauth2client_pkce("forgejo", True)
+        assert "oauth2_allow_insecure_client_disable_pkce" not in stub.entries["oauth2"]["forgejo"]
+
+        await client.delete_oauth2client("forgejo")
+        await client.delete_group("git-users")
+        await client.delete_user("marcus")
+        assert await client.get_user("marcus") is None
+
+    run(scenario)
+
+
+def test_relogin_when_session_is_rejected():
+    async def scenario(stub: KanidmStub, client: KanidmHTTPClient):
+        first_token = client.session.token
+        stub.revoke_tokens()
+        await client.create_group("git-users")
+        assert client.session.token != first_token
+        assert "git-users" in stub.entries["group"]
+
+    run(scenario)
+
+
+def test_group_members_are_reconciled_by_difference():
+    async def scenario(stub: KanidmStub, client: KanidmHTTPClient):
+        group = await client.create_group("git-users")
+        assert await client.reconcile_group_members("git-users", ["marcus", "anna"], group)
+        # kanidm reports members by spn, which must match the plain names
+        stub.entries["group"]["git-users"]["member"] = ["anna@idm.example.com", "marcus@idm.example.com"]
+
+        writes = stub.requests["POST"] + stub.requests["DELETE"]
+        assert not await client.reconcile_group_members("git-users", ["marcus", "anna"])
+        assert stub.requests["POST"] + stub.requests["DELETE"] == writes
+
+        assert await client.reconcile_group_members("git-users", ["marcus", "bob"])
+        assert sorted(stub.entries["group"]["git-users"]["member"]) == ["bob", "marcus@idm.example.com"]
+
+    run(scenario)
+
+
+def test_bulk_reconcile_lists_once_and_only_writes_the_difference():
+    async def scenario(stub: KanidmStub, client: KanidmHTTPClient):
+        stub.entries["person"]["anna"] = {"name": ["anna"], "displayname": ["Anna"], "mail": ["anna@example.com"]}
+        users = [
+            {"name": "anna", "spec": {"name": "anna", "displayName": "Anna", "emails": ["anna@example.com"]}},
+            {"name": "marcus", "spec": {"name": "marcus", "displayName": "Marcus", "emails": ["marcus@example.com"]}},
+        ]
+        groups = [{"name": "git-users", "spec": {"name": "git-users", "members": ["anna", "marcus"]}}]
+
+        stub.requests.clear()
+        assert await bulk_reconcile_instance(client, "kanidm", logger, users, groups, [], concurrency=2) == 0
+        assert stub.entries["person"]["marcus"]["mail"] == ["marcus@example.com"]
+        assert sorted(stub.entries["group"]["git-users"]["member"]) == ["anna", "marcus"]
+        # One list per kind, anna is already up to date
+        assert stub.requests["GET"] == 3
+        assert stub.requests["POST"] + stub.requests["PUT"] == 4
+
+        # A second pass finds nothing to change
+        stub.requests.clear()
+        assert await bulk_reconcile_instance(client, "kanidm", logger, users, groups, []) == 0
+        assert sum(stub.requests.values()) == 3
+
+    run(scenario)
+
+
+def test_bulk_reconciled_oauth2_secrets_belong_to_their_clients(monkeypatch):
+    created = []
+    monkeypatch.setattr(Deployer, "create_resource_factory", lambda self, **kwargs: created.append)
+
+    async def scenario(stub: KanidmStub, client: KanidmHTTPClient):
+        # As indexed by oauth2client_index, bulk reconciles run from the Kanidm's handlers
+        oauth2clients = [{
+            "name": "forgejo",
+            "spec": {"name": "forgejo", "displayName": "Forgejo", "origin": "https://git.example.com"},
+            "owner": {"apiVersion": "kanidm.github.io/v1alpha1", "kind": "OAuth2Client", "metadata": {"name": "forgejo", "namespace": "kanidm", "uid": "uid-forgejo"}},
+        }]
+        assert await bulk_reconcile_instance(client, "kanidm", logger, [], [], oauth2clients) == 0
+
+    run(scenario)
+    [secret] = created
+    [owner] = secret["metadata"]["ownerReferences"]
+    assert (owner["kind"], owner["name"], owner["uid"]) == ("OAuth2Client", "forgejo", "uid-forgejo")
+
+
+def test_unreachable_internal_service_falls_back_to_public_url():
+    async def scenario(stub: KanidmStub, client: KanidmHTTPClient):
+        # Nothing listens on port 1
+        client.session = KanidmSession(stub.url, "idm_admin", "password", internal_url="http://127.0.0.1:1")
+        await client.ensure_logged_in()
+        await client.create_group("git-users")
+        assert "git-users" in stub.entries["group"]
+        assert client.session.internal_unreachable_until > 0
+
+    run(scenario)
+
+
+def test_requests_lost_by_the_internal_service_are_not_resent():
+    async def scenario(stub: KanidmStub, client: KanidmHTTPClient):
+        # Accepts connections, then drops them without answering
+        server = await asyncio.start_server(lambda reader, writer: writer.close(), "127.0.0.1", 0)
+        try:
+            client.session.internal_url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+            posts = stub.requests["POST"]
+            with pytest.raises(kopf.TemporaryError):
+                await client.create_group("git-users")
+            assert stub.requests["POST"] == posts
+            assert client.session.internal_unreachable_until == 0
+        finally:
+            server.close()
+
+    run(scenario)
+
+
+def test_reads_are_routed_to_read_replicas():
+    async def scenario(stub: KanidmStub, client: KanidmHTTPClient):
+        replica = KanidmStub()
+        replica.entries = stub.entries
+        replica.tokens = stub.tokens
+        try:
+            client.session = KanidmSession("http://127.0.0.1:1", "idm_admin", "password",
+                internal_url=stub.url, read_url=await replica.start())
+            await client.ensure_logged_in()
+            await client.create_group("git-users")
+            writer_gets = stub.requests["GET"]
+            assert (await client.get_group("git-users"))["attrs"]["name"] == ["git-users"]
+            assert replica.requests["POST"] == 0
+            assert stub.requests["GET"] == writer_gets
+
+            # Sessions the replica doesn't know yet are retried on the write replica
+            replica.tokens = set()
+            assert await client.get_group("git-users") is not None
+            assert stub.requests["GET"] == writer_gets + 1
+        finally:
+            await replica.stop()
+
+    run(scenario)
+
+
+def test_requests_are_bounded_per_instance():
+    async def scenario(stub: KanidmStub, client: KanidmHTTPClient):
+        client.limiter = instance_limiter("kanidm", "kanidm-instance", 2)
+        stub.delay = 0.05
+        stub.max_in_flight = 0
+        waited = sample_value("kanidm_operator_kanidm_queue_wait_seconds_sum", namespace="kanidm", kanidm="kanidm-instance")
+        await asyncio.gather(*(client.get_group(f"group-{i}") for i in range(6)))
+        assert stub.max_in_flight == 2
+        # Four requests queued behind the first two, and two more behind those
+        total_wait = sample_value("kanidm_operator_kanidm_queue_wait_seconds_sum", namespace="kanidm", kanidm="kanidm-instance") - waited
+        assert total_wait >= 0.1
+
+    run(scenario)
+
+
+def test_drift_correction_only_writes_drifted_resources():
+    async def scenario(stub: KanidmStub, client: KanidmHTTPClient):
+        users = [{"name": "anna", "spec": {"name": "anna", "displayName": "Anna", "emails": ["anna@example.com"]}}]
+        groups = [{"name": "git-users", "spec": {"name": "git-users", "members": ["anna"]}}]
+        await bulk_reconcile_instance(client, "kanidm", logger, users, groups, [])
+        stub.entries["group"]["git-users"]["member"] = ["anna@idm.example.com"]
+
+        stub.requests.clear()
+        assert await bulk_reconcile_instance(client, "kanidm", logger, users, groups, [], only_drifted=True) == 0
+        assert sum(stub.requests.values()) == 3
+
+        # Someone removes anna in the kanidm UI
+        stub.entries["group"]["git-users"]["member"] = []
+        stub.requests.clear()
+        assert await bulk_reconcile_instance(client, "kanidm", logger, users, groups, [], only_drifted=True) == 0
+        assert stub.entries["group"]["git-users"]["member"] == ["anna"]
+        assert stub.requests["POST"] == 1 and stub.requests["PUT"] == 0
+
+    run(scenario)
+
+
+def test_oauth2_client_fingerprints_only_cover_managed_settings():
+    spec = {"name": "forgejo", "displayName": "Forgejo", "origin": "https://git.example.com",
+        "scope-map": {"group": "git-users", "scopes": ["openid", "email"]}}
+    entry = {"attrs": {
+        "oauth2_rs_name": ["forgejo"],
+        "displayname": ["Forgejo"],
+        "oauth2_rs_origin": ["https://git.example.com"],
+        # Not set by the spec, so not drift
+        "oauth2_rs_origin_landing": ["https://git.example.com/login"],
+        "oauth2_rs_scope_map": ['git-users@idm.example.com: {"email", "openid"}'],
+    }}
+    assert not drifted(oauth2client_state, spec, entry)
+    # Only set on creation
+    assert not drifted(oauth2client_state, {**spec, "displayName": "Forgejo Git"}, entry)
+    assert drifted(oauth2client_state, {**spec, "enable-pkce": False}, entry)
+    assert drifted(oauth2client_state, {**spec, "scope-map": {"group": "git-users", "scopes": ["openid"]}}, entry)
+
+
+def test_corrected_oauth2_clients_no_longer_drift(monkeypatch):
+    api_client = RecordingApiClient()
+    monkeypatch.setattr(deployer, "api_client", api_client)
+
+    async def scenario(stub: KanidmStub, client: KanidmHTTPClient):
+        oauth2clients = [{
+            "name": "forgejo",
+            "spec": {"name": "forgejo", "displayName": "Forgejo", "origin": "https://git.example.com"},
+            "owner": {"apiVersion": "kanidm.github.io/v1alpha1", "kind": "OAuth2Client", "metadata": {"name": "forgejo", "namespace": "kanidm", "uid": "1"}},
+        }]
+        await bulk_reconcile_instance(client, "kanidm", logger, [], [], oauth2clients)
+        # Renamed in the kanidm UI, which reconciles leave alone, and PKCE disabled
+        stub.entries["oauth2"]["forgejo"]["displayname"] = ["Forgejo Git"]
+        stub.entries["oauth2"]["forgejo"]["oauth2_allow_insecure_client_disable_pkce"] = ["true"]
+        await bulk_reconcile_instance(client, "kanidm", logger, [], [], oauth2clients, only_drifted=True)
+        assert stub.entries["oauth2"]["forgejo"].get("oauth2_allow_insecure_client_disable_pkce") != ["true"]
+
+        stub.requests.clear()
+        applied = len(api_client.calls)
+        assert await bulk_reconcile_instance(client, "kanidm", logger, [], [], oauth2clients, only_drifted=True) == 0
+        # Nothing left drifted, so only the three listings
+        assert stub.requests == {"GET": 3}
+        assert len(api_client.calls) == applied
+
+    run(scenario)
+
+
+def test_bulk_reconcile_creates_nested_groups_before_their_members():
+    async def scenario(stub: KanidmStub, client: KanidmHTTPClient):
+        stub.referential_integrity = True
+        users = [{"name": "anna", "spec": {"name": "anna", "displayName": "Anna"}}]
+        # Each group is a member of the one listed before it
+        groups = [
+            {"name": "admins", "spec": {"name": "admins", "members": ["anna", "git-admins"]}},
+            {"name": "git-admins", "spec": {"name": "git-admins", "members": ["anna"]}},
+        ]
+        assert await bulk_reconcile_instance(client, "kanidm", logger, users, groups, []) == 0
+        assert sorted(stub.entries["group"]["admins"]["member"]) == ["anna", "git-admins"]
+
+    run(scenario)
+
+
+def test_oauth2_client_settings_are_updated_in_one_request():
+    async def scenario(stub: KanidmStub, client: KanidmHTTPClient):
+        spec = {"name": "forgejo", "displayName": "Forgejo", "origin": "https://git.example.com",
+            "prefer-short-username": True, "enable-pkce": False, "callback-url": "https://git.example.com/login"}
+        entry = await client.ensure_oauth2client("forgejo", "Forgejo", "https://git.example.com", None)
+
+        stub.requests.clear()
+        await client.update_oauth2client("forgejo", **oauth2client_changes(spec, entry))
+        assert stub.requests["PATCH"] == 1
+
+        # Nothing left to change, so nothing to write
+        assert oauth2client_changes(spec, await client.get_oauth2client("forgejo")) == {}
+
+    run(scenario)
+
+
+def test_oauth2_client_secret_is_only_read_when_new_or_rotated(monkeypatch):
+    async def scenario(stub: KanidmStub, client: KanidmHTTPClient):
+        api_client = RecordingApiClient()
+        monkeypatch.setattr(deployer, "api_client", api_client)
+        spec = {"name": "forgejo", "displayName": "Forgejo", "origin": "https://git.example.com"}
+        owner = {"apiVersion": "kanidm.github.io/v1alpha1", "kind": "OAuth2Client", "metadata": {"name": "forgejo", "namespace": "kanidm", "uid": "1"}}
+
+        fingerprint = await reconcile_oauth2client(client, spec, "kanidm", logger, None, owner=owner)
+        assert fingerprint == secret_fingerprint(stub.secrets["forgejo"])
+        assert len(api_client.calls) == 1
+
+        stub.requests.clear()
+        existing = await client.get_oauth2client("forgejo")
+        assert await reconcile_oauth2client(client, spec, "kanidm", logger, existing, owner=owner, fingerprint=fingerprint) == fingerprint
+        assert stub.requests["GET"] == 1 and len(api_client.calls) == 1
+
+        rotated = await reconcile_oauth2client(client, spec, "kanidm", logger, existing, owner=owner, fingerprint=fingerprint, rotate=True)
+        assert rotated != fingerprint and rotated == secret_fingerprint(stub.secrets["forgejo"])
+        assert len(api_client.calls) == 2
+
+    run(scenario)
+
+
+def test_deleted_or_edited_oauth2_client_secrets_are_written_again(monkeypatch):
+    async def scenario(stub: KanidmStub, client: KanidmHTTPClient):
+        api_client = RecordingApiClient()
+        monkeypatch.setattr(deployer, "api_client", api_client)
+        spec = {"name": "forgejo", "displayName": "Forgejo", "origin": "https://git.example.com"}
+        owner = {"apiVersion": "kanidm.github.io/v1alpha1", "kind": "OAuth2Client", "metadata": {"name": "forgejo", "namespace": "kanidm", "uid": "1"}}
+        fingerprint = await reconcile_oauth2client(client, spec, "kanidm", logger, None, owner=owner)
+        existing = await client.get_oauth2client("forgejo")
+        [path] = api_client.live
+
+        del api_client.live[path]
+        assert await reconcile_oauth2client(client, spec, "kanidm", logger, existing, owner=owner, fingerprint=fingerprint) == fingerprint
+        assert path in api_client.live
+
+        api_client.live[path]["data"]["secret"] = "ZWRpdGVk"
+        assert await reconcile_oauth2client(client, spec, "kanidm", logger, existing, owner=owner, fingerprint=fingerprint) == fingerprint
+        assert api_client.live[path]["data"]["secret"] != "ZWRpdGVk"
+        assert len(api_client.calls) == 3
+
+    run(scenario)
+
+
+def test_bulk_reconciles_use_the_indexed_secret_fingerprint(monkeypatch):
+    async def scenario(stub: KanidmStub, client: KanidmHTTPClient):
+        api_client = RecordingApiClient()
+        monkeypatch.setattr(deployer, "api_client", api_client)
+        spec = {"name": "forgejo", "displayName": "Forgejo", "origin": "https://git.example.com"}
+        owner = {"apiVersion": "kanidm.github.io/v1alpha1", "kind": "OAuth2Client", "metadata": {"name": "forgejo", "namespace": "kanidm", "uid": "1"}}
+        fingerprint = await reconcile_oauth2client(client, spec, "kanidm", logger, None, owner=owner)
+        oauth2clients = [{"name": "forgejo", "spec": spec, "owner": owner, "fingerprint": fingerprint}]
+
+        stub.requests.clear()
+        assert await bulk_reconcile_instance(client, "kanidm", logger, [], [], oauth2clients) == 0
+        # Only the listings, the secret is already in the kubernetes Secret
+        assert stub.requests == {"GET": 3}
+
+        # A deleted Secret is drift, and written again
+        [path] = api_client.live
+        del api_client.live[path]
+        assert await bulk_reconcile_instance(client, "kanidm", logger, [], [], oauth2clients, only_drifted=True) == 0
+        assert path in api_client.live
+
+    run(scenario)
+
+
+def test_oauth2_client_secret_is_rotated_once_when_retried(monkeypatch):
+    class FailingApiClient:
+        def call_api(self, path, method, **kwargs):
+            raise ApiException(status=500)
+
+    async def scenario(stub: KanidmStub, client: KanidmHTTPClient):
+        spec = {"name": "forgejo", "displayName": "Forgejo", "origin": "https://git.example.com"}
+        owner = {"apiVersion": "kanidm.github.io/v1alpha1", "kind": "OAuth2Client", "metadata": {"name": "forgejo", "namespace": "kanidm", "uid": "1"}}
+        monkeypatch.setattr(deployer, "api_client", RecordingApiClient())
+        fingerprint = await reconcile_oauth2client(client, spec, "kanidm", logger, None, owner=owner)
+        existing = await client.get_oauth2client("forgejo")
+
+        # The secret is reset in kanidm, but writing the kubernetes Secret fails
+        monkeypatch.setattr(deployer, "api_client", FailingApiClient())
+        with pytest.raises(ApiException):
+            await reconcile_oauth2client(client, spec, "kanidm", logger, existing, owner=owner, fingerprint=fingerprint, rotate=True)
+        rotated = stub.secrets["forgejo"]
+        assert secret_fingerprint(rotated) != fingerprint
+
+        # The retry writes that secret rather than resetting it again
+        monkeypatch.setattr(deployer, "api_client", RecordingApiClient())
+        assert await reconcile_oauth2client(client, spec, "kanidm", logger, existing, owner=owner, fingerprint=fingerprint, rotate=True) == secret_fingerprint(rotated)
+        assert stub.secrets["forgejo"] == rotated
+
+    run(scenario)
@@ -0,0 +1,48 @@
+import asyncio
+
+from kanidm_operator.deploy.kanidm import RECOVERY_MARKER, boot_delay, kanidm_pod_index, parse_recovered_passwords, ready_pods
+
+
+def pod(name, component, instance, ready):
+    return asyncio.run(kanidm_pod_index(
+        name=name,
+        namespace="kanidm",
+        labels={"app.kubernetes.io/name": component, "kanidm.github.io/instance": instance},
+        status={"conditions": [{"type": "Ready", "status": "True" if ready else "False"}]},
+    ))
+
+
+def test_ready_pods_are_scoped_to_the_instance():
+    index = {}
+    for entry in [
+        pod("kanidm-abc", "kanidm", "kanidm-instance", True),
+        pod("kanidm-def", "kanidm", "other-instance", True),
+        pod("kanidm-replica-0", "kanidm-replica", "kanidm-instance", False),
+    ]:
+        for key, value in entry.items():
+            index.setdefault(key, []).append(value)
+
+    assert ready_pods(index, "kanidm", "kanidm-instance", "kanidm") == ["kanidm-abc"]
+    assert ready_pods(index, "kanidm", "kanidm-instance", "kanidm-replica") == []
+    assert ready_pods(index, "other", "kanidm-instance", "kanidm") == []
+
+
+def test_boot_delay_backs_off_exponentially():
+    assert [boot_delay(retry) for retry in range(4)] == [1, 2, 4, 8]
+    assert boot_delay(100) == 30
+
+
+def test_recovered_passwords_are_parsed_from_interleaved_logs():
+    output = "\n".join([
+        f"{RECOVERY_MARKER} admin",
+        '{"level":"info","msg":"Running account recovery"}',
+        "00000000-0000 INFO Running account recovery {",
+        '{"password":"admin-password"}',
+        f"{RECOVERY_MARKER} idm_admin",
+        'WARN something {"not": "json"',
+        '{"password":"idm-admin-password"} trailing log',
+        "",
+    ])
+    assert parse_recovered_passwords(output) == {"admin": "admin-password", "idm_admin": "idm-admin-password"}
+    # An account whose recovery failed is missing, rather than mixed up with the next
+    assert parse_recovered_passwords(f"{RECOVERY_MARKER} admin\nerror\n{RECOVERY_MARKER} idm_admin\n" + '{"password":"p"}') == {"idm_admin": "p"}
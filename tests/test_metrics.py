@@ -0,0 +1,47 @@
+import asyncio
+import time
+
+import kopf
+from prometheus_client import REGISTRY, generate_latest
+
+from kanidm_operator.http_client import http_operation
+from kanidm_operator.metrics import (
+    instrumented,
+    kanidm_requests,
+    monitor_event_loop_lag,
+    sample_value,
+)
+
+
+def test_event_loop_lag_is_measured():
+    async def scenario():
+        monitor = asyncio.create_task(monitor_event_loop_lag(interval=0.05))
+        await asyncio.sleep(0.1)
+        # A blocking call stalls the loop, which the monitor must notice
+        time.sleep(0.3)
+        await asyncio.sleep(0.1)
+        monitor.cancel()
+
+    asyncio.run(scenario())
+    assert sample_value("kanidm_operator_event_loop_lag_max_seconds") >= 0.2
+
+
+def test_requests_are_rendered_by_operation():
+    kanidm_requests.labels(backend="http", operation=http_operation("GET", "/v1/person/marcus/_attr/mail"), outcome="success").inc()
+
+    rendered = generate_latest(REGISTRY).decode("utf-8")
+    assert 'kanidm_operator_kanidm_requests_total{backend="http",operation="GET /v1/person/:name/_attr/mail",outcome="success"}' in rendered
+
+
+def test_instrumented_handlers_record_their_outcome():
+    @instrumented
+    async def on_create_thing(**kwargs):
+        assert sample_value("kanidm_operator_handlers_in_progress", handler="on_create_thing") == 1
+        raise kopf.TemporaryError("not yet", delay=10)
+
+    try:
+        asyncio.run(on_create_thing())
+    except kopf.TemporaryError:
+        pass
+    assert sample_value("kanidm_operator_handlers_in_progress", handler="on_create_thing") == 0
+    assert sample_value("kanidm_operator_handler_duration_seconds_count", handler="on_create_thing", outcome="retry") == 1
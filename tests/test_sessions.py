@@ -0,0 +1,35 @@
+from kanidm_operator.sessions import KanidmSession, SessionCache
+
+
+def make_session(ttl=600.0):
+    return KanidmSession("https://idm.example.com", "idm_admin", "secret", ttl=ttl)
+
+
+def test_session_validity():
+    session = make_session()
+    assert not session.valid
+    session.mark_logged_in()
+    assert session.valid
+    session.invalidate()
+    assert not session.valid
+
+    expired = make_session(ttl=0)
+    expired.mark_logged_in()
+    assert not expired.valid
+
+
+def test_session_cache_lru_and_eviction():
+    cache = SessionCache(max_size=2)
+    a, b, c = make_session(), make_session(), make_session()
+    cache.put(("a", "ns", "idm_admin"), a)
+    cache.put(("b", "ns", "idm_admin"), b)
+    # Touch a, so that b is the least recently used
+    assert cache.get(("a", "ns", "idm_admin")) is a
+    cache.put(("c", "ns", "idm_admin"), c)
+    assert cache.get(("b", "ns", "idm_admin")) is None
+    assert len(cache) == 2
+
+    assert cache.evict_where(lambda key, session: key[0] == "a") == 1
+    assert cache.get(("a", "ns", "idm_admin")) is None
+    assert cache.evict(("c", "ns", "idm_admin")) is c
+    assert len(cache) == 0
@@ -0,0 +1,13 @@
+import asyncio
+import logging
+
+import kopf
+
+from kanidm_operator import settings as operator_settings
+
+
+def test_updates_are_coalesced_within_the_configured_window(monkeypatch):
+    monkeypatch.setattr(operator_settings, "coalesce_window", 2.5)
+    settings = kopf.OperatorSettings()
+    asyncio.run(operator_settings.configure_operator(settings=settings, logger=logging.getLogger(__name__)))
+    assert settings.batching.batch_window == 2.5
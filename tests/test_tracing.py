@@ -0,0 +1,54 @@
+import asyncio
+import json
+import logging
+
+from kanidm_operator import tracing
+from kanidm_operator.http_client import close_http_session
+from kanidm_operator.metrics import instrumented
+from kanidm_stub import KanidmStub
+from test_http_client import connect
+
+logger = logging.getLogger(__name__)
+
+
+def test_reconcile_steps_are_traced_under_their_handler(monkeypatch, tmp_path):
+    monkeypatch.setattr(tracing, "tracing_enabled", True)
+    monkeypatch.setattr(tracing, "trace_file", str(tmp_path / "spans.jsonl"))
+    tracing._finished.clear()
+
+    @instrumented
+    async def on_create_group(stub: KanidmStub, **kwargs):
+        client = await connect(stub)
+        await client.create_group("git-users")
+
+    async def scenario():
+        stub = KanidmStub()
+        try:
+            await on_create_group(stub, body={"kind": "Group"}, namespace="kanidm", name="git-users")
+        finally:
+            await close_http_session()
+            await stub.stop()
+        await tracing.export_spans()
+
+    asyncio.run(scenario())
+    spans = [json.loads(line) for line in (tmp_path / "spans.jsonl").read_text().splitlines()]
+    by_name = {span["name"]: span for span in spans}
+    handler = by_name["handler on_create_group"]
+    assert "parentSpanId" not in handler
+    assert {"key": "k8s.name", "value": {"stringValue": "git-users"}} in handler["attributes"]
+
+    # Login and each kanidm request are children of the handler, in the same trace
+    for name in ("kanidm login", "kanidm GET /v1/group/:name", "kanidm POST /v1/group"):
+        assert by_name[name]["traceId"] == handler["traceId"]
+    assert by_name["kanidm login"]["parentSpanId"] == handler["spanId"]
+    assert by_name["kanidm POST /v1/auth"]["parentSpanId"] == by_name["kanidm login"]["spanId"]
+    assert by_name["kanidm POST /v1/group"]["parentSpanId"] == handler["spanId"]
+    assert not tracing._finished
+
+
+def test_spans_are_free_when_tracing_is_disabled(monkeypatch):
+    monkeypatch.setattr(tracing, "tracing_enabled", False)
+    tracing._finished.clear()
+    with tracing.span("handler on_create_user") as current:
+        assert current is None
+    assert not tracing._finished